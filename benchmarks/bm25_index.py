@@ -0,0 +1,108 @@
+"""
+Benchmark for the persistent BM25 index over key elements.
+
+Builds a BM25Index over synthetic key elements, one to four words drawn from
+a Zipf-distributed vocabulary, and reports how long building and reopening
+it takes and the latency of top-k queries. Up to --baseline-max key
+elements it also times what get_potential_nodes used to do on every
+question: build a BM25Okapi over all key elements and sort every score.
+
+Usage:
+    python -m benchmarks.bm25_index --sizes 10000 100000 1000000
+"""
+
+import argparse
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from src.adapters.bm25_index import BM25Index, tokenize
+
+
+def make_key_elements(n: int, vocabulary_size: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    words = np.minimum(rng.zipf(1.2, size=4 * n), vocabulary_size) - 1
+    lengths = rng.integers(1, 5, size=n)
+    key_elements, position = [], 0
+    for i, length in enumerate(lengths):
+        phrase = " ".join(f"term{w}" for w in words[position : position + length])
+        # Key elements are unique in the graph
+        key_elements.append(f"{phrase} {i}")
+        position += length
+    return key_elements
+
+
+def make_queries(n: int, vocabulary_size: int, seed: int = 1):
+    rng = random.Random(seed)
+    return [
+        " ".join(
+            f"term{min(int(rng.paretovariate(0.2)), vocabulary_size) - 1}"
+            for _ in range(rng.randint(2, 6))
+        )
+        for _ in range(n)
+    ]
+
+
+def percentiles(latencies):
+    p50, p95 = np.percentile(np.asarray(latencies) * 1000, [50, 95])
+    return f"p50 {p50:8.2f} ms, p95 {p95:8.2f} ms"
+
+
+def bench_index(key_elements, queries, k: int):
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        BM25Index(directory).add(key_elements)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = BM25Index(directory)
+        reopen = time.perf_counter() - start
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            index.search(query, k)
+            latencies.append(time.perf_counter() - start)
+        print(
+            f"    index: build {build:6.1f} s, reopen {reopen * 1000:6.1f} ms, "
+            f"query {percentiles(latencies)}"
+        )
+
+
+def bench_baseline(key_elements, queries, k: int):
+    from rank_bm25 import BM25Okapi
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        bm25 = BM25Okapi([tokenize(key_element) for key_element in key_elements])
+        scores = bm25.get_scores(tokenize(query))
+        sorted(zip(key_elements, scores), key=lambda item: item[1], reverse=True)[:k]
+        latencies.append(time.perf_counter() - start)
+    print(f" BM25Okapi: rebuilt per query, {percentiles(latencies)}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    arg_parser.add_argument("--vocabulary", type=int, default=50_000)
+    arg_parser.add_argument("--queries", type=int, default=200)
+    arg_parser.add_argument("--baseline-queries", type=int, default=5)
+    arg_parser.add_argument("--baseline-max", type=int, default=100_000)
+    arg_parser.add_argument("-k", type=int, default=10)
+    args = arg_parser.parse_args()
+
+    queries = make_queries(args.queries, args.vocabulary)
+    for size in args.sizes:
+        print(f"{size} key elements")
+        key_elements = make_key_elements(size, args.vocabulary)
+        bench_index(key_elements, queries, args.k)
+        if size <= args.baseline_max:
+            bench_baseline(key_elements, queries[: args.baseline_queries], args.k)
+
+
+if __name__ == "__main__":
+    main()
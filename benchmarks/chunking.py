@@ -0,0 +1,244 @@
+"""
+Benchmark for token-accurate chunking.
+
+Times src.reader_agent.kg_constructor.iter_chunks against the previous chunker,
+which estimated tokens by counting words, on a synthetic document. It also
+reports how far each chunker's chunks land from the token budget, measured
+with the extraction model's tokenizer.
+
+Usage:
+    python -m benchmarks.chunking --pages 200 --chunk-size 2000 --overlap 200
+"""
+
+import argparse
+import random
+import timeit
+from typing import Dict, Iterable, Iterator, List
+
+from src.models import Block, Page
+from src.reader_agent.chains import GPT4O_MODEL
+from src.reader_agent.kg_constructor import iter_chunks
+from src.utils import count_tokens, get_encoding
+
+WORDS = (
+    "the of and to in a is that for it as was with be by on not this are or from "
+    "at which have an they were one all their has been more when will would if "
+    "revenue payment customer regulation 2024 Article §12 (b) interest-rate"
+).split()
+
+
+def make_synthetic_pages(n_pages: int, blocks_per_page: int = 25):
+    rng = random.Random(42)
+
+    def paragraph(n_words: int) -> str:
+        return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+    position = {"p1": (0, 0), "p2": (1, 0), "p3": (1, 1), "p4": (0, 1)}
+    pages = []
+    for page_num in range(n_pages):
+        blocks = []
+        for index in range(blocks_per_page):
+            r = rng.random()
+            if r < 0.08:
+                block_type = "SectionHeader"
+                text = "#" * rng.randint(1, 4) + " " + paragraph(rng.randint(2, 12))
+            elif r < 0.12:
+                block_type, text = "Table", paragraph(300)
+            else:
+                block_type, text = "Text", paragraph(rng.randint(20, 250))
+            blocks.append(
+                {
+                    "id": f"/page/{page_num}/{block_type}/{index}",
+                    "type": block_type,
+                    "text": text,
+                    "position": position,
+                }
+            )
+        pages.append(
+            Page.model_validate(
+                {"id": str(page_num), "number": page_num + 1, "blocks": blocks}
+            )
+        )
+    return pages
+
+
+def legacy_iter_chunks(pages: Iterable[Page], chunk_size=2000) -> Iterator[dict]:
+    """
+    The word-count chunker iter_chunks replaced.
+
+    Yield chunks from a stream of pages while maintaining proper header hierarchy
+    and context. Each chunk is emitted as soon as it is complete, so pages can be
+    consumed while they are still being parsed.
+    """
+    current_chunk: List[Block] = []
+    current_tokens = 0
+    current_context: Dict[str, List[str]] = {
+        "headers": [],  # List of headers in hierarchical order
+        "footnotes": [],
+        "captions": [],
+    }
+
+    # Block types that should be kept together
+    atomic_blocks = {
+        "Table",
+        "Figure",
+        "ListGroup",
+        "Code",
+        "Equation",
+        "TableOfContents",
+        "PictureGroup",
+    }
+
+    # Block types that provide context
+    header_types = {"SectionHeader", "PageHeader"}
+    context_types = {"Caption", "Footnote"}
+
+    def get_header_level(header_text: str) -> int:
+        """Get header level from number of leading '#' characters"""
+        return len(header_text) - len(header_text.lstrip("#"))
+
+    def update_header_hierarchy(new_header: str) -> bool:
+        """
+        Update header hierarchy and return True if context changed.
+        """
+        new_level = get_header_level(new_header)
+
+        # Remove headers of same or lower level
+        existing_headers = current_context["headers"]
+        current_context["headers"] = [
+            h for h in existing_headers if get_header_level(h) < new_level
+        ]
+
+        # Add new header
+        current_context["headers"].append(new_header)
+        return bool(existing_headers) and (
+            existing_headers not in current_context["headers"]
+        )
+
+    def create_chunk_with_context(page, blocks, chunk_type="TextGroup"):
+        """Create a chunk with proper context and header hierarchy"""
+        if not blocks:
+            return None
+
+        # Get text with headers
+        header_text = (
+            "\n".join(current_context["headers"]) if current_context["headers"] else ""
+        )
+        block_text = "\n".join(b.text for b in blocks)
+        combined_text = f"{header_text}\n\n{block_text}" if header_text else block_text
+
+        return {
+            "text": combined_text,
+            "type": chunk_type,
+            "context": {
+                "headers": current_context["headers"].copy(),
+                "footnotes": current_context["footnotes"].copy(),
+                "captions": current_context["captions"].copy(),
+            },
+            "page": page.number,
+            "block_positions": [
+                coord for b in blocks for coord in b.position.to_list()
+            ],
+        }
+
+    # Process blocks in order
+    for page in pages:
+        context_changed = False
+
+        for block in page.blocks:
+            # Update context for headers
+            if block.type in header_types:
+                context_changed = update_header_hierarchy(block.text)
+                continue
+
+            # Update context for footnotes and captions
+            if block.type in context_types:
+                current_context[block.type.lower() + "s"].append(block.text)
+                continue
+
+            # Handle atomic blocks (keep intact)
+            if block.type in atomic_blocks:
+                # Save current chunk if exists
+                if current_chunk:
+                    chunk = create_chunk_with_context(page, current_chunk)
+                    if chunk:
+                        yield chunk
+                    current_chunk = []
+                    current_tokens = 0
+
+                # Create atomic block chunk
+                atomic_chunk = create_chunk_with_context(page, [block], block.type)
+                if atomic_chunk:
+                    yield atomic_chunk
+                continue
+
+            # Handle regular text blocks
+            if block.type in {"Text", "TextInlineMath", "ListItem"}:
+                estimated_tokens = len(block.text.split())
+
+                # Start new chunk if current is too large or context changed
+                if current_tokens + estimated_tokens > chunk_size or context_changed:
+                    if current_chunk:
+                        chunk = create_chunk_with_context(page, current_chunk)
+                        if chunk:
+                            yield chunk
+                        current_chunk = []
+                        current_tokens = 0
+                    context_changed = False
+
+                current_chunk.append(block)
+                current_tokens += estimated_tokens
+
+        # Add remaining blocks at end of page
+        if current_chunk:
+            chunk = create_chunk_with_context(page, current_chunk)
+            if chunk:
+                yield chunk
+            current_chunk = []
+            current_tokens = 0
+
+
+def budget_report(name, chunks, chunk_size):
+    sizes = [
+        count_tokens(chunk["text"], GPT4O_MODEL)
+        for chunk in chunks
+        if chunk["type"] == "TextGroup"
+    ]
+    over = sum(size > chunk_size for size in sizes)
+    print(
+        f"{name:>8}: {len(sizes)} text chunks, mean {sum(sizes) / len(sizes):.0f} "
+        f"tokens, max {max(sizes)}, {over} over the {chunk_size} token budget"
+    )
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--pages", type=int, default=200)
+    arg_parser.add_argument("--chunk-size", type=int, default=2000)
+    arg_parser.add_argument("--overlap", type=int, default=0)
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    pages = make_synthetic_pages(args.pages)
+    # Load the tokenizer outside the timed runs
+    get_encoding(GPT4O_MODEL)
+
+    runs = {
+        "words": lambda: list(legacy_iter_chunks(pages, args.chunk_size)),
+        "tokens": lambda: list(iter_chunks(pages, args.chunk_size, args.overlap)),
+    }
+    timings = {}
+    for name, func in runs.items():
+        timings[name] = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(
+            f"{name:>8}: {timings[name] * 1000:8.2f} ms for {args.pages} pages "
+            f"({args.pages / timings[name]:.0f} pages/s)"
+        )
+    print(f"Token-accurate chunking is {timings['tokens'] / timings['words']:.2f}x")
+
+    for name, func in runs.items():
+        budget_report(name, func(), args.chunk_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Benchmark for the extraction scheduler against a fake LLM gateway.
+
+The fake gateway answers after a random latency, enforces its own
+request-per-second limit and concurrency cap by answering 429, and fails a
+share of the remaining requests with 500. The benchmark extracts the same
+chunks the way process_document used to, all at once, and through
+ExtractionScheduler, then reports how many chunks made it and how fast.
+Finally it checks that the scheduler keeps to its own request and token
+budgets when every request is larger than one second of budget.
+
+Usage:
+    python -m benchmarks.extraction_scheduler --chunks 300 --gateway-rpm 1200
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+from src.models import AtomicFact, Extraction
+from src.reader_agent.scheduler import ExtractionScheduler
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, retry_after: Optional[float] = None):
+        self.status_code = status_code
+        self.headers = {"retry-after": str(retry_after)} if retry_after else {}
+
+
+class FakeAPIError(Exception):
+    def __init__(self, status_code: int, retry_after: Optional[float] = None):
+        super().__init__(f"Error code: {status_code}")
+        self.status_code = status_code
+        self.response = FakeResponse(status_code, retry_after)
+
+
+class FakeGateway:
+    """Async stand-in for the construction chain with throttling and errors."""
+
+    def __init__(self, rpm: float, max_in_flight: int, latency: float, error_rate):
+        self.per_second = rpm / 60
+        self.max_in_flight = max_in_flight
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(42)
+        self.started: Deque[float] = deque()
+        self.in_flight = 0
+        self.throttled = 0
+        # (start time, tokens) of every request the gateway accepted
+        self.sent: List[Tuple[float, int]] = []
+
+    async def __call__(self, chunk: dict) -> Extraction:
+        now = time.monotonic()
+        while self.started and now - self.started[0] > 1:
+            self.started.popleft()
+        if len(self.started) >= self.per_second or self.in_flight >= self.max_in_flight:
+            self.throttled += 1
+            raise FakeAPIError(429, retry_after=1)
+        self.started.append(now)
+        self.sent.append((now, chunk.get("tokens", 0)))
+
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(self.rng.uniform(0.5, 1.5) * self.latency)
+        finally:
+            self.in_flight -= 1
+        if self.rng.random() < self.error_rate:
+            raise FakeAPIError(500)
+        return Extraction(
+            atomic_facts=[AtomicFact(key_elements=["fact"], atomic_fact=chunk["text"])]
+        )
+
+
+def make_gateway(args) -> FakeGateway:
+    return FakeGateway(
+        args.gateway_rpm, args.gateway_concurrency, args.latency, args.error_rate
+    )
+
+
+async def unbounded(gateway, chunks):
+    """The previous behaviour: one task per chunk, gathered at once."""
+    tasks = [asyncio.create_task(gateway(chunk)) for chunk in chunks]
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def scheduled(gateway, chunks, args):
+    scheduler = ExtractionScheduler(
+        gateway,
+        max_concurrency=args.concurrency,
+        # Stay a little below the gateway limit to leave room for jitter
+        requests_per_minute=args.gateway_rpm * 0.9,
+        base_delay=0.5,
+        max_delay=10,
+    )
+    tasks = [await scheduler.submit(chunk) for chunk in chunks]
+    outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+    print(
+        f"    {scheduler.stats.requests} requests, {scheduler.stats.retries} retries, "
+        f"{scheduler.stats.rate_limited} rate limited"
+    )
+    return outcomes
+
+
+def report(name, outcomes, elapsed, gateway):
+    succeeded = sum(isinstance(o, Extraction) for o in outcomes)
+    print(
+        f"{name:>10}: {succeeded}/{len(outcomes)} chunks extracted in {elapsed:.1f} s "
+        f"({succeeded / elapsed:.1f} chunks/s), {gateway.throttled} throttled by "
+        "the gateway"
+    )
+
+
+def largest_burst(sent: List[Tuple[float, float]], per_second: float) -> float:
+    """
+    The most budget sent beyond the refill between any two requests.
+
+    A sender keeps to a token bucket of capacity c refilled at per_second
+    exactly when, for any requests i <= j, the amount sent from i to j is
+    at most c + per_second * (t_j - t_i).
+    """
+    return max(
+        sum(amount for _, amount in sent[i : j + 1])
+        - per_second * (sent[j][0] - sent[i][0])
+        for i in range(len(sent))
+        for j in range(i, len(sent))
+    )
+
+
+async def check_limit(name, scheduler, gateway, chunks, limit: float, amount):
+    tasks = [await scheduler.submit(chunk) for chunk in chunks]
+    await asyncio.gather(*tasks)
+    sent = [(t, amount(tokens)) for t, tokens in gateway.sent]
+    # One second of budget, or the largest request the bucket grows to
+    capacity = max(limit / 60, max(a for _, a in sent))
+    burst = largest_burst(sent, limit / 60)
+    verdict = "ok" if burst <= capacity * 1.01 else "EXCEEDED"
+    print(
+        f"{name:>10}: {len(sent)} requests in {sent[-1][0] - sent[0][0]:.1f} s, "
+        f"burst {burst:.0f} of {capacity:.0f}, {verdict}"
+    )
+
+
+def check_limits(args):
+    """Requests larger than one second of budget must still be fully charged."""
+    gateway = FakeGateway(60_000, 1000, args.latency, 0)
+    scheduler = ExtractionScheduler(
+        gateway, tokens_per_minute=60_000, request_overhead_tokens=0
+    )
+    chunks = [{"text": f"chunk {i}", "tokens": 3000} for i in range(4)]
+    asyncio.run(check_limit("TPM", scheduler, gateway, chunks, 60_000, lambda t: t))
+
+    gateway = FakeGateway(60_000, 1000, args.latency, 0)
+    scheduler = ExtractionScheduler(gateway, requests_per_minute=30)
+    chunks = [{"text": f"chunk {i}", "tokens": 0} for i in range(4)]
+    asyncio.run(check_limit("RPM", scheduler, gateway, chunks, 30, lambda t: 1))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--chunks", type=int, default=300)
+    arg_parser.add_argument("--gateway-rpm", type=float, default=1200)
+    arg_parser.add_argument("--gateway-concurrency", type=int, default=32)
+    arg_parser.add_argument("--latency", type=float, default=0.3)
+    arg_parser.add_argument("--error-rate", type=float, default=0.05)
+    arg_parser.add_argument("--concurrency", type=int, default=16)
+    args = arg_parser.parse_args()
+
+    chunks = [
+        {"text": f"chunk {i}", "tokens": random.randint(200, 2000)}
+        for i in range(args.chunks)
+    ]
+
+    for name, run in (
+        ("unbounded", lambda gateway: unbounded(gateway, chunks)),
+        ("scheduled", lambda gateway: scheduled(gateway, chunks, args)),
+    ):
+        gateway = make_gateway(args)
+        start = time.perf_counter()
+        outcomes = asyncio.run(run(gateway))
+        report(name, outcomes, time.perf_counter() - start, gateway)
+    check_limits(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Benchmark for the HTML to Markdown conversion of Marker blocks.
+
+Checks src.utils.html_to_md and html_blocks_to_md against the golden corpus in
+benchmarks/data/html_to_md_golden.json, then times them against the previous
+BeautifulSoup-based converter on a synthetic set of pages.
+
+Usage:
+    python -m benchmarks.html_to_md --blocks 10000
+"""
+
+import argparse
+import json
+import os
+import re
+import timeit
+
+from bs4 import BeautifulSoup
+
+from src.utils import html_blocks_to_md, html_to_md
+
+GOLDEN_PATH = os.path.join(os.path.dirname(__file__), "data", "html_to_md_golden.json")
+
+
+def legacy_html_to_md(html_content: str) -> str:
+    """The multi-pass BeautifulSoup converter html_to_md replaced."""
+    soup = BeautifulSoup(html_content, "html.parser")
+
+    for script in soup(["script", "style"]):
+        script.decompose()
+
+    for i in range(6, 0, -1):
+        for heading in soup.find_all(f"h{i}"):
+            heading.replace_with(f"{'#' * i} {heading.get_text()}\n")
+
+    for link in soup.find_all("a"):
+        link.replace_with(f"[{link.get_text()}]({link.get('href', '')})")
+
+    for img in soup.find_all("img"):
+        img.replace_with(f"![{img.get('alt', '')}]({img.get('src', '')})")
+
+    for ul in soup.find_all("ul"):
+        for li in ul.find_all("li"):
+            li.replace_with(f"- {li.get_text()}\n")
+
+    for ol in soup.find_all("ol"):
+        for i, li in enumerate(ol.find_all("li"), 1):
+            li.replace_with(f"{i}. {li.get_text()}\n")
+
+    for strong in soup.find_all(["strong", "b"]):
+        strong.replace_with(f"**{strong.get_text()}**")
+
+    for em in soup.find_all(["em", "i"]):
+        em.replace_with(f"*{em.get_text()}*")
+
+    for pre in soup.find_all("pre"):
+        code = pre.find("code")
+        if code:
+            classes = code.get("class")
+            lang = classes[0].replace("language-", "") if classes else ""
+            pre.replace_with(f"```{lang}\n{code.get_text()}\n```\n")
+
+    for code in soup.find_all("code"):
+        if code.parent is None or code.parent.name != "pre":
+            code.replace_with(f"`{code.get_text()}`")
+
+    for quote in soup.find_all("blockquote"):
+        lines = quote.get_text().strip().split("\n")
+        quote.replace_with("> " + "\n> ".join(lines) + "\n")
+
+    for table in soup.find_all("table"):
+        md_table = []
+        headers = [th.get_text().strip() for th in table.find_all("th")]
+        if headers:
+            md_table.append("| " + " | ".join(headers) + " |")
+            md_table.append("| " + " | ".join(["---"] * len(headers)) + " |")
+        for tr in table.find_all("tr"):
+            cells = [td.get_text().strip() for td in tr.find_all("td")]
+            if cells:
+                md_table.append("| " + " | ".join(cells) + " |")
+        table.replace_with("\n".join(md_table) + "\n")
+
+    text = soup.get_text()
+    text = re.sub(r"\n\s*\n", "\n\n", text)
+    text = re.sub(r" +", " ", text)
+    return text.strip()
+
+
+def check_golden(cases):
+    failures = [case for case in cases if html_to_md(case["html"]) != case["markdown"]]
+    for case in failures:
+        print(f"Mismatch for {case['html']!r}:")
+        print(f"  expected {case['markdown']!r}")
+        print(f"  got      {html_to_md(case['html'])!r}")
+    assert not failures, f"{len(failures)} of {len(cases)} golden cases differ"
+    batch = html_blocks_to_md([case["html"] for case in cases])
+    assert batch == [case["markdown"] for case in cases], "Batch API differs"
+    print(f"All {len(cases)} golden cases match")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--blocks", type=int, default=10000)
+    arg_parser.add_argument("--blocks-per-page", type=int, default=25)
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    with open(GOLDEN_PATH) as f:
+        cases = json.load(f)
+    check_golden(cases)
+
+    htmls = [case["html"] for case in cases]
+    blocks = [htmls[i % len(htmls)] for i in range(args.blocks)]
+    pages = [
+        blocks[i : i + args.blocks_per_page]
+        for i in range(0, len(blocks), args.blocks_per_page)
+    ]
+
+    runs = {
+        "legacy": lambda: [legacy_html_to_md(html) for html in blocks],
+        "single-pass": lambda: [html_to_md(html) for html in blocks],
+        "batched": lambda: [html_blocks_to_md(page) for page in pages],
+    }
+    for name, func in runs.items():
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(f"{name:>12}: {best * 1000:8.2f} ms for {args.blocks} blocks")
+
+
+if __name__ == "__main__":
+    main()
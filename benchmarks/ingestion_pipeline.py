@@ -0,0 +1,102 @@
+"""
+Benchmark for the staged document pipeline against phase-by-phase ingestion.
+
+Simulates a large document whose pages take a fixed time to parse, an LLM
+with a fixed latency and a Neo4j import with a fixed cost per chunk, without
+touching Neo4j or the LLM. The phased run parses everything, then extracts
+everything, then writes everything, as process_document used to; the
+pipelined run uses DocumentPipeline. The pipelined run should take about as
+long as the slowest stage, the phased one as long as all stages together.
+
+Usage:
+    python -m benchmarks.ingestion_pipeline --pages 200 --parse-time 0.02
+"""
+
+import argparse
+import asyncio
+import time
+
+from benchmarks.chunking import make_synthetic_pages
+from src.models import AtomicFact, Document, Extraction
+from src.reader_agent import kg_constructor
+from src.reader_agent.pipeline import DocumentPipeline
+from src.reader_agent.scheduler import ExtractionScheduler
+
+
+def slow_pages(pages, parse_time: float):
+    for page in pages:
+        time.sleep(parse_time)
+        yield page
+
+
+def fake_extract(latency: float):
+    async def extract(chunk: dict) -> Extraction:
+        await asyncio.sleep(latency)
+        return Extraction(
+            atomic_facts=[AtomicFact(key_elements=["fact"], atomic_fact=chunk["text"])]
+        )
+
+    return extract
+
+
+def fake_graph(write_time: float):
+    """Replace the Neo4j functions the pipeline calls with timed stand-ins."""
+    kg_constructor.find_stored_chunks = lambda chunk_ids: set()
+    kg_constructor.get_cached_extractions = lambda chunk_ids: {}
+    kg_constructor.finish_document = lambda *args, **kwargs: []
+
+    def import_chunks(doc, chunks, existing=None, links=()):
+        time.sleep(write_time * len(chunks))
+        return chunks
+
+    kg_constructor.import_chunks = import_chunks
+
+
+async def phased(doc, pages, args):
+    pages = list(pages)
+    chunks = list(kg_constructor.iter_chunks(pages, args.chunk_size))
+    scheduler = ExtractionScheduler(
+        fake_extract(args.latency), max_concurrency=args.concurrency
+    )
+    tasks = [await scheduler.submit(chunk) for chunk in chunks]
+    results = await asyncio.gather(*tasks)
+    kg_constructor.attach_atomic_facts(chunks, results)
+    await asyncio.to_thread(kg_constructor.import_chunks, doc, chunks)
+    return len(chunks)
+
+
+async def pipelined(doc, pages, args):
+    scheduler = ExtractionScheduler(
+        fake_extract(args.latency), max_concurrency=args.concurrency
+    )
+    pipeline = DocumentPipeline(
+        doc, pages, scheduler=scheduler, chunk_size=args.chunk_size
+    )
+    await pipeline.run()
+    for stats in pipeline.stages.values():
+        print(f"    {stats.report()}")
+    return pipeline.chunks
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--pages", type=int, default=200)
+    arg_parser.add_argument("--parse-time", type=float, default=0.02)
+    arg_parser.add_argument("--latency", type=float, default=0.5)
+    arg_parser.add_argument("--concurrency", type=int, default=16)
+    arg_parser.add_argument("--write-time", type=float, default=0.005)
+    arg_parser.add_argument("--chunk-size", type=int, default=2000)
+    args = arg_parser.parse_args()
+
+    fake_graph(args.write_time)
+    document = Document(name="benchmark", address="benchmark", pages=[])
+    pages = make_synthetic_pages(args.pages)
+    for name, run in (("phased", phased), ("pipelined", pipelined)):
+        start = time.perf_counter()
+        chunks = asyncio.run(run(document, slow_pages(pages, args.parse_time), args))
+        elapsed = time.perf_counter() - start
+        print(f"{name:>10}: {chunks} chunks in {elapsed:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
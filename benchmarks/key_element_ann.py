@@ -0,0 +1,177 @@
+"""
+Benchmark for the in-process key element ANN mirror against Neo4j.
+
+Builds the IVFIndex behind neo4j.EmbeddingMirror over synthetic clustered
+unit vectors and reports build time, recall@k against exact search and the
+latency of single queries for several n_probe settings. With --neo4j the
+same vectors are written as :BenchKeyElement nodes with a vector index and
+queried over Bolt for comparison; the nodes and the index are deleted
+afterwards.
+
+Run it against a scratch database, for instance a local container:
+    docker run -d -p 7687:7687 -e NEO4J_AUTH=neo4j/password neo4j:5
+    NEO4J_URI=bolt://localhost:7687 NEO4J_USERNAME=neo4j NEO4J_PASSWORD=password \\
+        python -m benchmarks.key_element_ann --sizes 10000 100000 --neo4j
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from typing import List, Set
+
+import numpy as np
+from dotenv import load_dotenv
+
+from src.adapters.vector_index import IVFIndex
+
+BENCH_INDEX = "bench_key_elements"
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_vectors(n: int, dim: int, clusters: int, seed: int = 0) -> np.ndarray:
+    """Unit vectors around random topics, closer to embeddings than noise."""
+    rng = np.random.default_rng(seed)
+    centers = normalize(rng.normal(size=(clusters, dim)).astype(np.float32))
+    topics = rng.integers(0, clusters, size=n)
+    noise = rng.normal(scale=0.5 / np.sqrt(dim), size=(n, dim)).astype(np.float32)
+    return normalize(centers[topics] + noise).astype(np.float32)
+
+
+def make_queries(vectors: np.ndarray, n: int, seed: int = 1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(vectors), n, replace=False)
+    noise = rng.normal(
+        scale=0.3 / np.sqrt(vectors.shape[1]), size=(n, vectors.shape[1])
+    )
+    return normalize(vectors[rows] + noise.astype(np.float32)).astype(np.float32)
+
+
+def exact_neighbours(vectors: np.ndarray, queries: np.ndarray, k: int, block=50):
+    truth: List[Set[int]] = []
+    for i in range(0, len(queries), block):
+        scores = queries[i : i + block] @ vectors.T
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        truth.extend(set(row.tolist()) for row in best)
+    return truth
+
+
+def percentiles(latencies):
+    p50, p95 = np.percentile(np.asarray(latencies) * 1000, [50, 95])
+    return f"p50 {p50:7.2f} ms, p95 {p95:7.2f} ms"
+
+
+def report(name: str, results, truth, latencies):
+    recall = np.mean(
+        [len(found & true) / len(true) for found, true in zip(results, truth)]
+    )
+    print(f"  {name:>16}: recall {recall:.3f}, {percentiles(latencies)}")
+
+
+def bench_mirror(vectors, queries, truth, k: int, probes):
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        index = IVFIndex(directory, vectors.shape[1])
+        for i in range(0, len(vectors), 10_000):
+            index.add(
+                [str(j) for j in range(i, min(i + 10_000, len(vectors)))],
+                vectors[i : i + 10_000],
+            )
+        print(f"  mirror build {time.perf_counter() - start:.1f} s")
+        for n_probe in probes if index.centroids is not None else [0]:
+            index.n_probe = n_probe
+            results, latencies = [], []
+            for query in queries:
+                start = time.perf_counter()
+                found = index.search(query, k)[0]
+                latencies.append(time.perf_counter() - start)
+                results.append({int(key) for key, _ in found})
+            name = f"n_probe {n_probe}" if n_probe else "exhaustive"
+            report(f"mirror {name}", results, truth, latencies)
+
+
+def bench_neo4j(vectors, queries, truth, k: int):
+    from src.adapters import neo4j
+
+    graph = neo4j.get_graph()
+    clean_up(graph)
+    start = time.perf_counter()
+    graph.query(
+        f"""CREATE VECTOR INDEX {BENCH_INDEX}
+    FOR (k:BenchKeyElement) ON k.embedding
+    OPTIONS {{indexConfig: {{
+        `vector.dimensions`: {vectors.shape[1]},
+        `vector.similarity_function`: 'cosine'
+    }}}}
+    """
+    )
+    neo4j.write_batches(
+        """UNWIND $rows AS row
+    CREATE (k:BenchKeyElement {id: row.id})
+    WITH k, row
+    CALL db.create.setNodeVectorProperty(k, 'embedding', row.embedding)
+    """,
+        [{"id": i, "embedding": vector.tolist()} for i, vector in enumerate(vectors)],
+        batch_size=500,
+    )
+    graph.query("CALL db.awaitIndexes(3600)")
+    print(f"  neo4j build {time.perf_counter() - start:.1f} s")
+
+    results, latencies = [], []
+    database = os.getenv("NEO4J_DATABASE", "neo4j")
+    with neo4j.get_driver().session(database=database) as session:
+        for query in queries:
+            start = time.perf_counter()
+            records = session.run(
+                f"""CALL db.index.vector.queryNodes('{BENCH_INDEX}', $k, $query)
+    YIELD node RETURN node.id AS id
+    """,
+                k=k,
+                query=query.tolist(),
+            )
+            results.append({record["id"] for record in records})
+            latencies.append(time.perf_counter() - start)
+    report("neo4j", results, truth, latencies)
+    clean_up(graph)
+
+
+def clean_up(graph):
+    graph.query(f"DROP INDEX {BENCH_INDEX} IF EXISTS")
+    graph.query(
+        """MATCH (k:BenchKeyElement)
+    CALL { WITH k DETACH DELETE k } IN TRANSACTIONS OF 10000 ROWS
+    """
+    )
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    arg_parser.add_argument("--dim", type=int, default=384)
+    arg_parser.add_argument("--clusters", type=int, default=1000)
+    arg_parser.add_argument("--queries", type=int, default=200)
+    arg_parser.add_argument("--probes", type=int, nargs="+", default=[8, 16, 32])
+    arg_parser.add_argument("-k", type=int, default=10)
+    arg_parser.add_argument(
+        "--neo4j", action="store_true", help="Compare with the Neo4j vector index"
+    )
+    args = arg_parser.parse_args()
+
+    load_dotenv()
+    for size in args.sizes:
+        print(f"{size} key elements, {args.dim} dimensions")
+        vectors = make_vectors(size, args.dim, args.clusters)
+        queries = make_queries(vectors, args.queries)
+        truth = exact_neighbours(vectors, queries, args.k)
+        bench_mirror(vectors, queries, truth, args.k, args.probes)
+        if args.neo4j:
+            bench_neo4j(vectors, queries, truth, args.k)
+
+
+if __name__ == "__main__":
+    main()
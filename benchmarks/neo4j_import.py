@@ -0,0 +1,154 @@
+"""
+Benchmark for the batched Neo4j import against the previous single query.
+
+Writes a synthetic document with the given numbers of atomic facts, first
+with the previous import, one query holding the whole document in a single
+transaction, then with kg_constructor.write_chunks, and reports rows per
+second. Nodes written by the benchmark have ids starting with "bench-" and
+are deleted before every run.
+
+Run it against a scratch database, for instance a local container:
+    docker run -d -p 7687:7687 -e NEO4J_AUTH=neo4j/password neo4j:5
+    NEO4J_URI=bolt://localhost:7687 NEO4J_USERNAME=neo4j NEO4J_PASSWORD=password \\
+        python -m benchmarks.neo4j_import --facts 10000 100000 1000000 --sessions 4
+"""
+
+import argparse
+import os
+import random
+import time
+from typing import List
+
+from dotenv import load_dotenv
+
+from src.adapters import neo4j
+from src.models import Document
+from src.reader_agent.kg_constructor import count_import_rows, write_chunks
+
+PREFIX = "bench-"
+
+
+def make_chunks(n_facts: int, facts_per_chunk: int, key_elements: int, vocabulary):
+    rng = random.Random(42)
+    chunks: List[dict] = []
+    for index in range(0, n_facts, facts_per_chunk):
+        facts = range(index, min(index + facts_per_chunk, n_facts))
+        chunks.append(
+            {
+                "id": f"{PREFIX}chunk-{index}",
+                "text": f"Synthetic chunk {index} " * 200,
+                "index": len(chunks),
+                "type": "TextGroup",
+                "page": 1 + len(chunks) // 4,
+                "block_positions": [0.0, 0.0, 1.0, 0.0, 1.0, 1.0, 0.0, 1.0],
+                "atomic_facts": [
+                    {
+                        "id": f"{PREFIX}fact-{i}",
+                        "atomic_fact": f"Synthetic atomic fact number {i}.",
+                        "key_elements": rng.sample(vocabulary, key_elements),
+                    }
+                    for i in facts
+                ],
+            }
+        )
+    return chunks
+
+
+def legacy_write_chunks(doc: Document, chunks):
+    """The import before batching: the whole document in one query."""
+    import_query = """
+    MERGE (d:Document {id:$document_name})
+    SET d.address = $document_address
+    WITH d
+    UNWIND $data AS row
+    MERGE (c:Chunk {id: row.id})
+    SET c.text = row.text,
+        c.index = row.index,
+        c.type = row.type,
+        c.block_positions = row.block_positions,
+        c.page = row.page
+    MERGE (d)-[r:HAS_CHUNK]->(c)
+    SET r.index = row.index
+    WITH c, row
+    UNWIND row.atomic_facts AS af
+    MERGE (a:AtomicFact {id: af.id})
+    SET a.text = af.atomic_fact
+    MERGE (c)-[:HAS_ATOMIC_FACT]->(a)
+    WITH c, a, af
+    UNWIND af.key_elements AS ke
+    MERGE (k:KeyElement {id: ke})
+    MERGE (a)-[:HAS_KEY_ELEMENT]->(k)
+    """
+    neo4j.get_graph().query(
+        import_query,
+        params={
+            "data": chunks,
+            "document_name": doc.name,
+            "document_address": doc.address,
+        },
+    )
+
+
+def clean_up():
+    for label in ("Document", "Chunk", "AtomicFact", "KeyElement"):
+        with neo4j.get_driver().session(
+            database=os.getenv("NEO4J_DATABASE", "neo4j")
+        ) as session:
+            session.run(
+                f"""MATCH (n:{label}) WHERE n.id STARTS WITH $prefix
+                CALL {{ WITH n DETACH DELETE n }} IN TRANSACTIONS OF 10000 ROWS""",
+                prefix=PREFIX,
+            ).consume()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument(
+        "--facts", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    arg_parser.add_argument("--facts-per-chunk", type=int, default=10)
+    arg_parser.add_argument("--key-elements", type=int, default=3)
+    arg_parser.add_argument("--vocabulary", type=int, default=50_000)
+    arg_parser.add_argument("--batch-size", type=int, default=5000)
+    arg_parser.add_argument("--sessions", type=int, default=1)
+    arg_parser.add_argument(
+        "--legacy-max-facts",
+        type=int,
+        default=100_000,
+        help="Skip the single-query import for larger documents",
+    )
+    args = arg_parser.parse_args()
+
+    load_dotenv()
+    os.environ["NEO4J_BATCH_SIZE"] = str(args.batch_size)
+    os.environ["NEO4J_WRITE_SESSIONS"] = str(args.sessions)
+    vocabulary = [f"{PREFIX}key-{i}" for i in range(args.vocabulary)]
+    doc = Document(name=f"{PREFIX}document", address="benchmark", pages=[])
+
+    for n_facts in args.facts:
+        chunks = make_chunks(
+            n_facts, args.facts_per_chunk, args.key_elements, vocabulary
+        )
+        rows = count_import_rows(chunks)
+        print(f"{n_facts} atomic facts, {len(chunks)} chunks, {rows} rows")
+        for name, write in (("single", legacy_write_chunks), ("batched", write_chunks)):
+            if name == "single" and n_facts > args.legacy_max_facts:
+                print(f"  {name:>8}: skipped")
+                continue
+            clean_up()
+            start = time.perf_counter()
+            try:
+                write(doc, chunks)
+            except Exception as e:
+                print(f"  {name:>8}: failed after {time.perf_counter() - start:.1f} s")
+                print(f"            {e!r}"[:200])
+                continue
+            elapsed = time.perf_counter() - start
+            print(f"  {name:>8}: {elapsed:7.1f} s  {rows / elapsed:9.0f} rows/s")
+    clean_up()
+
+
+if __name__ == "__main__":
+    main()
@@ -15,13 +15,15 @@ async def construct_knowledge_graph(doc_name, doc_type):
     if doc_type == "Wikipedia":
         doc = wikipedia.read_doc(doc_name)
     elif doc_type == "pdf":
-        doc = file_system.read_doc(doc_name)
+        # Stream pages so extraction starts before the whole PDF is parsed
+        doc, pages = file_system.stream_doc(doc_name)
+        return await kg_constructor.process_document(doc, pages, incremental=True)
 
     elif doc_type == "Klarna Wiki":
         doc = wiki.read_doc(doc_name)
     else:
         doc = wikibase.read_doc(doc_name)
-    await kg_constructor.process_document(doc)
+    return await kg_constructor.process_document(doc, incremental=True)
 
 
 def answer_question(question):
@@ -100,8 +102,14 @@ with doc_tab:
     if st.button("Add Document"):
         if doc_name:
             with st.spinner("Transferring data..."):
-                asyncio.run(construct_knowledge_graph(doc_name, doc_type))
-            st.success("Import successful!")
+                failed = asyncio.run(construct_knowledge_graph(doc_name, doc_type))
+            if failed:
+                st.warning(
+                    f"Imported with {len(failed)} chunks left out after failed "
+                    "extraction. Add the document again to retry them."
+                )
+            else:
+                st.success("Import successful!")
         else:
             st.error("Document name is required!")
 
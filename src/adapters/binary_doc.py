@@ -0,0 +1,243 @@
+"""
+Compact columnar on-disk format for parsed documents.
+
+Layout of a .grdoc file (all integers little-endian):
+
+    magic (8 bytes) | meta offset, meta length (2 x uint64)
+    block texts, UTF-8, back to back
+    numeric sections, each aligned to 8 bytes:
+        text_offsets        int64[n_blocks + 1]
+        id_offsets          int64[n_blocks + 1]
+        page_block_offsets  int64[n_pages + 1]
+        positions           float64[n_blocks, 8]
+        block_types         uint8[n_blocks]
+        block ids, UTF-8, back to back
+    meta JSON: name, address, page ids and numbers, block type names and the
+    offset, dtype and count of every section
+
+Texts are written as pages arrive, so a writer only keeps the small numeric
+columns in memory. Readers memory-map the file and build pages on demand.
+"""
+
+import json
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+from typing import Iterable, Iterator, List, get_args
+
+import numpy as np
+
+from src.models import Block, Document, Page
+
+MAGIC = b"GRDOC\x00\x01\x00"
+_HEADER = struct.Struct("<QQ")
+BLOCK_TYPES = list(get_args(Block.model_fields["type"].annotation))
+_BLOCK_TYPE_INDEX = {block_type: index for index, block_type in enumerate(BLOCK_TYPES)}
+
+
+class BinaryDocumentWriter:
+    """Write a document page by page; the file only appears once closed."""
+
+    def __init__(self, path: str, name: str, address: str):
+        self.path = path
+        self.name = name
+        self.address = address
+
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, self._tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        self._file = os.fdopen(fd, "wb")
+        self._file.write(MAGIC + _HEADER.pack(0, 0))
+
+        self._text_offsets = array("q", [0])
+        self._id_offsets = array("q", [0])
+        self._page_block_offsets = array("q", [0])
+        self._positions = array("d")
+        self._block_types = array("B")
+        self._ids = bytearray()
+        self._page_ids: List[str] = []
+        self._page_numbers: List[int] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add_page(self, page: Page):
+        for block in page.blocks:
+            text = block.text.encode("utf-8")
+            self._file.write(text)
+            self._text_offsets.append(self._text_offsets[-1] + len(text))
+
+            self._ids += block.id.encode("utf-8")
+            self._id_offsets.append(len(self._ids))
+
+            self._block_types.append(_BLOCK_TYPE_INDEX[block.type])
+            self._positions.extend(block.position.to_list())
+
+        self._page_block_offsets.append(len(self._block_types))
+        self._page_ids.append(page.id)
+        self._page_numbers.append(page.number)
+
+    def _write_section(self, data: bytes, dtype: str, count: int) -> dict:
+        self._file.write(b"\x00" * (-self._file.tell() % 8))
+        section = {"offset": self._file.tell(), "dtype": dtype, "count": count}
+        self._file.write(data)
+        return section
+
+    def close(self):
+        sections = {}
+        for key, values in (
+            ("text_offsets", self._text_offsets),
+            ("id_offsets", self._id_offsets),
+            ("page_block_offsets", self._page_block_offsets),
+        ):
+            data = np.asarray(values, dtype="<i8")
+            sections[key] = self._write_section(data.tobytes(), "<i8", len(data))
+        positions = np.asarray(self._positions, dtype="<f8")
+        sections["positions"] = self._write_section(
+            positions.tobytes(), "<f8", len(positions)
+        )
+        sections["block_types"] = self._write_section(
+            self._block_types.tobytes(), "u1", len(self._block_types)
+        )
+        sections["ids"] = self._write_section(bytes(self._ids), "u1", len(self._ids))
+
+        meta = json.dumps(
+            {
+                "name": self.name,
+                "address": self.address,
+                "page_ids": self._page_ids,
+                "page_numbers": self._page_numbers,
+                "block_types": BLOCK_TYPES,
+                "sections": sections,
+            }
+        ).encode("utf-8")
+        meta_offset = self._file.tell()
+        self._file.write(meta)
+        self._file.seek(len(MAGIC))
+        self._file.write(_HEADER.pack(meta_offset, len(meta)))
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        os.unlink(self._tmp_path)
+
+
+def write_document(doc: Document, path: str):
+    """Write a whole document in the binary format."""
+    with BinaryDocumentWriter(path, doc.name, doc.address) as writer:
+        for page in doc.pages:
+            writer.add_page(page)
+
+
+def write_pages(
+    path: str, name: str, address: str, pages: Iterable[Page]
+) -> Iterator[Page]:
+    """Pass pages through while writing them to path."""
+    with BinaryDocumentWriter(path, name, address) as writer:
+        for page in pages:
+            writer.add_page(page)
+            yield page
+
+
+class BinaryDocument:
+    """Memory-mapped reader for documents written by BinaryDocumentWriter."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[: len(MAGIC)] != MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a binary document")
+
+        meta_offset, meta_length = _HEADER.unpack_from(self._mmap, len(MAGIC))
+        meta = json.loads(self._mmap[meta_offset : meta_offset + meta_length])
+        self.name = meta["name"]
+        self.address = meta["address"]
+        self.page_ids: List[str] = meta["page_ids"]
+        self.page_numbers: List[int] = meta["page_numbers"]
+        self.block_type_names: List[str] = meta["block_types"]
+
+        sections = meta["sections"]
+        self._ids_offset = sections["ids"]["offset"]
+        self._text_offset = len(MAGIC) + _HEADER.size
+        self.text_offsets = self._array(sections["text_offsets"])
+        self.id_offsets = self._array(sections["id_offsets"])
+        self.page_block_offsets = self._array(sections["page_block_offsets"])
+        self.positions = self._array(sections["positions"]).reshape(-1, 4, 2)
+        self.block_types = self._array(sections["block_types"])
+
+    def _array(self, section: dict) -> np.ndarray:
+        return np.frombuffer(
+            self._mmap,
+            dtype=section["dtype"],
+            count=section["count"],
+            offset=section["offset"],
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.page_ids)
+
+    def close(self):
+        # Arrays hold exports of the mmap buffer and must go before it closes
+        self.text_offsets = self.id_offsets = self.page_block_offsets = None
+        self.positions = self.block_types = None
+        self._mmap.close()
+
+    def _strings(self, base: int, offsets: np.ndarray, start: int, end: int):
+        bounds = offsets[start : end + 1].tolist()
+        return [
+            str(self._mmap[base + begin : base + finish], "utf-8")
+            for begin, finish in zip(bounds, bounds[1:])
+        ]
+
+    def block_texts(self, index: int) -> List[str]:
+        """Texts of the blocks of a page, without building the page."""
+        start, end = self.page_block_offsets[index : index + 2].tolist()
+        return self._strings(self._text_offset, self.text_offsets, start, end)
+
+    def page(self, index: int) -> Page:
+        start, end = self.page_block_offsets[index : index + 2].tolist()
+        ids = self._strings(self._ids_offset, self.id_offsets, start, end)
+        texts = self._strings(self._text_offset, self.text_offsets, start, end)
+        types = self.block_types[start:end].tolist()
+        positions = self.positions[start:end].tolist()
+        return Page.model_validate(
+            {
+                "id": self.page_ids[index],
+                "number": self.page_numbers[index],
+                "blocks": [
+                    {
+                        "id": block_id,
+                        "type": self.block_type_names[block_type],
+                        "text": text,
+                        "position": dict(zip(("p1", "p2", "p3", "p4"), position)),
+                    }
+                    for block_id, text, block_type, position in zip(
+                        ids, texts, types, positions
+                    )
+                ],
+            }
+        )
+
+    def pages(self) -> Iterator[Page]:
+        for index in range(len(self)):
+            yield self.page(index)
+
+    def to_document(self) -> Document:
+        return Document(name=self.name, address=self.address, pages=list(self.pages()))
@@ -0,0 +1,387 @@
+import bisect
+import fcntl
+import json
+import math
+import os
+import re
+import shutil
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Documents kept in memory before they are written to a segment of their own
+FLUSH_SIZE = 10_000
+
+_TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.lower())
+
+
+def _load(path: str, dtype, size: Optional[int] = None) -> np.ndarray:
+    """Memory-map an array file, or the first size rows of it."""
+    rows = os.path.getsize(path) // np.dtype(dtype).itemsize
+    size = rows if size is None else size
+    if not size:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(size,))
+
+
+class _Terms:
+    """Sorted terms of a segment as a sequence of bytes, for bisect."""
+
+    def __init__(self, blob: np.ndarray, ends: np.ndarray):
+        self.blob = blob
+        self.ends = ends
+
+    def __len__(self) -> int:
+        return len(self.ends)
+
+    def __getitem__(self, i: int) -> bytes:
+        start = self.ends[i - 1] if i else 0
+        return self.blob[start : self.ends[i]].tobytes()
+
+
+class _Segment:
+    """
+    Immutable posting lists of the documents start to end.
+
+    terms.bin holds the sorted terms back to back, term_ends.i64 where each
+    ends, posting_ends.i64 where its postings end in docs.i32 and tfs.u16.
+    """
+
+    def __init__(self, directory: str, start: int, end: int):
+        self.directory = directory
+        self.start = start
+        self.end = end
+        self.terms = _Terms(
+            _load(self._path("terms.bin"), np.uint8),
+            _load(self._path("term_ends.i64"), np.int64),
+        )
+        self.posting_ends = _load(self._path("posting_ends.i64"), np.int64)
+        self.docs = _load(self._path("docs.i32"), np.int32)
+        self.tfs = _load(self._path("tfs.u16"), np.uint16)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def postings(self, term: bytes) -> Tuple[np.ndarray, np.ndarray]:
+        i = bisect.bisect_left(self.terms, term)
+        if i == len(self.terms) or self.terms[i] != term:
+            return self.docs[:0], self.tfs[:0]
+        start = self.posting_ends[i - 1] if i else 0
+        end = self.posting_ends[i]
+        return self.docs[start:end], self.tfs[start:end]
+
+    @staticmethod
+    def write(directory: str, postings: Dict[str, Tuple[List[int], List[int]]]):
+        os.makedirs(directory)
+        terms = sorted(term.encode("utf-8") for term in postings)
+        lists = [postings[term.decode("utf-8")] for term in terms]
+        np.cumsum([len(term) for term in terms], dtype=np.int64).tofile(
+            os.path.join(directory, "term_ends.i64")
+        )
+        with open(os.path.join(directory, "terms.bin"), "wb") as f:
+            f.write(b"".join(terms))
+        np.cumsum([len(docs) for docs, _ in lists], dtype=np.int64).tofile(
+            os.path.join(directory, "posting_ends.i64")
+        )
+        np.asarray([d for docs, _ in lists for d in docs], dtype=np.int32).tofile(
+            os.path.join(directory, "docs.i32")
+        )
+        np.asarray([t for _, tfs in lists for t in tfs], dtype=np.uint16).tofile(
+            os.path.join(directory, "tfs.u16")
+        )
+
+
+class BM25Index:
+    """
+    Persistent BM25 index over short texts such as key elements.
+
+    Documents are appended to keys.bin, with their end offsets in
+    key_ends.i64 and their token counts in lengths.u16, and get the row
+    they were appended at as id. Their posting lists are written to
+    immutable segments, each covering a range of rows; the rows added since
+    the last segment are indexed in memory until FLUSH_SIZE of them make up
+    a new segment. Like a binary counter, a segment is merged with the one
+    before it while that is not bigger, so there are only logarithmically
+    many and each document is rewritten a logarithmic number of times.
+    segments.json lists the current segments.
+
+    Everything is memory-mapped, so opening the index reads nothing but the
+    segment list and the in-memory rows, and a query only reads the posting
+    lists of its terms. Removed documents are listed in removed.i32 and
+    skipped; merges leave them out. Other processes see added documents on
+    their next search. Writers hold an exclusive lock on write.lock, so
+    several processes may add and remove documents.
+    """
+
+    def __init__(self, directory: str, k1: float = 1.5, b: float = 0.75):
+        self.directory = directory
+        self.k1 = k1
+        self.b = b
+        os.makedirs(directory, exist_ok=True)
+        for name in ("keys.bin", "key_ends.i64", "lengths.u16", "removed.i32"):
+            open(self._path(name), "ab").close()
+        self._lock = threading.Lock()
+        self._ids: Optional[Dict[str, int]] = None
+        self._manifest_version = None
+        self.segments: List[_Segment] = []
+        # Rows indexed, by a segment or in memory
+        self._size = 0
+        self._pending: Dict[str, Tuple[List[int], List[int]]] = {}
+        self.key_ends = self.lengths = self.keys = np.empty(0, dtype=np.int64)
+        self._total_length = 0
+        self._removed_size = -1
+        with self._write_lock():
+            self._truncate()
+            self._refresh()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def _write_lock(self):
+        """Keep other threads and processes from writing the files meanwhile."""
+        with self._lock, open(self._path("write.lock"), "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _truncate(self):
+        """Drop the rows an interrupted add left partly written."""
+        size = min(
+            os.path.getsize(self._path("key_ends.i64")) // 8,
+            os.path.getsize(self._path("lengths.u16")) // 2,
+        )
+        key_ends = _load(self._path("key_ends.i64"), np.int64, size)
+        for name, length in (
+            ("keys.bin", int(key_ends[-1]) if size else 0),
+            ("key_ends.i64", 8 * size),
+            ("lengths.u16", 2 * size),
+        ):
+            with open(self._path(name), "ab") as f:
+                f.truncate(length)
+
+    def _refresh(self):
+        """Pick up segments and rows written since the index was last read."""
+        manifest_path = self._path("segments.json")
+        # Rows in the key ids, which a new manifest does not change
+        known = self._size
+        for attempt in range(3):
+            try:
+                stat = os.stat(manifest_path)
+                manifest_version = (stat.st_ino, stat.st_mtime_ns)
+            except FileNotFoundError:
+                manifest_version = None
+            if manifest_version == self._manifest_version:
+                break
+            try:
+                manifest = []
+                if manifest_version:
+                    with open(manifest_path, encoding="utf-8") as f:
+                        manifest = json.load(f)
+                self.segments = [
+                    _Segment(self._path(s["name"]), s["start"], s["end"])
+                    for s in manifest
+                ]
+            except FileNotFoundError:
+                # Replaced by a merge while it was read
+                if attempt == 2:
+                    raise
+                continue
+            self._manifest_version = manifest_version
+            self._pending = {}
+            self._size = self.flushed
+
+        size = self._map_rows()
+        if size > self._size:
+            self._index_pending(range(max(self._size, self.flushed), size))
+            self._size = size
+        if self._ids is not None:
+            # Rows other processes added
+            for row in range(known, size):
+                self._ids[self.key(row)] = row
+        removed_size = os.path.getsize(self._path("removed.i32")) // 4
+        if removed_size != self._removed_size:
+            removed = _load(self._path("removed.i32"), np.int32)
+            if self._ids is not None:
+                for row in removed[max(self._removed_size, 0) :].tolist():
+                    if self._ids.get(self.key(row)) == row:
+                        del self._ids[self.key(row)]
+            self._removed_size = removed_size
+            self.removed = np.unique(removed)
+
+    def _map_rows(self) -> int:
+        """Map the rows in the files, returning how many there are."""
+        size = os.path.getsize(self._path("key_ends.i64")) // 8
+        if size != len(self.key_ends):
+            self.key_ends = _load(self._path("key_ends.i64"), np.int64, size)
+            self.lengths = _load(self._path("lengths.u16"), np.uint16, size)
+            self.keys = _load(self._path("keys.bin"), np.uint8)
+            self._total_length = int(self.lengths.sum(dtype=np.int64))
+        return size
+
+    @property
+    def flushed(self) -> int:
+        """Rows covered by segments; later rows are indexed in memory."""
+        return self.segments[-1].end if self.segments else 0
+
+    def __len__(self) -> int:
+        return self._size - len(self.removed)
+
+    def key(self, row: int) -> str:
+        start = self.key_ends[row - 1] if row else 0
+        return self.keys[start : self.key_ends[row]].tobytes().decode("utf-8")
+
+    def _key_ids(self) -> Dict[str, int]:
+        if self._ids is None:
+            removed = set(self.removed.tolist())
+            self._ids = {
+                self.key(row): row for row in range(self._size) if row not in removed
+            }
+        return self._ids
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            self._refresh()
+            return key in self._key_ids()
+
+    def _postings(self, rows: Iterable[int]) -> Dict[str, Tuple[List[int], List[int]]]:
+        postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        for row in rows:
+            for term, tf in Counter(tokenize(self.key(row))).items():
+                docs, tfs = postings.setdefault(term, ([], []))
+                docs.append(row)
+                tfs.append(min(tf, 65535))
+        return postings
+
+    def _index_pending(self, rows: Iterable[int]):
+        for term, (docs, tfs) in self._postings(rows).items():
+            pending_docs, pending_tfs = self._pending.setdefault(term, ([], []))
+            pending_docs += docs
+            pending_tfs += tfs
+
+    def add(self, keys: Iterable[str]):
+        """Append keys; keys already in the index are skipped."""
+        with self._write_lock():
+            self._refresh()
+            ids = self._key_ids()
+            new = [key for key in dict.fromkeys(keys) if key not in ids]
+            if not new:
+                return
+            encoded = [key.encode("utf-8") for key in new]
+            lengths = [min(len(tokenize(key)), 65535) for key in new]
+            offset = int(self.key_ends[-1]) if self._size else 0
+            key_ends = offset + np.cumsum([len(key) for key in encoded], dtype=np.int64)
+            # The key ends go last, as they decide how many rows there are
+            with open(self._path("keys.bin"), "ab") as f:
+                f.write(b"".join(encoded))
+            with open(self._path("lengths.u16"), "ab") as f:
+                f.write(np.asarray(lengths, dtype=np.uint16).tobytes())
+            with open(self._path("key_ends.i64"), "ab") as f:
+                f.write(key_ends.tobytes())
+            for row, key in enumerate(new, self._size):
+                ids[key] = row
+            end = self._map_rows()
+            if end - self.flushed >= FLUSH_SIZE:
+                # Indexed from the files by the flush instead of in memory
+                self._flush(end)
+            self._refresh()
+
+    def remove(self, keys: Iterable[str]):
+        """Remove keys from search results; they are dropped by the next merge."""
+        with self._write_lock():
+            self._refresh()
+            ids = self._key_ids()
+            rows = [ids.pop(key) for key in dict.fromkeys(keys) if key in ids]
+            if rows:
+                with open(self._path("removed.i32"), "ab") as f:
+                    f.write(np.asarray(rows, dtype=np.int32).tobytes())
+                self._refresh()
+
+    def _flush(self, end: int):
+        """Write the rows up to end after the last segment to a new one and merge."""
+        start = self.flushed
+        removed = set(self.removed.tolist())
+        spans = [(s.start, s.end) for s in self.segments] + [(start, end)]
+        while len(spans) > 1 and spans[-2][1] - spans[-2][0] <= end - spans[-1][0]:
+            spans[-2:] = [(spans[-2][0], spans[-1][1])]
+        # The merged segment replaces the segments it covers
+        start = spans[-1][0]
+        name = f"segment-{start}-{end}"
+        directory = self._path(name)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        _Segment.write(
+            directory,
+            self._postings(row for row in range(start, end) if row not in removed),
+        )
+        manifest = [
+            {"name": f"segment-{s}-{e}", "start": s, "end": e} for s, e in spans
+        ]
+        with open(self._path("segments.json.tmp"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(self._path("segments.json.tmp"), self._path("segments.json"))
+        names = {segment["name"] for segment in manifest}
+        for entry in os.listdir(self.directory):
+            if entry.startswith("segment-") and entry not in names:
+                shutil.rmtree(self._path(entry))
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        """The k keys scoring highest for query with their scores, best first."""
+        with self._lock:
+            self._refresh()
+            return self._search(query, k)
+
+    def _search(self, query: str, k: int) -> List[Tuple[str, float]]:
+        size = self._size
+        if not size:
+            return []
+        average_length = max(self._total_length / size, 1e-9)
+        docs: List[np.ndarray] = []
+        weights: List[np.ndarray] = []
+        for term in dict.fromkeys(tokenize(query)):
+            encoded = term.encode("utf-8")
+            postings = [segment.postings(encoded) for segment in self.segments]
+            pending_docs, pending_tfs = self._pending.get(term, ([], []))
+            postings.append((np.asarray(pending_docs), np.asarray(pending_tfs)))
+            df = sum(len(term_docs) for term_docs, _ in postings)
+            if not df:
+                continue
+            idf = math.log(1 + (size - df + 0.5) / (df + 0.5))
+            term_docs = np.concatenate([d for d, _ in postings]).astype(np.int64)
+            tfs = np.concatenate([t for _, t in postings]).astype(np.float32)
+            norms = 1 - self.b + self.b * self.lengths[term_docs] / average_length
+            docs.append(term_docs)
+            weights.append(idf * tfs * (self.k1 + 1) / (tfs + self.k1 * norms))
+        if not docs:
+            return []
+
+        doc_ids, doc_weights = np.concatenate(docs), np.concatenate(weights)
+        if len(doc_ids) > size // 16:
+            # Summing into a score per row beats sorting this many postings
+            scores = np.bincount(doc_ids, weights=doc_weights, minlength=size)
+            candidates = np.flatnonzero(scores)
+            scores = scores[candidates]
+        else:
+            candidates, inverse = np.unique(doc_ids, return_inverse=True)
+            scores = np.bincount(inverse, weights=doc_weights)
+        if len(self.removed):
+            live = ~np.isin(candidates, self.removed)
+            candidates, scores = candidates[live], scores[live]
+        top = min(k, len(candidates))
+        if not top:
+            return []
+        best = np.argpartition(-scores, top - 1)[:top]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [(self.key(int(candidates[i])), float(scores[i])) for i in best]
@@ -0,0 +1,118 @@
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from src.adapters.file_system import DATA_DIR
+from src.models import Extraction
+
+
+class ExtractionCache:
+    """
+    Persistent cache of extraction results in SQLite.
+
+    Results are keyed by the chunk id (md5 of the chunk text), a hash of the
+    extraction prompt and the model name, so changing either makes old
+    entries unreachable. Entries are evicted least-recently-used first once
+    their total size exceeds max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS extractions (
+                    chunk_id TEXT NOT NULL,
+                    prompt_hash TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    extraction TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    accessed REAL NOT NULL,
+                    PRIMARY KEY (chunk_id, prompt_hash, model)
+                )"""
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS extractions_accessed "
+                "ON extractions (accessed)"
+            )
+            (self._size,) = self._db.execute(
+                "SELECT coalesce(sum(size), 0) FROM extractions"
+            ).fetchone()
+
+    def get_many(
+        self, chunk_ids: List[str], prompt_hash: str, model: str
+    ) -> Dict[str, Extraction]:
+        if not chunk_ids:
+            return {}
+        chunk_ids = list(set(chunk_ids))
+        placeholders = ",".join("?" * len(chunk_ids))
+        with self._lock, self._db:
+            rows = self._db.execute(
+                f"""SELECT chunk_id, extraction FROM extractions
+                WHERE prompt_hash = ? AND model = ? AND chunk_id IN ({placeholders})
+                """,
+                [prompt_hash, model, *chunk_ids],
+            ).fetchall()
+            # Record the access, which eviction orders by
+            self._db.executemany(
+                """UPDATE extractions SET accessed = ?
+                WHERE chunk_id = ? AND prompt_hash = ? AND model = ?""",
+                [(time.time(), row[0], prompt_hash, model) for row in rows],
+            )
+        return {
+            chunk_id: Extraction.model_validate_json(extraction)
+            for chunk_id, extraction in rows
+        }
+
+    def get(self, chunk_id: str, prompt_hash: str, model: str) -> Optional[Extraction]:
+        return self.get_many([chunk_id], prompt_hash, model).get(chunk_id)
+
+    def put(self, chunk_id: str, prompt_hash: str, model: str, extraction: Extraction):
+        data = extraction.model_dump_json()
+        with self._lock, self._db:
+            previous = self._db.execute(
+                """SELECT size FROM extractions
+                WHERE chunk_id = ? AND prompt_hash = ? AND model = ?""",
+                (chunk_id, prompt_hash, model),
+            ).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO extractions VALUES (?, ?, ?, ?, ?, ?)",
+                (chunk_id, prompt_hash, model, data, len(data), time.time()),
+            )
+            self._size += len(data) - (previous[0] if previous else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes:
+            rows = self._db.execute(
+                "SELECT rowid, size FROM extractions ORDER BY accessed LIMIT 256"
+            ).fetchall()
+            if not rows:
+                self._size = 0
+                break
+            victims = []
+            for rowid, size in rows:
+                if self._size <= self.max_bytes:
+                    break
+                victims.append((rowid,))
+                self._size -= size
+            self._db.executemany("DELETE FROM extractions WHERE rowid = ?", victims)
+
+
+@lru_cache(maxsize=1)
+def extraction_cache() -> ExtractionCache:
+    return ExtractionCache(
+        path=os.getenv(
+            "EXTRACTION_CACHE_PATH", os.path.join(DATA_DIR, "extraction_cache.sqlite")
+        ),
+        max_bytes=int(os.getenv("EXTRACTION_CACHE_MAX_BYTES", 1024**3)),
+    )
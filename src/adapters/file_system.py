@@ -1,12 +1,219 @@
+import hashlib
+import json
 import os
+from functools import lru_cache
+from importlib import metadata
+from typing import Iterable, Iterator, Optional, Tuple
 
-from src.models import Document
-from src.parser import pdf_parser
+from src.adapters.binary_doc import BinaryDocument, write_document, write_pages
+from src.models import Document, Page
+from src.parser import marker_config, pdf_parser
 
+DATA_DIR = "data"
+# Part of every parse cache key; bump it when the .grdoc format or what the
+# parser makes of a document changes, e.g. in utils.html_to_md
+PARSE_CACHE_VERSION = 2
 
-def read_doc(doc_path: str) -> Document:
+
+def _package_version(name: str) -> Optional[str]:
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+class ParseCache:
+    """
+    Content-addressed cache of parsed documents.
+
+    Entries are keyed by the SHA-256 of the file bytes plus the parser
+    configuration and version, and how the document was split for parsing,
+    and evicted least-recently-used first once
+    the cache directory grows beyond max_bytes. Entries that cannot be read
+    are deleted and count as misses.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def key(
+        self, doc_path: str, doc_type: str = "pdf", window: Optional[int] = None
+    ) -> str:
+        """
+        Cache key of a document parsed in windows of window pages at a time.
+
+        Marker detects headers, footers and sections per conversion, so a
+        document parsed in windows differs from one parsed whole (no window).
+        """
+        # API keys don't change the parse result, so keep them out of the key
+        config = {k: v for k, v in marker_config().items() if "api_key" not in k}
+        config["doc_type"] = doc_type
+        config["window"] = window
+        config["cache_version"] = PARSE_CACHE_VERSION
+        config["marker_version"] = _package_version("marker-pdf")
+
+        digest = hashlib.sha256()
+        with open(doc_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        digest.update(json.dumps(config, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.grdoc")
+
+    def open(self, key: str) -> Optional[BinaryDocument]:
+        path = self._path(key)
+        try:
+            reader = BinaryDocument(path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self._discard(path, e)
+            return None
+        # Bump the modification time, which eviction uses as last access time
+        os.utime(path)
+        return reader
+
+    def get(self, key: str) -> Optional[Document]:
+        reader = self.open(key)
+        if reader is None:
+            return None
+        try:
+            with reader:
+                return reader.to_document()
+        except Exception as e:
+            self._discard(self._path(key), e)
+            return None
+
+    def _discard(self, path: str, error: Exception):
+        print(f"Discarding unreadable parse cache entry {path}: {error!r}")
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def put(self, key: str, doc: Document):
+        write_document(doc, self._path(key))
+        self._evict(keep=key)
+
+    def put_pages(
+        self, key: str, doc_name: str, doc_path: str, pages: Iterable[Page]
+    ) -> Iterator[Page]:
+        """
+        Pass pages through while writing them to the cache entry for key.
+
+        The entry is only published once every page has been consumed, so an
+        abandoned stream never leaves a truncated document behind.
+        """
+        yield from write_pages(self._path(key), doc_name, doc_path, pages)
+        self._evict(keep=key)
+
+    def _evict(self, keep: str):
+        """Evict entries other than keep, the one just written, down to max_bytes."""
+        kept = self._path(keep)
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            # Skip files that are still being written
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            if path == kept:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+@lru_cache(maxsize=1)
+def parse_cache() -> ParseCache:
+    return ParseCache(
+        cache_dir=os.getenv("PARSE_CACHE_DIR", os.path.join(DATA_DIR, "parse_cache")),
+        max_bytes=int(os.getenv("PARSE_CACHE_MAX_BYTES", 2 * 1024**3)),
+    )
+
+
+def _stored_doc_path(doc_name: str) -> str:
+    return os.path.join(DATA_DIR, f"{doc_name}.grdoc")
+
+
+def open_doc(doc_name: str) -> BinaryDocument:
+    """
+    Open a stored document for lazy, memory-mapped reads.
+
+    Documents stored as JSON by earlier versions are converted on first access.
+    """
+    path = _stored_doc_path(doc_name)
+    json_path = os.path.join(DATA_DIR, f"{doc_name}.json")
+    if not os.path.exists(path) and os.path.exists(json_path):
+        with open(json_path, "rb") as f:
+            write_document(Document.model_validate_json(f.read()), path)
+    return BinaryDocument(path)
+
+
+def read_doc(doc_path: str, parser=None) -> Document:
+    """
+    Parse a PDF, going through the parse cache.
+
+    parser defaults to the shared in-process Marker parser; anything with the
+    same parse_document method, such as a ParserPool, can be passed instead.
+    """
     doc_name = os.path.splitext(os.path.basename(doc_path))[0]
-    doc = pdf_parser().parse_document(doc_name, doc_path)
-    with open(f"data/{doc_name}.json", "w") as f:
-        f.write(doc.model_dump_json())
+    cache = parse_cache()
+    # A ParserPool parses page ranges in separate conversions
+    key = cache.key(doc_path, window=getattr(parser, "pages_per_task", None))
+
+    doc = cache.get(key)
+    if doc is not None:
+        print(f"Parse cache hit for {doc_path}")
+        doc = doc.model_copy(update={"name": doc_name, "address": doc_path})
+    else:
+        doc = (parser or pdf_parser()).parse_document(doc_name, doc_path)
+        cache.put(key, doc)
+
+    write_document(doc, _stored_doc_path(doc_name))
     return doc
+
+
+def _read_pages(reader: BinaryDocument) -> Iterator[Page]:
+    with reader:
+        yield from reader.pages()
+
+
+def stream_doc(
+    doc_path: str, pages_per_window: int = 10
+) -> Tuple[Document, Iterator[Page]]:
+    """
+    Read a document page by page.
+
+    Returns the document without pages together with an iterator over its
+    pages, which are parsed lazily, pages_per_window at a time, and written
+    to the parse cache on the way. Once every page has been consumed the
+    document is stored like read_doc stores it.
+    """
+    doc_name = os.path.splitext(os.path.basename(doc_path))[0]
+    doc = Document(name=doc_name, address=doc_path, pages=[])
+    cache = parse_cache()
+    key = cache.key(doc_path, window=pages_per_window)
+
+    reader = cache.open(key)
+    pages: Iterator[Page]
+    if reader is not None:
+        print(f"Parse cache hit for {doc_path}")
+        pages = _read_pages(reader)
+    else:
+        pages = cache.put_pages(
+            key,
+            doc_name,
+            doc_path,
+            pdf_parser().iter_pages(doc_path, pages_per_window),
+        )
+    return doc, write_pages(_stored_doc_path(doc_name), doc_name, doc_path, pages)
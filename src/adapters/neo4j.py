@@ -1,10 +1,36 @@
+import fcntl
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
+from typing import Callable, Generic, List, Optional, Tuple, TypeVar
 
+import numpy as np
 from langchain_community.graphs import Neo4jGraph
 from langchain_community.vectorstores import Neo4jVector
+from neo4j import GraphDatabase
 
+from src.adapters.bm25_index import BM25Index
+from src.adapters.vector_index import IVFIndex
 from src.reader_agent import chains
 
+# The smoothed idf of a key element over the chunks, log((1 + n) / (1 + df)) + 1
+# as in scikit-learn, from the document frequency the import keeps on it
+IDF_RETRIEVAL_QUERY = """CALL { MATCH (c:Chunk) RETURN count(c) AS chunks }
+RETURN node.id AS text, score,
+    {idf: log((1.0 + chunks) / (1.0 + coalesce(node.df, 0))) + 1} AS metadata
+"""
+# Prefix of a write query that moves the graph to a new version, see
+# stamp_key_elements; the new version is available as version
+BUMP_GRAPH_VERSION = """MERGE (v:GraphVersion {id: 'graph'})
+    SET v.version = coalesce(v.version, 0) + 1
+    WITH v.version AS version
+"""
+
+T = TypeVar("T")
+
 
 @lru_cache
 def get_graph():
@@ -20,31 +46,489 @@ def get_graph():
     graph.query(
         "CREATE CONSTRAINT IF NOT EXISTS FOR (d:Document) REQUIRE d.id IS UNIQUE"
     )
+    graph.query(
+        "CREATE CONSTRAINT IF NOT EXISTS FOR (v:GraphVersion) REQUIRE v.id IS UNIQUE"
+    )
+    graph.query("CREATE INDEX IF NOT EXISTS FOR (k:KeyElement) ON (k.version)")
+    create_vector_index(graph, chains.get_embedding_provider())
     return graph
 
 
+def create_vector_index(graph: Neo4jGraph, provider: chains.EmbeddingProvider):
+    """Vector index over the key element embeddings of provider."""
+    # Key element embeddings are written by embedding_backfill
+    graph.query(
+        f"""CREATE VECTOR INDEX {provider.index_name} IF NOT EXISTS
+    FOR (k:KeyElement) ON k.{provider.embedding_property}
+    OPTIONS {{indexConfig: {{
+        `vector.dimensions`: {provider.dimensions},
+        `vector.similarity_function`: 'cosine'
+    }}}}
+    """
+    )
+    graph.query(
+        "CREATE INDEX IF NOT EXISTS "
+        f"FOR (k:KeyElement) ON (k.{provider.version_property})"
+    )
+
+
+@lru_cache
+def get_driver():
+    """Driver for explicit transactions, configured like get_graph."""
+    return GraphDatabase.driver(
+        os.environ["NEO4J_URI"],
+        auth=(os.environ["NEO4J_USERNAME"], os.environ["NEO4J_PASSWORD"]),
+    )
+
+
+def write_batches(
+    query: str,
+    rows: List[dict],
+    params: Optional[dict] = None,
+    batch_size: Optional[int] = None,
+    sessions: Optional[int] = None,
+):
+    """
+    Run a write query over rows in batches, one write transaction per batch.
+
+    The query gets a batch as $rows next to params. Batches are spread over
+    up to NEO4J_WRITE_SESSIONS parallel sessions, so they must not depend on
+    each other; transactions that fail with a transient error, such as a
+    deadlock between two batches, are retried by the driver.
+    """
+    if not rows:
+        return
+    batch_size = batch_size or int(os.getenv("NEO4J_BATCH_SIZE", 5000))
+    sessions = sessions or int(os.getenv("NEO4J_WRITE_SESSIONS", 1))
+    # Creates the constraints MERGE relies on
+    get_graph()
+    database = os.getenv("NEO4J_DATABASE", "neo4j")
+
+    def write(batch):
+        with get_driver().session(database=database) as session:
+            session.execute_write(
+                lambda tx: tx.run(query, {**(params or {}), "rows": batch}).consume()
+            )
+
+    batches = [rows[i : i + batch_size] for i in range(0, len(rows), batch_size)]
+    if sessions == 1 or len(batches) == 1:
+        for batch in batches:
+            write(batch)
+        return
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        # list() re-raises the first failed batch
+        list(executor.map(write, batches))
+
+
 @lru_cache
 def get_vector():
-    neo4j_vector = Neo4jVector.from_existing_graph(
-        embedding=chains.get_openai_embeddings(),
-        index_name="keyelements",
-        node_label="KeyElement",
-        text_node_properties=["id"],
-        embedding_node_property="embedding",
-        retrieval_query="RETURN node.id AS text, score, {tfidf: Null} AS metadata",
+    """
+    Vector store over the key element embeddings.
+
+    Only the question is embedded here, by the provider EMBEDDING_PROVIDER
+    selects; key elements are embedded when they are imported, see
+    src.embedding_backfill.
+    """
+    # Creates the vector index if the graph has none yet
+    get_graph()
+    neo4j_vector = Neo4jVector.from_existing_index(
+        embedding=chains.get_embeddings(),
+        index_name=chains.get_embedding_provider().index_name,
+        retrieval_query=IDF_RETRIEVAL_QUERY,
     )
     return neo4j_vector
 
 
-@lru_cache
-def get_all_key_elements():
-    """Fetch all existing key elements from the Neo4j database."""
-    query = "MATCH (k:KeyElement) RETURN k.id AS id"
-    result = get_graph().query(query)
+def get_unembedded_key_elements(
+    limit: int, skip: List[str], provider: Optional[str] = None
+) -> List[str]:
+    """Ids of up to limit key elements without an embedding, except skip."""
+    embedding = f"k.{chains.get_embedding_provider(provider).embedding_property}"
+    result = get_graph().query(
+        f"""MATCH (k:KeyElement)
+    WHERE {embedding} IS NULL AND NOT k.id IN $skip
+    RETURN k.id AS id LIMIT $limit
+    """,
+        params={"limit": limit, "skip": skip},
+    )
     return [record["id"] for record in result]
 
 
+def write_key_element_embeddings(rows: List[dict], provider: Optional[str] = None):
+    """
+    Store {"id", "embedding"} rows on their key elements.
+
+    The embeddings get no graph version here; stamp_key_element_embeddings
+    stamps them once the backfill run that wrote them is done, so
+    EmbeddingMirror can fetch the ones written since it synced.
+    """
+    embedding_provider = chains.get_embedding_provider(provider)
+    write_batches(
+        """UNWIND $rows AS row
+    MATCH (k:KeyElement {id: row.id})
+    CALL db.create.setNodeVectorProperty(k, $property, row.embedding)
+    """,
+        rows,
+        {"property": embedding_provider.embedding_property},
+        # A row carries a whole embedding
+        batch_size=500,
+    )
+
+
+def drop_key_element_embeddings(provider: str, batch_size: int = 10_000) -> int:
+    """
+    Drop the vector index of provider and delete its embeddings in batches.
+
+    Returns the number of key elements whose embedding was deleted.
+    """
+    embedding_provider = chains.get_embedding_provider(provider)
+    embedding = f"k.{embedding_provider.embedding_property}"
+    version = f"k.{embedding_provider.version_property}"
+    graph = get_graph()
+    graph.query(f"DROP INDEX {embedding_provider.index_name} IF EXISTS")
+    dropped = 0
+    while True:
+        result = graph.query(
+            f"""MATCH (k:KeyElement) WHERE {embedding} IS NOT NULL
+    WITH k LIMIT $limit
+    REMOVE {embedding}, {version}
+    RETURN count(k) AS dropped
+    """,
+            params={"limit": batch_size},
+        )
+        if not result[0]["dropped"]:
+            return dropped
+        dropped += result[0]["dropped"]
+
+
+def get_graph_version() -> Tuple[int, int]:
+    """
+    The version of the graph and the last version that removed key elements.
+
+    Imports and embedding backfill runs move the graph to a new version
+    once, in the transaction that stamps what they wrote with it, see
+    stamp_key_elements. The version node is locked until it commits, so
+    versions commit in order: once a reader sees version n, every key
+    element of a version up to n is visible.
+    """
+    result = get_graph().query(
+        """OPTIONAL MATCH (v:GraphVersion {id: 'graph'})
+    RETURN coalesce(v.version, 0) AS version,
+        coalesce(v.removed_version, 0) AS removed_version
+    """
+    )
+    return result[0]["version"], result[0]["removed_version"]
+
+
+def stamp_key_elements(key_elements: List[str]):
+    """
+    Move the graph to a new version and stamp the new key_elements with it.
+
+    Imports call this once, after writing their key elements, so parallel
+    write sessions do not wait on the version node and readers see one new
+    version per import. Key elements of an import that failed before this
+    are stamped when the document is imported again.
+    """
+    if not key_elements:
+        return
+    get_graph().query(
+        BUMP_GRAPH_VERSION
+        + """UNWIND $key_elements AS id
+    MATCH (k:KeyElement {id: id})
+    WHERE k.version IS NULL
+    SET k.version = version
+    """,
+        params={"key_elements": key_elements},
+    )
+
+
+def stamp_key_element_embeddings(provider: Optional[str] = None):
+    """
+    Move the graph to a new version and stamp the new embeddings with it.
+
+    Like stamp_key_elements, for the embeddings of provider that have no
+    version yet: an embedding backfill run calls this once when it is done,
+    which also stamps what a failed run wrote.
+    """
+    embedding_provider = chains.get_embedding_provider(provider)
+    get_graph().query(
+        BUMP_GRAPH_VERSION
+        + f"""MATCH (k:KeyElement)
+    WHERE k.{embedding_provider.embedding_property} IS NOT NULL
+        AND k.{embedding_provider.version_property} IS NULL
+    SET k.{embedding_provider.version_property} = version
+    """
+    )
+
+
+def mark_removal():
+    """Move the graph to a new version that removed key elements."""
+    get_graph().query(
+        """MERGE (v:GraphVersion {id: 'graph'})
+    SET v.version = coalesce(v.version, 0) + 1
+    SET v.removed_version = v.version
+    """
+    )
+
+
+class VersionedCache(Generic[T]):
+    """
+    Graph data cached in the process and refreshed as the graph changes.
+
+    Calling the cache returns the data, checking the graph version at most
+    every max_age seconds. If it moved, delta(data, version) brings the data
+    up to date with what was added after version, the version it was read
+    at; data is loaded in full again by load() after key elements were
+    removed, or on every change if there is no delta.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[], T],
+        delta: Optional[Callable[[T, int], T]] = None,
+        max_age: float = 5.0,
+    ):
+        self.load = load
+        self.delta = delta
+        self.max_age = max_age
+        self._data: Optional[T] = None
+        self._version = 0
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self) -> T:
+        with self._lock:
+            now = time.monotonic()
+            if self._data is not None and now - self._checked < self.max_age:
+                return self._data
+            # Read before the data, so anything added meanwhile comes again
+            version, removed_version = get_graph_version()
+            self._checked = now
+            if self._data is None or removed_version > self._version:
+                self._data = self.load()
+            elif version > self._version:
+                self._data = (
+                    self.delta(self._data, self._version) if self.delta else self.load()
+                )
+            self._version = version
+            return self._data
+
+    def cache_clear(self):
+        with self._lock:
+            self._data = None
+
+
+def _load_key_elements() -> List[str]:
+    result = get_graph().query("MATCH (k:KeyElement) RETURN k.id AS id")
+    return [record["id"] for record in result]
+
+
+def _add_key_elements(key_elements: List[str], version: int) -> List[str]:
+    result = get_graph().query(
+        "MATCH (k:KeyElement) WHERE k.version > $version RETURN k.id AS id",
+        params={"version": version},
+    )
+    return list(dict.fromkeys(key_elements + [record["id"] for record in result]))
+
+
+# All key elements in the graph; KEY_ELEMENTS_CACHE_MAX_AGE sets how stale
+# they may get, in seconds
+get_all_key_elements = VersionedCache(
+    _load_key_elements,
+    _add_key_elements,
+    max_age=float(os.getenv("KEY_ELEMENTS_CACHE_MAX_AGE", 5.0)),
+)
+
+
+@lru_cache(maxsize=1)
+def get_keyword_index() -> BM25Index:
+    """
+    BM25 index over the key elements, filled from the graph on first use.
+
+    Imports add new key elements to it, see kg_constructor.write_chunks.
+    """
+    # Imported here so that answering questions does not load the parsers
+    from src.adapters.file_system import DATA_DIR
+
+    index = BM25Index(
+        os.getenv("KEY_ELEMENT_BM25_DIR", os.path.join(DATA_DIR, "key_element_bm25"))
+    )
+    if not len(index):
+        index.add(get_all_key_elements())
+    return index
+
+
+def retrieve_key_elements_by_keywords(question, count):
+    return get_keyword_index().search(question, count)
+
+
+class EmbeddingMirror:
+    """
+    In-process copy of the key element embeddings of a provider.
+
+    The embeddings are kept in a persistent IVFIndex, searched exhaustively
+    while it is small, so a similarity search does not go to the Neo4j
+    vector index. A background thread started by start() brings the copy up
+    to date every interval seconds: embeddings stamped with a graph version
+    after the one it was synced to are added, see
+    stamp_key_element_embeddings, and after key elements were removed, the
+    ones no longer in the graph are removed from it. The first sync copies
+    every embedding, page_size at a time; until it is done, and while a
+    sync changes the index, search returns None so that questions go to
+    Neo4j instead of waiting.
+
+    The index files are rewritten in place, so a process needs a directory
+    of its own: the mirror takes the first of directory/0, directory/1, ...
+    that no other process holds the lock of, and keeps it for its lifetime.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        provider: Optional[str] = None,
+        interval: float = 5.0,
+        page_size: int = 10_000,
+    ):
+        self.provider = chains.get_embedding_provider(provider)
+        self.directory = self._claim(directory)
+        self.index = IVFIndex(self.directory, self.provider.dimensions)
+        self.interval = interval
+        self.page_size = page_size
+        self._version_path = os.path.join(self.directory, "version.json")
+        # The graph version the copy is up to date with, -1 before the first sync
+        self.version = -1
+        if os.path.exists(self._version_path):
+            with open(self._version_path, encoding="utf-8") as f:
+                self.version = json.load(f)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def _claim(self, directory: str) -> str:
+        """Lock the first directory/<n> no other process uses and return it."""
+        os.makedirs(directory, exist_ok=True)
+        n = 0
+        while True:
+            lock = open(os.path.join(directory, f"{n}.lock"), "ab")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                n += 1
+                continue
+            # Held until the process exits
+            self._directory_lock = lock
+            return os.path.join(directory, str(n))
+
+    def _embeddings(self, after: str) -> List[dict]:
+        embedding = f"k.{self.provider.embedding_property}"
+        if self.version < 0:
+            match = f"MATCH (k:KeyElement) WHERE {embedding} IS NOT NULL"
+        else:
+            # Paging by id would otherwise scan the key elements in id order;
+            # create_vector_index makes the index
+            match = f"""MATCH (k:KeyElement)
+    USING INDEX k:KeyElement({self.provider.version_property})
+    WHERE k.{self.provider.version_property} > $version"""
+        return get_graph().query(
+            f"""{match} AND k.id > $after
+    RETURN k.id AS id, {embedding} AS embedding ORDER BY k.id LIMIT $limit
+    """,
+            params={"version": self.version, "after": after, "limit": self.page_size},
+        )
+
+    def sync(self):
+        # Read before the embeddings, so anything written meanwhile comes again
+        version, removed_version = get_graph_version()
+        if removed_version > self.version and self.index.ids:
+            key_elements = set(get_all_key_elements())
+            with self._lock:
+                self.index.remove(
+                    [key for key in self.index.ids if key not in key_elements]
+                )
+        if version > self.version:
+            after = ""
+            while rows := self._embeddings(after):
+                vectors = np.asarray([row["embedding"] for row in rows], np.float32)
+                vectors /= np.maximum(
+                    np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12
+                )
+                with self._lock:
+                    self.index.add([row["id"] for row in rows], vectors)
+                after = rows[-1]["id"]
+        self.version = version
+        with open(self._version_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(version, f)
+        os.replace(self._version_path + ".tmp", self._version_path)
+
+    def _sync_forever(self):
+        while True:
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"Syncing the key element embeddings failed: {e!r}")
+            time.sleep(self.interval)
+
+    def start(self) -> "EmbeddingMirror":
+        """Keep the copy up to date in a daemon thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._sync_forever, name="embedding-mirror", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def search(self, question: str, count: int) -> Optional[List[Tuple[str, float]]]:
+        """
+        The count key elements most similar to the question, best first.
+
+        Scores are mapped onto [0, 1] like those of the Neo4j vector index.
+        None if the copy is not synced yet or a sync is changing it.
+        """
+        if self.version < 0:
+            return None
+        query = np.asarray(
+            chains.get_embeddings(self.provider.name).embed_query(question), np.float32
+        )
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            results = self.index.search(query, count)[0]
+        finally:
+            self._lock.release()
+        return [(key, (1 + score) / 2) for key, score in results]
+
+
+@lru_cache(maxsize=1)
+def get_embedding_mirror() -> Optional[EmbeddingMirror]:
+    """
+    Mirror of the embeddings of the current provider if KEY_ELEMENT_ANN is set.
+
+    It is kept under KEY_ELEMENT_ANN_DIR and syncs in the background as
+    often as the key element cache refreshes, see KEY_ELEMENTS_CACHE_MAX_AGE.
+    """
+    if not os.getenv("KEY_ELEMENT_ANN"):
+        return None
+    # Imported here so that answering questions does not load the parsers
+    from src.adapters.file_system import DATA_DIR
+
+    provider = chains.get_embedding_provider()
+    directory = os.getenv(
+        "KEY_ELEMENT_ANN_DIR", os.path.join(DATA_DIR, "key_element_ann")
+    )
+    mirror = EmbeddingMirror(
+        os.path.join(directory, provider.name),
+        provider.name,
+        interval=float(os.getenv("KEY_ELEMENTS_CACHE_MAX_AGE", 5.0)),
+    )
+    return mirror.start()
+
+
 def retrieve_key_elements_by_similarity(question, count):
+    mirror = get_embedding_mirror()
+    results = mirror.search(question, count) if mirror is not None else None
+    if results is not None:
+        return results
     data = get_vector().similarity_search_with_relevance_scores(question, k=count)
 
     return [(record[0].page_content, record[1]) for record in data]
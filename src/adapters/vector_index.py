@@ -0,0 +1,236 @@
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Vectors needed before the index is clustered; smaller indexes are scanned
+TRAIN_SIZE = 10_000
+# Rows added since the last regrouping that are scanned on every search,
+# relative to the size of the index
+PENDING_RATIO = 1 / 16
+
+
+class IVFIndex:
+    """
+    Persistent approximate nearest-neighbour index over unit vectors.
+
+    Vectors are clustered around k-means centroids (an inverted file index)
+    and a query only scans the vectors of its n_probe nearest clusters, so a
+    search touches a few thousand vectors even when the index holds
+    millions. Scores are dot products, i.e. cosine similarities of the
+    normalized vectors that go in.
+
+    The index lives in a directory of append-only files: keys.jsonl,
+    vectors.f32, lists.i32 (the cluster of every vector) and removed.i32
+    (the rows of removed keys, skipped by searches), plus centroids.npy.
+    Vectors are memory-mapped, so they do not need to fit in memory, and
+    adding or removing vectors only appends to the files. Until TRAIN_SIZE
+    vectors are added the index is searched exhaustively; it is clustered
+    then and again whenever it has grown fourfold.
+    """
+
+    def __init__(self, directory: str, dim: int, n_probe: int = 8):
+        self.directory = directory
+        self.dim = dim
+        self.n_probe = n_probe
+        os.makedirs(directory, exist_ok=True)
+
+        self.keys: List[str] = []
+        with open(self._path("keys.jsonl"), "a+", encoding="utf-8") as f:
+            f.seek(0)
+            self.keys = [json.loads(line) for line in f if line.endswith("\n")]
+        # An interrupted add can leave the files with different lengths
+        size = min(
+            len(self.keys),
+            self._file_rows("vectors.f32", 4 * dim),
+            self._file_rows("lists.i32", 4),
+        )
+        self._truncate(size)
+        self.ids: Dict[str, int] = {key: i for i, key in enumerate(self.keys)}
+        removed_path = self._path("removed.i32")
+        removed = (
+            np.fromfile(removed_path, dtype=np.int32)
+            if os.path.exists(removed_path)
+            else np.empty(0, dtype=np.int32)
+        )
+        self.removed = np.unique(removed[removed < size])
+        for row in self.removed:
+            # A key added again after its removal maps to its newest row
+            if self.ids.get(self.keys[row]) == row:
+                del self.ids[self.keys[row]]
+
+        centroids_path = self._path("centroids.npy")
+        self.centroids: Optional[np.ndarray] = (
+            np.load(centroids_path) if os.path.exists(centroids_path) else None
+        )
+        self._trained_size = len(self) if self.centroids is not None else 0
+        self._vectors: Optional[np.ndarray] = None
+        self._regroup()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.ids
+
+    def remove(self, keys: Iterable[str]):
+        """Remove keys from search results; their rows stay in the files."""
+        rows = np.asarray(
+            [self.ids.pop(key) for key in dict.fromkeys(keys) if key in self.ids],
+            dtype=np.int32,
+        )
+        if not len(rows):
+            return
+        with open(self._path("removed.i32"), "ab") as f:
+            f.write(rows.tobytes())
+        self.removed = np.union1d(self.removed, rows).astype(np.int32)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _file_rows(self, name: str, row_bytes: int) -> int:
+        path = self._path(name)
+        return os.path.getsize(path) // row_bytes if os.path.exists(path) else 0
+
+    def _truncate(self, size: int):
+        if size < len(self.keys):
+            self.keys = self.keys[:size]
+            with open(self._path("keys.jsonl"), "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(key) + "\n" for key in self.keys)
+        for name, row_bytes in (("vectors.f32", 4 * self.dim), ("lists.i32", 4)):
+            with open(self._path(name), "ab") as f:
+                f.truncate(size * row_bytes)
+
+    def vectors(self) -> np.ndarray:
+        if self._vectors is None or len(self._vectors) != len(self):
+            self._vectors = (
+                np.memmap(
+                    self._path("vectors.f32"),
+                    dtype=np.float32,
+                    mode="r",
+                    shape=(len(self), self.dim),
+                )
+                if len(self)
+                else np.empty((0, self.dim), dtype=np.float32)
+            )
+        return self._vectors
+
+    def _lists(self) -> np.ndarray:
+        return np.fromfile(self._path("lists.i32"), dtype=np.int32)
+
+    def _regroup(self):
+        """Sort the vector ids by cluster so a cluster is a contiguous slice."""
+        lists = self._lists()
+        self._order = np.argsort(lists, kind="stable").astype(np.int32)
+        n_lists = 0 if self.centroids is None else len(self.centroids)
+        self._offsets = np.searchsorted(lists[self._order], np.arange(n_lists + 1))
+        self._pending: List[int] = []
+
+    def _assign(self, vectors: np.ndarray, block: int = 16_384) -> np.ndarray:
+        if self.centroids is None:
+            return np.zeros(len(vectors), dtype=np.int32)
+        return np.concatenate(
+            [
+                np.argmax(vectors[i : i + block] @ self.centroids.T, axis=1)
+                for i in range(0, len(vectors), block)
+            ]
+            or [np.empty(0, dtype=np.int64)]
+        ).astype(np.int32)
+
+    def train(self, iterations: int = 10, seed: int = 0):
+        """Cluster the vectors with spherical k-means and reassign them."""
+        vectors = self.vectors()
+        n_lists = max(1, int(np.sqrt(len(self))))
+        rng = np.random.default_rng(seed)
+        sample_size = min(len(self), 64 * n_lists)
+        sample = np.asarray(vectors[np.sort(rng.choice(len(self), sample_size, False))])
+
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Empty clusters keep their previous centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+        self.centroids = centroids.astype(np.float32)
+        lists = self._assign(vectors)
+        lists.tofile(self._path("lists.i32.tmp"))
+        os.replace(self._path("lists.i32.tmp"), self._path("lists.i32"))
+        np.save(self._path("centroids.tmp.npy"), self.centroids)
+        os.replace(self._path("centroids.tmp.npy"), self._path("centroids.npy"))
+        self._trained_size = len(self)
+        self._regroup()
+
+    def add(self, keys: List[str], vectors: np.ndarray):
+        """Append vectors under keys; keys already in the index are skipped."""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        seen = set()
+        new = []
+        for i, key in enumerate(keys):
+            if key not in self.ids and key not in seen:
+                seen.add(key)
+                new.append(i)
+        if not new:
+            return
+        keys = [keys[i] for i in new]
+        vectors = vectors[new]
+        lists = self._assign(vectors)
+
+        # Vectors first, keys last: a crash leaves rows that _truncate drops
+        with open(self._path("vectors.f32"), "ab") as f:
+            f.write(vectors.tobytes())
+        with open(self._path("lists.i32"), "ab") as f:
+            f.write(lists.tobytes())
+        with open(self._path("keys.jsonl"), "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(key) + "\n" for key in keys)
+
+        self._pending.extend(range(len(self), len(self) + len(keys)))
+        for key in keys:
+            self.ids[key] = len(self.keys)
+            self.keys.append(key)
+
+        if len(self) >= max(TRAIN_SIZE, 4 * self._trained_size):
+            self.train()
+        elif len(self._pending) > max(1000, len(self) * PENDING_RATIO):
+            self._regroup()
+
+    def _candidates(self, query_lists: np.ndarray) -> np.ndarray:
+        slices = [
+            self._order[self._offsets[i] : self._offsets[i + 1]] for i in query_lists
+        ]
+        return np.concatenate(slices + [np.asarray(self._pending, dtype=np.int32)])
+
+    def search(self, queries: np.ndarray, k: int = 10) -> List[List[Tuple[str, float]]]:
+        """The k nearest keys of every query with their scores, best first."""
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        if not len(self):
+            return [[] for _ in queries]
+        vectors = self.vectors()
+        if self.centroids is None:
+            probes = None
+        else:
+            n_probe = min(self.n_probe, len(self.centroids))
+            probes = np.argpartition(
+                -(queries @ self.centroids.T), n_probe - 1, axis=1
+            )[:, :n_probe]
+
+        results: List[List[Tuple[str, float]]] = []
+        for i, query in enumerate(queries):
+            if probes is None:
+                candidates = np.arange(len(self))
+            else:
+                candidates = np.unique(self._candidates(probes[i]))
+            if len(self.removed):
+                candidates = candidates[~np.isin(candidates, self.removed)]
+            if not len(candidates):
+                results.append([])
+                continue
+            scores = vectors[candidates] @ query
+            top = min(k, len(candidates))
+            best = np.argpartition(-scores, top - 1)[:top]
+            best = best[np.argsort(-scores[best])]
+            results.append([(self.keys[candidates[j]], float(scores[j])) for j in best])
+        return results
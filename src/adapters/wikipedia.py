@@ -1,11 +1,47 @@
+import re
+from typing import List, Literal
+
 import wikipedia
-from langchain_community.tools import WikipediaQueryRun
-from langchain_community.utilities import WikipediaAPIWrapper
 
+from src.models import Block, Document, Page, Polygon
+
+_SECTION_HEADER = re.compile(r"(={2,6})\s*(.*?)\s*={2,6}")
+# Article text carries no layout, so every block covers the whole page
+_FULL_PAGE = Polygon(p1=(0.0, 0.0), p2=(1.0, 0.0), p3=(1.0, 1.0), p4=(0.0, 1.0))
+
+
+def read_doc(doc_name: str) -> Document:
+    """
+    Fetch a Wikipedia article as a single-page document.
+
+    Section titles ("== History ==") become SectionHeader blocks with Markdown
+    headers so that chunking keeps the article's header hierarchy.
+    """
+    page = wikipedia.page(doc_name, auto_suggest=False)
+
+    blocks: List[Block] = []
+    for line in page.content.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        match = _SECTION_HEADER.fullmatch(line)
+        block_type: Literal["SectionHeader", "Text"]
+        if match:
+            block_type = "SectionHeader"
+            text = f"{'#' * len(match.group(1))} {match.group(2)}"
+        else:
+            block_type, text = "Text", line
+        blocks.append(
+            Block(
+                id=f"/page/0/{block_type}/{len(blocks)}",
+                type=block_type,
+                text=text,
+                position=_FULL_PAGE,
+            )
+        )
 
-def read_doc(doc_name):
-    wikipedia_qr = WikipediaQueryRun(
-        api_wrapper=WikipediaAPIWrapper(doc_content_chars_max=10000)
+    return Document(
+        name=page.title,
+        address=page.url,
+        pages=[Page(id="/page/0/Page/0", number=1, blocks=blocks)],
     )
-    page = wikipedia.page(doc_name)
-    return wikipedia_qr.run(doc_name), page.fullurl if page.exists() else None
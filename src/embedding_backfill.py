@@ -0,0 +1,230 @@
+"""
+Embedding of key elements that have no embedding yet.
+
+Key elements without an embedding are fetched from Neo4j page by page, sent
+to the embedding endpoint in large batches and written back with batched
+UNWIND updates. Batches that fail are retried with exponential backoff, or
+split up when the endpoint rejects their input. Ingestion runs this after
+importing documents, so questions never wait for bulk embedding; it can also
+run on its own as a background worker. Key elements are embedded by the
+provider EMBEDDING_PROVIDER selects, or the one given with --provider.
+
+Usage:
+    python -m src.embedding_backfill --watch --interval 30
+"""
+
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from src.adapters import neo4j
+from src.reader_agent import chains, scheduler
+
+
+@dataclass
+class BackfillStats:
+    embedded: int = 0
+    failed_batches: int = 0
+    started: float = field(default_factory=time.perf_counter)
+
+    def progress(self, retrying: int):
+        elapsed = time.perf_counter() - self.started
+        print(
+            f"Embedded {self.embedded} key elements in {elapsed:.1f} s "
+            f"({self.embedded / elapsed:.1f}/s), {retrying} waiting for a retry"
+        )
+
+
+class EmbeddingBackfill:
+    """
+    Embed key elements missing an embedding in batches, with a retry queue.
+
+    Up to concurrency batches of batch_size key elements are embedded at a
+    time. Key elements of a batch that failed wait in the retry queue: after
+    a transient error with base_delay doubling with every attempt, up to
+    max_retries attempts; after a permanent error, such as an input the
+    endpoint rejects, right away in batches half the size, so a single bad
+    key element ends up alone and does not hold back the others. Embeddings
+    are made and stored for provider, see chains.get_embedding_provider.
+    """
+
+    def __init__(
+        self,
+        batch_size: Optional[int] = None,
+        concurrency: Optional[int] = None,
+        max_retries: int = 5,
+        base_delay: float = 2.0,
+        max_delay: float = 60.0,
+        provider: Optional[str] = None,
+    ):
+        self.batch_size = batch_size or int(os.getenv("EMBEDDING_BATCH_SIZE", 1000))
+        self.concurrency = concurrency or int(os.getenv("EMBEDDING_CONCURRENCY", 2))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.provider = chains.get_embedding_provider(provider).name
+        self.stats = BackfillStats()
+        # Key element id -> (failed attempts, time of the next attempt,
+        # size of the batch to retry it in)
+        self.retry_queue: Dict[str, Tuple[int, float, int]] = {}
+        self.gave_up: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def _failed(self, ids: List[str], error: Exception):
+        status_code = scheduler.error_status_code(error)
+        permanent = status_code in scheduler.PERMANENT_STATUS_CODES
+        now = time.monotonic()
+        with self._lock:
+            self.stats.failed_batches += 1
+            for i in ids:
+                attempts = self.retry_queue.get(i, (0, 0.0, 0))[0]
+                if permanent and len(ids) > 1:
+                    self.retry_queue[i] = (attempts, now, len(ids) // 2)
+                    continue
+                attempts += 1
+                if permanent or attempts > self.max_retries:
+                    self.retry_queue.pop(i, None)
+                    self.gave_up.add(i)
+                    continue
+                delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+                self.retry_queue[i] = (attempts, now + delay, len(ids))
+
+    def _embed(self, ids: List[str]) -> int:
+        try:
+            vectors = chains.get_embeddings(self.provider).embed_documents(ids)
+            neo4j.write_key_element_embeddings(
+                [{"id": i, "embedding": vector} for i, vector in zip(ids, vectors)],
+                self.provider,
+            )
+        except Exception as e:
+            print(f"Embedding {len(ids)} key elements failed: {e!r}")
+            self._failed(ids, e)
+            return 0
+        with self._lock:
+            for i in ids:
+                self.retry_queue.pop(i, None)
+            self.stats.embedded += len(ids)
+        return len(ids)
+
+    def _waiting(self, now: float) -> List[str]:
+        with self._lock:
+            waiting = [i for i, (_, due, _) in self.retry_queue.items() if due > now]
+            return waiting + list(self.gave_up)
+
+    def _drop_vanished(self, queried: float):
+        """
+        Forget retries that were due at queried but not returned by the query.
+
+        They were deleted, or embedded by another worker, in the meantime.
+        """
+        with self._lock:
+            for i in [
+                i for i, (_, due, _) in self.retry_queue.items() if due <= queried
+            ]:
+                del self.retry_queue[i]
+
+    def _batches(self, ids: List[str]) -> List[List[str]]:
+        """Fresh key elements in full batches, retried ones in their own sizes."""
+        groups: Dict[int, List[str]] = {}
+        with self._lock:
+            for i in ids:
+                size = self.retry_queue[i][2] if i in self.retry_queue else 0
+                groups.setdefault(size, []).append(i)
+        return [
+            group[j : j + (size or self.batch_size)]
+            for size, group in groups.items()
+            for j in range(0, len(group), size or self.batch_size)
+        ]
+
+    def run_once(self, wait_for_retries: bool = True) -> int:
+        """
+        Embed every key element that has no embedding yet.
+
+        With wait_for_retries, keeps going until the retry queue is empty
+        too. The embeddings are stamped with a new graph version at the end,
+        see neo4j.stamp_key_element_embeddings. Returns the number of key
+        elements embedded.
+        """
+        embedded = 0
+        page_size = self.batch_size * self.concurrency
+        stamped = self.stats.embedded
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                while True:
+                    queried = time.monotonic()
+                    ids = neo4j.get_unembedded_key_elements(
+                        page_size, self._waiting(queried), self.provider
+                    )
+                    if not ids:
+                        self._drop_vanished(queried)
+                        if not (wait_for_retries and self.retry_queue):
+                            break
+                        next_due = min(due for _, due, _ in self.retry_queue.values())
+                        time.sleep(max(0.0, next_due - time.monotonic()))
+                        continue
+                    embedded += sum(executor.map(self._embed, self._batches(ids)))
+                    self.stats.progress(len(self.retry_queue))
+        finally:
+            # Also after a failure, for the embeddings written before it
+            if self.stats.embedded > stamped:
+                neo4j.stamp_key_element_embeddings(self.provider)
+        if self.gave_up:
+            print(
+                f"Left {len(self.gave_up)} key elements without an embedding "
+                "after failed attempts"
+            )
+        return embedded
+
+    def run_forever(
+        self, interval: float = 30.0, stop: Optional[threading.Event] = None
+    ):
+        """Embed new key elements every interval seconds until stop is set."""
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            self.run_once(wait_for_retries=False)
+            stop.wait(interval)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument(
+        "--batch-size", type=int, help="Key elements per embedding request"
+    )
+    arg_parser.add_argument(
+        "--concurrency", type=int, help="Embedding requests at once"
+    )
+    arg_parser.add_argument(
+        "--provider",
+        choices=chains.EMBEDDING_PROVIDERS,
+        help="Embedding provider, by default EMBEDDING_PROVIDER",
+    )
+    arg_parser.add_argument(
+        "--watch", action="store_true", help="Keep embedding new key elements"
+    )
+    arg_parser.add_argument(
+        "--interval", type=float, default=30.0, help="Seconds between runs with --watch"
+    )
+    args = arg_parser.parse_args()
+
+    load_dotenv()
+    backfill = EmbeddingBackfill(
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        provider=args.provider,
+    )
+    if args.watch:
+        backfill.run_forever(args.interval)
+    else:
+        backfill.run_once()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Re-embedding of the key elements with another embedding provider.
+
+Each provider keeps its embeddings in its own property and vector index, so
+the key elements are embedded with the new provider next to the embeddings
+questions are still answered with. Once that is done, set
+EMBEDDING_PROVIDER to the new provider and restart; then run the migration
+again with --drop to embed key elements imported in between and delete the
+index and embeddings of the old provider.
+
+Usage:
+    python -m src.embedding_migration local
+    EMBEDDING_PROVIDER=local python -m src.embedding_migration local --drop openai
+"""
+
+import argparse
+import time
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from src.adapters import neo4j
+from src.embedding_backfill import EmbeddingBackfill
+from src.reader_agent import chains
+
+
+def migrate(
+    provider: str,
+    drop: Optional[str] = None,
+    batch_size: Optional[int] = None,
+    concurrency: Optional[int] = None,
+) -> bool:
+    """
+    Embed every key element with provider, then drop the embeddings of drop.
+
+    The old embeddings are only dropped once every key element has an
+    embedding of provider and questions are answered with it. Returns
+    whether the migration finished.
+    """
+    target = chains.get_embedding_provider(provider)
+    if drop == target.name:
+        raise ValueError(f"Cannot drop {drop}, the provider migrated to")
+    neo4j.create_vector_index(neo4j.get_graph(), target)
+
+    start = time.perf_counter()
+    backfill = EmbeddingBackfill(batch_size, concurrency, provider=target.name)
+    embedded = backfill.run_once()
+    print(
+        f"Embedded {embedded} key elements with {target.name} ({target.model}) "
+        f"in {time.perf_counter() - start:.1f} s"
+    )
+    if backfill.gave_up:
+        print(
+            f"{len(backfill.gave_up)} key elements have no {target.name} "
+            "embedding, run the migration again"
+        )
+        return False
+    if not drop:
+        return True
+    if chains.get_embedding_provider().name == drop:
+        print(f"Questions are answered with {drop}, set EMBEDDING_PROVIDER first")
+        return False
+    dropped = neo4j.drop_key_element_embeddings(drop)
+    print(f"Dropped the {drop} vector index and {dropped} embeddings")
+    return True
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument(
+        "provider", choices=chains.EMBEDDING_PROVIDERS, help="Provider to migrate to"
+    )
+    arg_parser.add_argument(
+        "--drop",
+        choices=chains.EMBEDDING_PROVIDERS,
+        help="Provider whose index and embeddings to delete afterwards",
+    )
+    arg_parser.add_argument(
+        "--batch-size", type=int, help="Key elements per embedding request"
+    )
+    arg_parser.add_argument(
+        "--concurrency", type=int, help="Embedding requests at once"
+    )
+    args = arg_parser.parse_args()
+
+    load_dotenv()
+    if not migrate(args.provider, args.drop, args.batch_size, args.concurrency):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Removal of documents from the knowledge graph and compaction of orphans.
+
+Removing a document deletes its chunks in batches, then the atomic facts and
+key elements no other document uses. Compaction deletes whatever is left
+without references, e.g. after an interrupted import, and reports how much
+it reclaimed; with --watch it runs periodically.
+
+Documents are named as they were imported: a Wikipedia page by its title, a
+PDF by its file name without the extension.
+
+Usage:
+    python -m src.graph_maintenance remove "Klarna"
+    python -m src.graph_maintenance compact --watch --interval 3600
+"""
+
+import argparse
+import os
+import threading
+import time
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+from src.reader_agent import kg_constructor
+
+
+def remove_documents(doc_names: List[str]) -> kg_constructor.RemovalStats:
+    removal = kg_constructor.RemovalStats()
+    for doc_name in doc_names:
+        start = time.perf_counter()
+        removed = kg_constructor.remove_document(doc_name)
+        print(
+            f"Removed {doc_name} in {time.perf_counter() - start:.1f} s: "
+            f"{removed.report()}"
+        )
+        removal.add(removed)
+    return removal
+
+
+def compact(
+    batch_size: int = kg_constructor.CHUNK_BATCH_SIZE,
+) -> kg_constructor.RemovalStats:
+    start = time.perf_counter()
+    removal = kg_constructor.compact_graph(batch_size)
+    print(
+        f"Compaction reclaimed {removal.report()} in "
+        f"{time.perf_counter() - start:.1f} s"
+    )
+    return removal
+
+
+def compact_forever(
+    interval: float = 3600.0,
+    stop: Optional[threading.Event] = None,
+    batch_size: int = kg_constructor.CHUNK_BATCH_SIZE,
+):
+    """Compact the graph every interval seconds until stop is set."""
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        compact(batch_size)
+        stop.wait(interval)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+    remove_parser = commands.add_parser("remove", help="Remove documents")
+    remove_parser.add_argument("documents", nargs="+", help="Document names")
+    compact_parser = commands.add_parser("compact", help="Delete orphaned nodes")
+    compact_parser.add_argument(
+        "--watch", action="store_true", help="Keep compacting periodically"
+    )
+    compact_parser.add_argument(
+        "--interval",
+        type=float,
+        default=3600.0,
+        help="Seconds between runs with --watch",
+    )
+    compact_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=kg_constructor.CHUNK_BATCH_SIZE,
+        help="Nodes deleted per transaction",
+    )
+    args = arg_parser.parse_args()
+
+    load_dotenv()
+    if os.getenv("NORMALIZE_KEY_ELEMENTS"):
+        # Loaded so that removed key elements are dropped from its index
+        kg_constructor.KeyElementNormalizer()
+    if args.command == "remove":
+        missing = [
+            doc_name
+            for doc_name in args.documents
+            if not kg_constructor.document_exists(doc_name)
+        ]
+        for doc_name in missing:
+            print(f"No document named {doc_name} in the graph")
+        remove_documents([name for name in args.documents if name not in missing])
+        if missing:
+            raise SystemExit(1)
+    elif args.watch:
+        compact_forever(args.interval, batch_size=args.batch_size)
+    else:
+        compact(args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+"""
+Headless bulk ingestion of PDFs and Wikipedia articles into the knowledge graph.
+
+Sources are PDF paths, directories (searched recursively for PDFs) and
+"wikipedia:<title>" entries, given on the command line or in a manifest file
+with one source per line. Every document goes through parse -> chunk ->
+extract -> Neo4j import, and each stage has its own concurrency limit.
+Within a document the stages after parsing overlap, see
+src.reader_agent.pipeline. New key elements are embedded in the background
+while documents are imported.
+
+Usage:
+    python -m src.ingestion docs/ --manifest manifest.txt --llm-concurrency 16
+"""
+
+import argparse
+import asyncio
+import os
+import threading
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from src.adapters import file_system, wikipedia
+from src.embedding_backfill import EmbeddingBackfill
+from src.models import Document
+from src.parser import ParserPool
+from src.reader_agent import kg_constructor
+from src.reader_agent.pipeline import DocumentPipeline, StageStats
+from src.reader_agent.scheduler import ExtractionScheduler
+
+WIKIPEDIA_PREFIX = "wikipedia:"
+
+
+def collect_sources(paths: List[str], manifest: Optional[str] = None) -> List[str]:
+    """Expand directories and manifest entries into a list of PDFs and titles."""
+    entries = list(paths)
+    if manifest:
+        with open(manifest) as f:
+            entries += [line.strip() for line in f]
+
+    sources = []
+    for entry in entries:
+        if not entry or entry.startswith("#"):
+            continue
+        if os.path.isdir(entry):
+            for root, _, files in sorted(os.walk(entry)):
+                sources += [
+                    os.path.join(root, file)
+                    for file in sorted(files)
+                    if file.lower().endswith(".pdf")
+                ]
+        else:
+            sources.append(entry)
+    # Keep the first occurrence of every source
+    return list(dict.fromkeys(sources))
+
+
+@dataclass
+class IngestionStats:
+    total: int
+    documents: int = 0
+    failed: int = 0
+    pages: int = 0
+    chunks: int = 0
+    llm_calls: int = 0
+    neo4j_rows: int = 0
+    reused_chunks: int = 0
+    cached_chunks: int = 0
+    failed_chunks: int = 0
+    retries: int = 0
+    embeddings: int = 0
+    stages: Dict[str, StageStats] = field(
+        default_factory=lambda: {
+            name: StageStats(name) for name in ("parse", "chunk", "extract", "write")
+        }
+    )
+    started: float = field(default_factory=time.perf_counter)
+
+    def progress(
+        self, source: str, doc: Optional[Document] = None, chunks=0, failed_chunks=0
+    ):
+        done = self.documents + self.failed
+        status = f"{len(doc.pages)} pages, {chunks} chunks" if doc else "failed"
+        if failed_chunks:
+            status += f", {failed_chunks} not imported after failed extraction"
+        print(f"[{done}/{self.total}] {source}: {status}")
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        print(
+            f"Ingested {self.documents} of {self.total} documents "
+            f"({self.failed} failed) in {elapsed:.1f} s"
+        )
+        for name, count in (
+            ("pages", self.pages),
+            ("chunks", self.chunks),
+            ("LLM calls", self.llm_calls),
+            ("Neo4j rows", self.neo4j_rows),
+            ("embeddings", self.embeddings),
+        ):
+            print(f"  {name:>10}: {count:>9}  ({count / elapsed:.2f}/s)")
+        print(
+            f"  {self.reused_chunks} chunks reused without an LLM call, "
+            f"{self.cached_chunks} of them from the extraction cache"
+        )
+        print(
+            f"  {self.retries} LLM calls retried, "
+            f"{self.failed_chunks} chunks failed extraction"
+        )
+        print("  Time spent per stage, summed over documents:")
+        for stage in self.stages.values():
+            print(f"  {stage.report()}")
+
+
+class Ingester:
+    """Run sources through the pipeline with per-stage concurrency limits."""
+
+    def __init__(
+        self,
+        parse_workers: int = 2,
+        parse_concurrency: Optional[int] = None,
+        llm_concurrency: int = 8,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_retries: int = 5,
+        import_concurrency: int = 2,
+        documents: int = 8,
+        chunk_size: int = 2000,
+        overlap: int = 0,
+        incremental: bool = False,
+        normalize_key_elements: bool = False,
+        embedding_interval: float = 10.0,
+    ):
+        self.parse_workers = parse_workers
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.incremental = incremental
+        self.normalize_key_elements = normalize_key_elements
+        self.normalizer: Optional[kg_constructor.KeyElementNormalizer] = None
+        self.embedding_interval = embedding_interval
+        # Queue a couple of documents per worker so workers never wait for work
+        self.parse_semaphore = asyncio.Semaphore(parse_concurrency or 2 * parse_workers)
+        self.scheduler = ExtractionScheduler(
+            kg_constructor.extract_atomic_facts,
+            max_concurrency=llm_concurrency,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            max_retries=max_retries,
+        )
+        self.import_semaphore = asyncio.Semaphore(import_concurrency)
+        # Bounds the documents held in memory between parsing and import
+        self.document_semaphore = asyncio.Semaphore(documents)
+        self.parser_pool: Optional[ParserPool] = None
+        # Extractions in flight by chunk id, shared by all documents
+        self.extraction_tasks: Dict[str, asyncio.Task] = {}
+
+    def _read(self, source: str) -> Document:
+        if source.startswith(WIKIPEDIA_PREFIX):
+            return wikipedia.read_doc(source[len(WIKIPEDIA_PREFIX) :].strip())
+        return file_system.read_doc(source, parser=self.parser_pool)
+
+    async def ingest_document(self, source: str, stats: IngestionStats):
+        async with self.document_semaphore:
+            try:
+                async with self.parse_semaphore:
+                    started = time.perf_counter()
+                    doc = await asyncio.to_thread(self._read, source)
+                    stats.stages["parse"].busy += time.perf_counter() - started
+                existing = (
+                    await asyncio.to_thread(
+                        kg_constructor.get_document_chunk_indexes, doc.name
+                    )
+                    if self.incremental
+                    else {}
+                )
+                pipeline = DocumentPipeline(
+                    doc,
+                    scheduler=self.scheduler,
+                    existing=existing,
+                    chunk_size=self.chunk_size,
+                    overlap=self.overlap,
+                    extraction_tasks=self.extraction_tasks,
+                    import_semaphore=self.import_semaphore,
+                    normalizer=self.normalizer,
+                )
+                await pipeline.run()
+            except Exception as e:
+                stats.failed += 1
+                print(f"Failed to ingest {source}: {e!r}")
+                stats.progress(source)
+                return
+
+            stats.documents += 1
+            stats.pages += len(doc.pages)
+            stats.chunks += pipeline.chunks
+            stats.reused_chunks += pipeline.chunks - pipeline.extracting
+            stats.cached_chunks += pipeline.cached
+            stats.failed_chunks += len(pipeline.failed)
+            stats.neo4j_rows += kg_constructor.count_import_rows(pipeline.written)
+            for name, stage in pipeline.stages.items():
+                stats.stages[name].add(stage)
+            stats.progress(source, doc, pipeline.chunks, len(pipeline.failed))
+
+    async def ingest(self, sources: List[str]) -> IngestionStats:
+        stats = IngestionStats(total=len(sources))
+        if self.normalize_key_elements:
+            self.normalizer = await asyncio.to_thread(
+                kg_constructor.KeyElementNormalizer
+            )
+        if indexed := await asyncio.to_thread(kg_constructor.index_chunk_terms):
+            print(f"Stored the terms of {indexed} chunks imported before")
+        has_pdfs = any(not s.startswith(WIKIPEDIA_PREFIX) for s in sources)
+        # Worker processes load the Marker models, so only start them for PDFs
+        pool = ParserPool(max_workers=self.parse_workers) if has_pdfs else None
+        # Embed new key elements while documents are still being imported
+        backfill = EmbeddingBackfill()
+        stop_backfill = threading.Event()
+        backfill_thread = threading.Thread(
+            target=backfill.run_forever,
+            args=(self.embedding_interval, stop_backfill),
+            daemon=True,
+        )
+        backfill_thread.start()
+        try:
+            with pool or nullcontext():
+                self.parser_pool = pool
+                await asyncio.gather(
+                    *(self.ingest_document(source, stats) for source in sources)
+                )
+        finally:
+            self.parser_pool = None
+            stop_backfill.set()
+            await asyncio.to_thread(backfill_thread.join)
+        await asyncio.to_thread(backfill.run_once)
+        stats.llm_calls = self.scheduler.stats.requests
+        stats.retries = self.scheduler.stats.retries
+        stats.embeddings = backfill.stats.embedded
+        return stats
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument(
+        "sources", nargs="*", help="PDF files, directories or wikipedia:<title>"
+    )
+    arg_parser.add_argument("--manifest", help="File with one source per line")
+    arg_parser.add_argument(
+        "--parse-workers", type=int, default=2, help="Marker worker processes"
+    )
+    arg_parser.add_argument(
+        "--parse-concurrency",
+        type=int,
+        help="Documents parsed or fetched at once (default: 2 x parse workers)",
+    )
+    arg_parser.add_argument(
+        "--llm-concurrency", type=int, default=8, help="Concurrent extraction calls"
+    )
+    arg_parser.add_argument(
+        "--rpm", type=float, help="Extraction requests per minute (default: no limit)"
+    )
+    arg_parser.add_argument(
+        "--tpm", type=float, help="Extraction tokens per minute (default: no limit)"
+    )
+    arg_parser.add_argument(
+        "--max-retries", type=int, default=5, help="Retries per extraction call"
+    )
+    arg_parser.add_argument(
+        "--import-concurrency", type=int, default=2, help="Concurrent Neo4j imports"
+    )
+    arg_parser.add_argument(
+        "--documents", type=int, default=8, help="Documents in flight at once"
+    )
+    arg_parser.add_argument(
+        "--chunk-size", type=int, default=2000, help="Chunk budget in tokens"
+    )
+    arg_parser.add_argument(
+        "--overlap", type=int, default=0, help="Tokens shared by adjacent chunks"
+    )
+    arg_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only extract chunks that stored documents do not have yet",
+    )
+    arg_parser.add_argument(
+        "--normalize-key-elements",
+        action="store_true",
+        help="Map key elements onto similar ones already in the graph",
+    )
+    args = arg_parser.parse_args()
+
+    sources = collect_sources(args.sources, args.manifest)
+    if not sources:
+        arg_parser.error("no sources given")
+
+    load_dotenv()
+    ingester = Ingester(
+        parse_workers=args.parse_workers,
+        parse_concurrency=args.parse_concurrency,
+        llm_concurrency=args.llm_concurrency,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        max_retries=args.max_retries,
+        import_concurrency=args.import_concurrency,
+        documents=args.documents,
+        chunk_size=args.chunk_size,
+        overlap=args.overlap,
+        incremental=args.incremental,
+        normalize_key_elements=args.normalize_key_elements,
+    )
+    stats = asyncio.run(ingester.ingest(sources))
+    stats.report()
+
+
+if __name__ == "__main__":
+    main()
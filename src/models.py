@@ -86,6 +86,7 @@ sequences, interpersonal relationships, timelines, etc."""
     def set_id(self):
         if self.atomic_fact and not self.id:
             self.id = encode_md5(self.atomic_fact)
+        return self
 
 
 class Extraction(BaseModel):
@@ -1,52 +1,111 @@
+import gc
+import multiprocessing
 import os
+import sys
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
 from functools import lru_cache
-from typing import List, Literal, Tuple
+from typing import Iterable, Iterator, List, Literal, Optional, Tuple
 
-from marker.config.parser import ConfigParser
-
-# from marker.converters.html import HtmlConverter
-# from marker.converters.image import ImageConverter
-from marker.converters.pdf import PdfConverter
-from marker.models import create_model_dict
+import pymupdf as fitz
 from tqdm import tqdm
 
 from src.models import Block, Document, Page, Polygon
-from src.utils import html_to_md
+from src.utils import html_blocks_to_md
+
+# Marker (and with it torch) is only imported once a conversion needs it, so
+# importing this module stays cheap for processes that never parse documents
+_artifact_dict: Optional[dict] = None
+_artifact_lock = threading.Lock()
+
+
+def get_artifact_dict() -> dict:
+    """Load the Marker models on first use; all converters share one copy."""
+    global _artifact_dict
+    with _artifact_lock:
+        if _artifact_dict is None:
+            from marker.models import create_model_dict
+
+            _artifact_dict = create_model_dict()
+        return _artifact_dict
+
+
+def warm_up_models():
+    """Load the Marker models ahead of the first conversion."""
+    get_artifact_dict()
+
+
+def release_models():
+    """Drop the Marker models and the cached parsers holding on to them."""
+    global _artifact_dict
+    with _artifact_lock:
+        _artifact_dict = None
+    pdf_parser.cache_clear()
+    html_parser.cache_clear()
+    image_parser.cache_clear()
+    gc.collect()
+
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def marker_config() -> dict:
+    """Marker settings shared by every converter."""
+    return {
+        "output_format": "json",
+        "use_llm": True,
+        "llm_service": "marker.services.openai.OpenAIService",
+        "openai_model": "gemini-1.5-flash",
+        "openai_api_key": os.getenv("AI_GATEWAY_API_KEY"),
+        "openai_base_url": os.getenv("AI_GATEWAY_BASE_URL"),
+        "force_ocr": False,
+    }
 
 
 class MarkerParser:
     def __init__(self, doc_type: Literal["pdf", "html", "image"] = "pdf"):
-        json_config = {
-            "output_format": "json",
-            "use_llm": True,
-            "llm_service": "marker.services.openai.OpenAIService",
-            "openai_model": "gemini-1.5-flash",
-            "openai_api_key": os.getenv("AI_GATEWAY_API_KEY"),
-            "openai_base_url": os.getenv("AI_GATEWAY_BASE_URL"),
-            "force_ocr": False,
-        }
+        self.doc_type = doc_type
+        self._json_converter = None
+
+    @property
+    def json_converter(self):
+        if self._json_converter is None:
+            self._json_converter = self._create_converter()
+        return self._json_converter
+
+    def _create_converter(self, page_range: Optional[str] = None):
+        from marker.config.parser import ConfigParser
+
+        # from marker.converters.html import HtmlConverter
+        # from marker.converters.image import ImageConverter
+        from marker.converters.pdf import PdfConverter
+
+        json_config = marker_config()
+        if page_range is not None:
+            json_config["page_range"] = page_range
         json_config_parser = ConfigParser(json_config)
 
-        if doc_type == "pdf":
-            self.json_converter = PdfConverter(
+        if self.doc_type == "pdf":
+            return PdfConverter(
                 config=json_config_parser.generate_config_dict(),
-                artifact_dict=create_model_dict(),
+                artifact_dict=get_artifact_dict(),
                 processor_list=json_config_parser.get_processors(),
                 renderer=json_config_parser.get_renderer(),
                 llm_service=json_config_parser.get_llm_service(),
             )
 
-        # elif doc_type == "html":
-        #    self.json_converter = HtmlConverter(
+        # elif self.doc_type == "html":
+        #    return HtmlConverter(
         #        config=json_config_parser.generate_config_dict(),
-        #        artifact_dict=create_model_dict(),
+        #        artifact_dict=get_artifact_dict(),
         #        processor_list=json_config_parser.get_processors(),
         #    )
 
-        # elif doc_type == "image":
-        #    self.json_converter = ImageConverter(
+        # elif self.doc_type == "image":
+        #    return ImageConverter(
         #        config=json_config_parser.generate_config_dict(),
-        #        artifact_dict=create_model_dict(),
+        #        artifact_dict=get_artifact_dict(),
         #        processor_list=json_config_parser.get_processors(),
         #    )
 
@@ -89,21 +148,15 @@ class MarkerParser:
             (relative_x4, relative_y4),
         ]
 
-    def parse_document(self, doc_name: str, doc_path: str) -> Document:
-
-        json_doc = self.json_converter(doc_path)
-
-        # Print document structure
-        print(f"Document type: {json_doc.block_type}")
-        print(f"Number of pages: {len(json_doc.children)}")
-
+    def _build_pages(self, json_doc, first_page_number: int = 1) -> List[Page]:
         pages = []
 
         # Iterate through pages and blocks
-        for page_num, page in tqdm(enumerate(json_doc.children, 1)):
+        for page_num, page in tqdm(enumerate(json_doc.children, first_page_number)):
+            texts = html_blocks_to_md([block.html for block in page.children])
             blocks = []
 
-            for block in page.children:
+            for block, text in zip(page.children, texts):
                 relative_position = self._calculate_relative_position(
                     block.polygon, page.polygon
                 )
@@ -111,7 +164,7 @@ class MarkerParser:
                     Block(
                         id=block.id,
                         type=block.block_type,
-                        text=html_to_md(block.html),
+                        text=text,
                         position=Polygon(
                             p1=relative_position[0],
                             p2=relative_position[1],
@@ -128,15 +181,127 @@ class MarkerParser:
                     blocks=blocks,
                 )
             )
+        return pages
+
+    def parse_page_range(
+        self, doc_path: str, first_page: int, last_page: int
+    ) -> List[Page]:
+        """Parse the zero-based, inclusive page range [first_page, last_page]."""
+        json_doc = self._create_converter(f"{first_page}-{last_page}")(doc_path)
+        return self._build_pages(json_doc, first_page_number=first_page + 1)
+
+    def iter_pages(self, doc_path: str, pages_per_window: int = 10) -> Iterator[Page]:
+        """
+        Parse a document window by window, yielding pages as they are ready.
+
+        Only one window of pages is held in memory at a time.
+        """
+        with fitz.open(doc_path) as pdf:
+            page_count = len(pdf)
+        for first_page in range(0, page_count, pages_per_window):
+            last_page = min(first_page + pages_per_window, page_count) - 1
+            yield from self.parse_page_range(doc_path, first_page, last_page)
+
+    def parse_document(self, doc_name: str, doc_path: str) -> Document:
+
+        json_doc = self.json_converter(doc_path)
+
+        # Print document structure
+        print(f"Document type: {json_doc.block_type}")
+        print(f"Number of pages: {len(json_doc.children)}")
 
         document = Document(
             name=doc_name,
             address=doc_path,
-            pages=pages,
+            pages=self._build_pages(json_doc),
         )
         return document
 
 
+# Parser owned by each pool worker, created once by _init_pool_worker
+_worker_parser: Optional[MarkerParser] = None
+
+
+def _init_pool_worker(doc_type: Literal["pdf", "html", "image"]):
+    global _worker_parser
+    warm_up_models()
+    _worker_parser = MarkerParser(doc_type=doc_type)
+
+
+def _parse_page_range(doc_path: str, first_page: int, last_page: int) -> List[Page]:
+    assert _worker_parser is not None, "called outside a ParserPool worker"
+    return _worker_parser.parse_page_range(doc_path, first_page, last_page)
+
+
+class ParserPool:
+    """
+    Parse PDFs in worker processes, splitting large documents into page ranges.
+
+    Every worker loads the Marker models once at startup and keeps them for
+    the lifetime of the pool.
+    """
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        pages_per_task: int = 20,
+        doc_type: Literal["pdf", "html", "image"] = "pdf",
+    ):
+        self.pages_per_task = pages_per_task
+        # torch does not survive fork, so workers are always spawned
+        self.executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_pool_worker,
+            initargs=(doc_type,),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def _submit(self, doc_path: str) -> List[Future]:
+        with fitz.open(doc_path) as pdf:
+            page_count = len(pdf)
+        return [
+            self.executor.submit(
+                _parse_page_range,
+                doc_path,
+                first_page,
+                min(first_page + self.pages_per_task, page_count) - 1,
+            )
+            for first_page in range(0, page_count, self.pages_per_task)
+        ]
+
+    @staticmethod
+    def _merge(doc_name: str, doc_path: str, futures: List[Future]) -> Document:
+        # Futures are in page order, so results can be concatenated as they are
+        return Document(
+            name=doc_name,
+            address=doc_path,
+            pages=[page for future in futures for page in future.result()],
+        )
+
+    def parse_document(self, doc_name: str, doc_path: str) -> Document:
+        return self._merge(doc_name, doc_path, self._submit(doc_path))
+
+    def parse_documents(self, docs: Iterable[Tuple[str, str]]) -> Iterator[Document]:
+        """
+        Parse a queue of (doc_name, doc_path) pairs.
+
+        All page ranges of all documents are submitted up front so workers
+        never idle between documents; documents are yielded in input order.
+        """
+        submitted = [
+            (doc_name, doc_path, self._submit(doc_path)) for doc_name, doc_path in docs
+        ]
+        for doc_name, doc_path, futures in submitted:
+            yield self._merge(doc_name, doc_path, futures)
 
 
 @lru_cache(maxsize=1)
@@ -1,6 +1,12 @@
+import json
 import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
 from functools import lru_cache
+from typing import List, Optional
 
+from langchain_core.embeddings import Embeddings
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
@@ -13,12 +19,50 @@ from src.models import (
     InitialNodes,
     NeighborOutput,
 )
+from src.utils import encode_md5
+
+GPT4O_MODEL = "gpt-4o-2024-08-06"
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 1536
+
+
+@dataclass(frozen=True)
+class EmbeddingProvider:
+    """
+    A model key elements and questions are embedded with.
+
+    Each provider keeps its embeddings in its own key element property and
+    vector index, so the graph can be re-embedded with another provider
+    while questions are answered with the current one, see
+    src.embedding_migration.
+    """
+
+    name: str
+    model: str
+    dimensions: int
+
+    @property
+    def index_name(self) -> str:
+        # OpenAI keeps the names graphs were created with before providers
+        return "keyelements" if self.name == "openai" else f"keyelements_{self.name}"
+
+    @property
+    def embedding_property(self) -> str:
+        return "embedding" if self.name == "openai" else f"embedding_{self.name}"
+
+    @property
+    def version_property(self) -> str:
+        # The graph version the embedding was written at
+        return f"{self.embedding_property}_version"
+
+
+EMBEDDING_PROVIDERS = ("openai", "local")
 
 
 @lru_cache
 def get_gpt4o_model():
     return ChatOpenAI(
-        model="gpt-4o-2024-08-06",
+        model=GPT4O_MODEL,
         temperature=0,
         base_url=os.environ["AI_GATEWAY_BASE_URL"],
         api_key=os.environ["AI_GATEWAY_API_KEY"],
@@ -39,15 +83,92 @@ def get_gpt4_vision_model():
 @lru_cache
 def get_openai_embeddings():
     return OpenAIEmbeddings(
-        model="text-embedding-3-small",
+        model=EMBEDDING_MODEL,
         base_url=os.environ["AI_GATEWAY_BASE_URL"],
         api_key=os.environ["AI_GATEWAY_API_KEY"],
     )
 
 
 @lru_cache
-def construction_chain():
-    construction_system = """
+def get_local_embeddings():
+    # Imported here so that loading this module does not pull in torch
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    return HuggingFaceEmbeddings(
+        model_name=get_embedding_provider("local").model,
+        model_kwargs={"device": os.getenv("LOCAL_EMBEDDING_DEVICE", "cpu")},
+        encode_kwargs={"normalize_embeddings": True, "batch_size": 256},
+    )
+
+
+def get_embedding_provider(name: Optional[str] = None) -> EmbeddingProvider:
+    """The provider called name, by default the one EMBEDDING_PROVIDER selects."""
+    name = name or os.getenv("EMBEDDING_PROVIDER", "openai")
+    if name == "openai":
+        return EmbeddingProvider(name, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+    if name == "local":
+        # Runs on CPU in the process, without a request per question
+        return EmbeddingProvider(
+            name,
+            os.getenv(
+                "LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2"
+            ),
+            int(os.getenv("LOCAL_EMBEDDING_DIMENSIONS", 384)),
+        )
+    raise ValueError(
+        f"Unknown embedding provider {name!r}, "
+        f"expected one of {', '.join(EMBEDDING_PROVIDERS)}"
+    )
+
+
+class QueryCachedEmbeddings(Embeddings):
+    """
+    Embeddings that remember the last cache_size queries they embedded.
+
+    Queries are looked up with their case and whitespace normalized, so a
+    question asked again, or with different spacing or capitalization, is
+    not embedded again. The model is always given the query as it was
+    asked first. Documents are always embedded.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache_size: int = 1024):
+        self.embeddings = embeddings
+        self.cache_size = cache_size
+        # Normalized query -> embedding, least recently used first
+        self._cache: OrderedDict[str, List[float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = " ".join(text.split()).lower()
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return list(self._cache[key])
+        embedding = self.embeddings.embed_query(text)
+        with self._lock:
+            self._cache[key] = embedding
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return list(embedding)
+
+
+@lru_cache
+def _get_embeddings(name: str) -> QueryCachedEmbeddings:
+    embeddings = get_local_embeddings() if name == "local" else get_openai_embeddings()
+    return QueryCachedEmbeddings(
+        embeddings, int(os.getenv("EMBEDDING_QUERY_CACHE_SIZE", 1024))
+    )
+
+
+def get_embeddings(provider: Optional[str] = None) -> QueryCachedEmbeddings:
+    """Embeddings of the provider, see get_embedding_provider."""
+    return _get_embeddings(get_embedding_provider(provider).name)
+
+
+CONSTRUCTION_SYSTEM_PROMPT = """
     You are now an intelligent assistant tasked with meticulously extracting both key elements and
     atomic facts from a long text.
     1. Key Elements: The essential nouns (e.g., characters, times, events, places, numbers), verbs (e.g.,
@@ -67,18 +188,41 @@ def construction_chain():
     5. Ensure that the key elements are in lowercase unless they are proper nouns.
     """
 
-    construction_human = """Use the given format to extract information from the 
+CONSTRUCTION_HUMAN_PROMPT = """Use the given format to extract information from the 
     following input: {input}"""
 
+
+@lru_cache
+def construction_prompt_hash() -> str:
+    """
+    Hash of everything that shapes an extraction besides the chunk and model.
+
+    Stored extractions are keyed by it, so editing the prompt or the Extraction
+    schema invalidates them.
+    """
+    return encode_md5(
+        json.dumps(
+            [
+                CONSTRUCTION_SYSTEM_PROMPT,
+                CONSTRUCTION_HUMAN_PROMPT,
+                Extraction.model_json_schema(),
+            ],
+            sort_keys=True,
+        )
+    )
+
+
+@lru_cache
+def construction_chain():
     construction_prompt = ChatPromptTemplate.from_messages(
         [
             (
                 "system",
-                construction_system,
+                CONSTRUCTION_SYSTEM_PROMPT,
             ),
             (
                 "human",
-                construction_human,
+                CONSTRUCTION_HUMAN_PROMPT,
             ),
         ]
     )
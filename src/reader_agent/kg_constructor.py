@@ -1,274 +1,963 @@
 import asyncio
 import json
+import os
+import threading
+from dataclasses import dataclass, field
 from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 import numpy as np
-from sentence_transformers import SentenceTransformer, util
 
 from src.adapters import neo4j
-from src.models import Document
-from src.reader_agent.chains import construction_chain
-from src.utils import encode_md5
+from src.adapters.extraction_cache import extraction_cache
+from src.adapters.file_system import DATA_DIR
+from src.adapters.vector_index import IVFIndex
+from src.embedding_backfill import EmbeddingBackfill
+from src.models import Document, Extraction, Page
+from src.reader_agent import chains
+from src.reader_agent.scheduler import ExtractionScheduler
+from src.utils import encode_md5, get_encoding
+
+# Chunks looked up in the graph at once before extraction
+DEDUP_BATCH_SIZE = 16
+# Chunk rows carry the chunk text, so fewer of them go in one transaction
+CHUNK_BATCH_SIZE = 500
+CHUNK_PROPERTIES = ("id", "text", "index", "type", "block_positions", "page")
 
 
 @lru_cache
 class KeyElementNormalizer:
-    def __init__(self):
+    """
+    Map key elements onto canonical key elements with the same meaning.
+
+    Canonical key elements are kept with their embeddings in a persistent
+    IVFIndex, so only key elements not seen before are embedded and each of
+    them is resolved with a top-k query instead of being compared with every
+    other key element. Key elements mapped onto another one are remembered
+    as aliases. On first use the index is filled with the key elements
+    already in the graph, which is the only step that embeds them all.
+    """
+
+    def __init__(self, threshold: float = 0.7, k: int = 8):
+        # Imported here so that loading this module does not pull in torch
+        from sentence_transformers import SentenceTransformer
 
         self.model = SentenceTransformer(
             "all-MiniLM-L6-v2"
         )  # Model for semantic similarity
-        self.threshold = 0.7  # Similarity threshold for normalization
+        self.threshold = threshold  # Similarity threshold for normalization
+        self.k = k
+        index_dir = os.getenv(
+            "KEY_ELEMENT_INDEX_DIR", os.path.join(DATA_DIR, "key_element_index")
+        )
+        self.index = IVFIndex(index_dir, self.model.get_sentence_embedding_dimension())
+        self.aliases_path = os.path.join(index_dir, "aliases.jsonl")
+        self.aliases = {}
+        if os.path.exists(self.aliases_path):
+            with open(self.aliases_path, encoding="utf-8") as f:
+                self.aliases = dict(json.loads(line) for line in f)
+        self._lock = threading.Lock()
 
-    def _create_normalized_representatives(self, key_elements):
-        """Normalize a list of keywords using semantic similarity."""
-        embeddings = self.model.encode(key_elements, convert_to_tensor=True)
-        similarity_matrix = util.cos_sim(embeddings, embeddings)
+        if not len(self.index):
+            key_elements = neo4j.get_all_key_elements()
+            for i in range(0, len(key_elements), 10_000):
+                batch = key_elements[i : i + 10_000]
+                self.index.add(batch, self._embed(batch))
 
-        groups = []
-        used_indices = set()
+    def _embed(self, key_elements: List[str]) -> np.ndarray:
+        return self.model.encode(
+            key_elements, batch_size=256, normalize_embeddings=True
+        ).astype(np.float32)
 
-        for i, key_element in enumerate(key_elements):
-            if i in used_indices:
-                continue
-            group = [key_element]
-            used_indices.add(i)
-            for j, score in enumerate(similarity_matrix[i]):
-                if j != i and score >= self.threshold and j not in used_indices:
-                    group.append(key_elements[j])
-                    used_indices.add(j)
-            groups.append(group)
-
-        # Return a mapping of each key element to its normalized representative
-        normalized_mapping = {ke: group[0] for group in groups for ke in group}
-        return normalized_mapping
-
-    def sanitize_key_elements(self, chunk):
-        """Normalize key elements for each atomic fact."""
-        existing_key_elements = neo4j.get_all_key_elements()
-        afs = chunk["atomic_facts"]
-        key_elements = set()
-        for af in afs:
-            key_elements |= set(af["key_elements"])
-        normalized_mapping = self._create_normalized_representatives(
-            existing_key_elements + list(key_elements)
-        )
-        for af in afs:
+    def normalize(self, key_elements: Iterable[str]) -> Dict[str, str]:
+        """Map each key element to its canonical key element."""
+        with self._lock:
+            mapping = {}
+            new = []
+            for ke in dict.fromkeys(key_elements):
+                if ke in self.index:
+                    mapping[ke] = ke
+                elif ke in self.aliases:
+                    mapping[ke] = self.aliases[ke]
+                else:
+                    new.append(ke)
+            if not new:
+                return mapping
+
+            embeddings = self._embed(new)
+            canonical: List[str] = []
+            canonical_embeddings: List[np.ndarray] = []
+            aliases: Dict[str, str] = {}
+            for ke, embedding, hits in zip(
+                new, embeddings, self.index.search(embeddings, self.k)
+            ):
+                target, score = hits[0] if hits else (ke, 0.0)
+                # New canonical key elements of this call are not indexed yet
+                if canonical:
+                    scores = np.stack(canonical_embeddings) @ embedding
+                    best = int(np.argmax(scores))
+                    if scores[best] > score:
+                        target, score = canonical[best], float(scores[best])
+                if score >= self.threshold:
+                    mapping[ke] = aliases[ke] = target
+                else:
+                    mapping[ke] = ke
+                    canonical.append(ke)
+                    canonical_embeddings.append(embedding)
 
-            af["key_elements"] = [normalized_mapping[ke] for ke in af["key_elements"]]
+            if canonical:
+                self.index.add(canonical, np.stack(canonical_embeddings))
+            if aliases:
+                with open(self.aliases_path, "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps(alias) + "\n" for alias in aliases.items())
+                self.aliases.update(aliases)
+            return mapping
 
+    def forget(self, key_elements: Iterable[str]):
+        """Drop key elements deleted from the graph and the aliases onto them."""
+        key_elements = set(key_elements)
+        with self._lock:
+            self.index.remove(key_elements)
+            aliases = {
+                alias: target
+                for alias, target in self.aliases.items()
+                if alias not in key_elements and target not in key_elements
+            }
+            if len(aliases) == len(self.aliases):
+                return
+            with open(self.aliases_path + ".tmp", "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(alias) + "\n" for alias in aliases.items())
+            os.replace(self.aliases_path + ".tmp", self.aliases_path)
+            self.aliases = aliases
+
+    def sanitize_key_elements(self, chunks: List[dict]):
+        """Normalize the key elements of the atomic facts of chunks."""
+        afs = [af for chunk in chunks for af in chunk["atomic_facts"]]
+        mapping = self.normalize(ke for af in afs for ke in af["key_elements"])
+        for af in afs:
+            af["key_elements"] = list(
+                dict.fromkeys(mapping[ke] for ke in af["key_elements"])
+            )
 
-def extract_chunks_from_document(document: Document, chunk_size=2000):
+
+def iter_chunks(
+    pages: Iterable[Page],
+    chunk_size: int = 2000,
+    overlap: int = 0,
+    model: str = chains.GPT4O_MODEL,
+) -> Iterator[dict]:
     """
-    Extract chunks from document while maintaining proper header hierarchy and context.
+    Yield chunks from a stream of pages while maintaining proper header hierarchy
+    and context. Each chunk is emitted as soon as it is complete, so pages can be
+    consumed while they are still being parsed.
+
+    chunk_size is measured in tokens of the model's tokenizer and includes the
+    header context prepended to the chunk text. Text blocks longer than the
+    budget are split; atomic blocks such as tables are kept whole. When a text
+    chunk is full, up to overlap tokens of its trailing blocks are repeated at
+    the start of the next chunk on the same page and under the same headers.
     """
-    chunks = []
-    current_chunk = []
+    encoding = get_encoding(model)
+    current_chunk = []  # (block, tokens) pairs
     current_tokens = 0
     current_context = {
         "headers": [],  # List of headers in hierarchical order
         "footnotes": [],
-        "captions": []
+        "captions": [],
     }
-    
+    # Header context as it is prepended to chunks, and its size in tokens
+    header_text = ""
+    header_tokens = 0
+
     # Block types that should be kept together
     atomic_blocks = {
-        "Table", "Figure", "ListGroup", "Code", "Equation",
-        "TableOfContents", "PictureGroup"
+        "Table",
+        "Figure",
+        "ListGroup",
+        "Code",
+        "Equation",
+        "TableOfContents",
+        "PictureGroup",
     }
-    
+
     # Block types that provide context
     header_types = {"SectionHeader", "PageHeader"}
     context_types = {"Caption", "Footnote"}
-    
+    text_types = {"Text", "TextInlineMath", "ListItem"}
+
+    def token_count(text: str) -> int:
+        return len(encoding.encode_ordinary(text))
+
+    # Blocks are joined with "\n" and headers with "\n\n"
+    separator_tokens = token_count("\n")
+    header_separator_tokens = token_count("\n\n")
+
     def get_header_level(header_text: str) -> int:
         """Get header level from number of leading '#' characters"""
-        return len(header_text) - len(header_text.lstrip('#'))
-    
-    def update_header_hierarchy(new_header: str) -> bool:
+        return len(header_text) - len(header_text.lstrip("#"))
+
+    def update_header_hierarchy(new_header: str):
         """
-        Update header hierarchy and return True if context changed.
+        Update header hierarchy.
         """
+        nonlocal header_text, header_tokens
         new_level = get_header_level(new_header)
-        
+
         # Remove headers of same or lower level
         existing_headers = current_context["headers"]
         current_context["headers"] = [
-            h for h in existing_headers
-            if get_header_level(h) < new_level
+            h for h in existing_headers if get_header_level(h) < new_level
         ]
-        
+
         # Add new header
         current_context["headers"].append(new_header)
-        return existing_headers and existing_headers not in current_context["headers"]
-    
-    def create_chunk_with_context(page, blocks, chunk_type="TextGroup"):
+
+        # Keep at least half of every chunk for content by dropping the
+        # outermost headers from the chunk text if the hierarchy is too long
+        headers = current_context["headers"]
+        while True:
+            header_text = "\n".join(headers)
+            header_tokens = token_count(header_text) + header_separator_tokens
+            if header_tokens <= chunk_size // 2 or len(headers) == 1:
+                break
+            headers = headers[1:]
+
+    def create_chunk_with_context(page, blocks, chunk_type="TextGroup", tokens=0):
         """Create a chunk with proper context and header hierarchy"""
         if not blocks:
             return None
-            
+
         # Get text with headers
-        header_text = "\n".join(current_context["headers"]) if current_context["headers"] else ""
         block_text = "\n".join(b.text for b in blocks)
         combined_text = f"{header_text}\n\n{block_text}" if header_text else block_text
-        
+
         return {
             "text": combined_text,
             "type": chunk_type,
+            "tokens": header_tokens + tokens,
             "context": {
                 "headers": current_context["headers"].copy(),
                 "footnotes": current_context["footnotes"].copy(),
-                "captions": current_context["captions"].copy()
+                "captions": current_context["captions"].copy(),
             },
             "page": page.number,
-            "block_positions": [coord for b in blocks for coord in b.position.to_list()]
+            "block_positions": [
+                coord for b in blocks for coord in b.position.to_list()
+            ],
         }
-    
+
+    def joined_tokens(pairs) -> int:
+        """Tokens of the newline-joined text of (block, tokens) pairs."""
+        return sum(t for _, t in pairs) + separator_tokens * max(len(pairs) - 1, 0)
+
+    def flush_chunk(page):
+        return create_chunk_with_context(
+            page, [b for b, _ in current_chunk], tokens=current_tokens
+        )
+
+    def overlap_blocks(limit: int):
+        """Trailing blocks of the current chunk that fit in limit tokens."""
+        if limit <= 0:
+            return []
+        for start in range(len(current_chunk)):
+            if joined_tokens(current_chunk[start:]) <= limit:
+                return current_chunk[start:]
+        return []
+
+    def split_block(block, budget: int):
+        """Split a text block into pieces of at most budget tokens."""
+        tokens = encoding.encode_ordinary(block.text)
+        if len(tokens) <= budget:
+            return [(block, len(tokens))]
+        pieces = []
+        for start in range(0, len(tokens), budget):
+            text = encoding.decode(tokens[start : start + budget])
+            pieces.append((block.model_copy(update={"text": text}), token_count(text)))
+        return pieces
+
     # Process blocks in order
-    for page in document.pages:
-        context_changed = False
-        
+    for page in pages:
         for block in page.blocks:
-            # Update context for headers
+            # Update context for headers, closing the chunk of the previous section
             if block.type in header_types:
-                context_changed = update_header_hierarchy(block.text)
+                if current_chunk:
+                    yield flush_chunk(page)
+                    current_chunk = []
+                    current_tokens = 0
+                update_header_hierarchy(block.text)
                 continue
-                
+
             # Update context for footnotes and captions
             if block.type in context_types:
                 current_context[block.type.lower() + "s"].append(block.text)
                 continue
-            
+
             # Handle atomic blocks (keep intact)
             if block.type in atomic_blocks:
                 # Save current chunk if exists
                 if current_chunk:
-                    chunk = create_chunk_with_context(current_chunk)
+                    chunk = flush_chunk(page)
                     if chunk:
-                        chunks.append(chunk)
+                        yield chunk
                     current_chunk = []
                     current_tokens = 0
-                
+
                 # Create atomic block chunk
-                atomic_chunk = create_chunk_with_context([block], block.type)
+                atomic_chunk = create_chunk_with_context(
+                    page, [block], block.type, token_count(block.text)
+                )
                 if atomic_chunk:
-                    chunks.append(atomic_chunk)
+                    yield atomic_chunk
                 continue
-            
+
             # Handle regular text blocks
-            if block.type in {"Text", "TextInlineMath", "ListItem"}:
-                estimated_tokens = len(block.text.split())
-                
-                # Start new chunk if current is too large or context changed
-                if current_tokens + estimated_tokens > chunk_size or context_changed:
+            if block.type in text_types:
+                budget = max(chunk_size - header_tokens, 1)
+
+                for piece, piece_tokens in split_block(block, budget):
+                    # Start new chunk if current is too large
+                    if (
+                        current_chunk
+                        and current_tokens + separator_tokens + piece_tokens > budget
+                    ):
+                        yield flush_chunk(page)
+                        current_chunk = overlap_blocks(
+                            min(overlap, budget - piece_tokens - separator_tokens)
+                        )
+                        current_tokens = joined_tokens(current_chunk)
+
                     if current_chunk:
-                        chunk = create_chunk_with_context(page,current_chunk)
-                        if chunk:
-                            chunks.append(chunk)
-                        current_chunk = []
-                        current_tokens = 0
-                    context_changed = False
-                
-                current_chunk.append(block)
-                current_tokens += estimated_tokens
-        
+                        current_tokens += separator_tokens
+                    current_chunk.append((piece, piece_tokens))
+                    current_tokens += piece_tokens
+
         # Add remaining blocks at end of page
         if current_chunk:
-            chunk = create_chunk_with_context(page, current_chunk)
+            chunk = flush_chunk(page)
             if chunk:
-                chunks.append(chunk)
+                yield chunk
             current_chunk = []
             current_tokens = 0
-    
-    return chunks
 
 
-async def process_document(doc: Document):
+def extract_chunks_from_document(document: Document, chunk_size=2000, overlap=0):
+    """
+    Extract chunks from document while maintaining proper header hierarchy and context.
+    """
+    return list(iter_chunks(document.pages, chunk_size, overlap))
 
-    # key_element_normalizer = KeyElementNormalizer()
-    print("Chunking document")
 
-    chunks = extract_chunks_from_document(doc)
-    
-    print("Constructing knowledge graph")
-    construction_tasks = [
-        asyncio.create_task(
-            construction_chain().ainvoke(
-                {
-                    "input": chunk["text"]
-                }
-            )
-        )
-        for chunk in chunks
-    ]
-    
-    print("Extracting atomic facts")
-    results = await asyncio.gather(*construction_tasks)
-    # print("Calculating tf-idf matrix")
-    # tf_idf_matrix = calculate_tfidf_matrix(
-    #    [chunk["text"] for chunk in chunks],
-    #    [
-    #        ke
-    #        for result in results
-    #        for af in result.atomic_facts
-    #        for ke in af.key_elements
-    #    ],
-    # )
+async def extract_atomic_facts(chunk: dict) -> Extraction:
+    """Run the construction chain on one chunk and write the result to the cache."""
+    extraction = await chains.construction_chain().ainvoke({"input": chunk["text"]})
+    extraction_cache().put(
+        encode_md5(chunk["text"]),
+        chains.construction_prompt_hash(),
+        chains.GPT4O_MODEL,
+        extraction,
+    )
+    return extraction
+
+
+def get_cached_extractions(chunk_ids: List[str]) -> Dict[str, Extraction]:
+    """Look up earlier extractions of chunks with the current prompt and model."""
+    return extraction_cache().get_many(
+        chunk_ids, chains.construction_prompt_hash(), chains.GPT4O_MODEL
+    )
+
+
+def attach_atomic_facts(chunks: List[dict], results: List[Optional[Extraction]]):
+    """
+    Store extraction results on their chunks and assign ids and indexes.
+
+    A None result marks a chunk that was not extracted because the graph
+    already has it; it gets no atomic facts and keeps the stored ones.
+    """
     for index, chunk in enumerate(chunks):
-        chunk["atomic_facts"] = [
-            af for af in results[index].atomic_facts if af is not None
-        ]
-        
         chunk["id"] = encode_md5(chunk["text"])
         chunk["index"] = index
-        # chunk["tfidf"] = tf_idf_matrix[index]
+        set_atomic_facts(chunk, results[index])
 
-        # key_element_normalizer.sanitize_key_elements(chunk)
 
-        for af in chunk["atomic_facts"]:
-            af["id"] = encode_md5(af["atomic_fact"])
+def set_atomic_facts(chunk: dict, result: Optional[Extraction]):
+    """Store the extraction result of one chunk, None if it was not extracted."""
+    chunk["atomic_facts"] = (
+        [af.model_dump() for af in result.atomic_facts if af is not None]
+        if result is not None
+        else []
+    )
+    chunk["extracted"] = result is not None
+    for af in chunk["atomic_facts"]:
+        af["id"] = encode_md5(af["atomic_fact"])
+
+
+def count_import_rows(chunks: List[dict]) -> int:
+    """Number of chunk, atomic fact and key element rows import_chunks writes."""
+    return sum(
+        1
+        + len(chunk["atomic_facts"])
+        + sum(len(af["key_elements"]) for af in chunk["atomic_facts"])
+        for chunk in chunks
+    )
+
+
+def chunk_terms(atomic_facts: List[dict]) -> List[str]:
+    """
+    The distinct key elements extracted from a chunk.
+
+    Stored on the chunk as terms when it is created and added to the document
+    frequency df of each key element, which the vector retrieval turns into
+    an idf; removing the chunk subtracts them again.
+    """
+    return list(dict.fromkeys(ke for af in atomic_facts for ke in af["key_elements"]))
+
+
+def index_chunk_terms(batch_size: int = CHUNK_BATCH_SIZE) -> int:
+    """
+    Store the terms of chunks imported before they were kept, see chunk_terms.
+
+    Returns the number of chunks updated.
+    """
+    graph = neo4j.get_graph()
+    indexed = 0
+    while True:
+        result = graph.query(
+            """MATCH (c:Chunk) WHERE c.terms IS NULL
+    WITH c LIMIT $limit
+    OPTIONAL MATCH (c)-[:HAS_ATOMIC_FACT]->()-[:HAS_KEY_ELEMENT]->(k:KeyElement)
+    RETURN c.id AS id, collect(DISTINCT k.id) AS key_elements
+    """,
+            params={"limit": batch_size},
+        )
+        if not result:
+            return indexed
+        neo4j.write_batches(
+            """UNWIND $rows AS row
+    MATCH (c:Chunk {id: row.id}) WHERE c.terms IS NULL
+    SET c.terms = row.terms
+    WITH row
+    UNWIND row.terms AS term
+    MATCH (k:KeyElement {id: term})
+    SET k.df = coalesce(k.df, 0) + 1
+    """,
+            [
+                {"id": record["id"], "terms": record["key_elements"]}
+                for record in result
+            ],
+        )
+        indexed += len(result)
 
-    print("Importing data into Neo4j")
-    import_query = """
-    MERGE (d:Document {id:$document_name})
+
+def write_document(doc: Document):
+    neo4j.get_graph().query(
+        """MERGE (d:Document {id: $document_name})
     SET d.address = $document_address
-    WITH d
-    UNWIND $data AS row
+    """,
+        params={"document_name": doc.name, "document_address": doc.address},
+    )
+
+
+def write_chunks(doc: Document, chunks: List[dict]):
+    """
+    Write a document and its chunks, atomic facts and key elements to Neo4j.
+
+    Nodes and relationships are written in batches by neo4j.write_batches.
+    A chunk node is written last, in the same transaction as its links to
+    the document and its atomic facts, so a chunk found in the graph is
+    always complete even if an import fails halfway. The same transaction
+    adds a new chunk to the document frequencies of its key elements, see
+    chunk_terms.
+    """
+    key_elements = {}
+    atomic_facts = {}
+    for chunk in chunks:
+        for af in chunk["atomic_facts"]:
+            atomic_facts[af["id"]] = {"id": af["id"], "text": af["atomic_fact"]}
+            for ke in af["key_elements"]:
+                key_elements[(af["id"], ke)] = {"atomic_fact": af["id"], "id": ke}
+
+    key_element_ids = list({row["id"]: None for row in key_elements.values()})
+    write_document(doc)
+    neo4j.write_batches(
+        """UNWIND $rows AS row
+    MERGE (k:KeyElement {id: row.id})
+    """,
+        [{"id": key_element} for key_element in key_element_ids],
+    )
+    neo4j.stamp_key_elements(key_element_ids)
+    neo4j.get_keyword_index().add(key_element_ids)
+    neo4j.write_batches(
+        """UNWIND $rows AS row
+    MERGE (a:AtomicFact {id: row.id})
+    SET a.text = row.text
+    """,
+        list(atomic_facts.values()),
+    )
+    neo4j.write_batches(
+        """UNWIND $rows AS row
+    MATCH (a:AtomicFact {id: row.atomic_fact})
+    MATCH (k:KeyElement {id: row.id})
+    MERGE (a)-[:HAS_KEY_ELEMENT]->(k)
+    """,
+        list(key_elements.values()),
+    )
+    neo4j.write_batches(
+        """MATCH (d:Document {id: $document_name})
+    UNWIND $rows AS row
     MERGE (c:Chunk {id: row.id})
+    ON CREATE SET c._created = true
     SET c.text = row.text,
         c.index = row.index,
         c.type = row.type,
         c.block_positions = row.block_positions,
-        c.page = row.page
-    MERGE (d)-[:HAS_CHUNK]->(c)
+        c.page = row.page,
+        c.terms = row.terms
+    MERGE (d)-[r:HAS_CHUNK]->(c)
+    SET r.index = row.index
+    // Concurrent imports of a chunk wait for each other on the MERGE, so
+    // only the one that created it sees the flag
+    WITH c, row, coalesce(c._created, false) AS created
+    REMOVE c._created
+    WITH c, row, created
+    CALL {
+        WITH row, created
+        UNWIND CASE WHEN created THEN row.terms ELSE [] END AS term
+        MATCH (k:KeyElement {id: term})
+        SET k.df = coalesce(k.df, 0) + 1
+    }
     WITH c, row
     UNWIND row.atomic_facts AS af
-    MERGE (a:AtomicFact {id: af.id})
-    SET a.text = af.atomic_fact
+    MATCH (a:AtomicFact {id: af})
     MERGE (c)-[:HAS_ATOMIC_FACT]->(a)
-    WITH c, a, af
-    UNWIND af.key_elements AS ke
-    MERGE (k:KeyElement {id: ke})
-    MERGE (a)-[:HAS_KEY_ELEMENT]->(k)
+    """,
+        # A chunk repeated in a document must only count once
+        list(
+            {
+                chunk["id"]: {
+                    **{key: chunk[key] for key in CHUNK_PROPERTIES},
+                    "terms": chunk_terms(chunk["atomic_facts"]),
+                    "atomic_facts": [af["id"] for af in chunk["atomic_facts"]],
+                }
+                for chunk in chunks
+            }.values()
+        ),
+        params={"document_name": doc.name},
+        batch_size=CHUNK_BATCH_SIZE,
+    )
+
+
+def attach_chunks(doc: Document, chunks: List[dict]):
+    """
+    Link chunks that are already in the graph to a document.
+
+    The chunk nodes, which other documents may share, are left as they are;
+    only the position of the chunk in this document is written.
+    """
+    write_document(doc)
+    neo4j.write_batches(
+        """MATCH (d:Document {id: $document_name})
+    UNWIND $rows AS row
+    MATCH (c:Chunk {id: row.id})
+    MERGE (d)-[r:HAS_CHUNK]->(c)
+    SET r.index = row.index
+    """,
+        [{"id": c["id"], "index": c["index"]} for c in chunks],
+        params={"document_name": doc.name},
+    )
+
+
+def find_stored_chunks(chunk_ids: List[str]) -> Set[str]:
+    """Ids among chunk_ids of chunks that are already in the graph."""
+    if not chunk_ids:
+        return set()
+    result = neo4j.get_graph().query(
+        """UNWIND $chunk_ids AS id
+    MATCH (c:Chunk {id: id})
+    RETURN c.id AS id
+    """,
+        params={"chunk_ids": chunk_ids},
+    )
+    return {record["id"] for record in result}
+
+
+def document_exists(doc_name: str) -> bool:
+    result = neo4j.get_graph().query(
+        "MATCH (d:Document {id: $document_name}) RETURN count(d) > 0 AS exists",
+        params={"document_name": doc_name},
+    )
+    return result[0]["exists"]
+
+
+def get_document_chunk_indexes(doc_name: str) -> Dict[str, int]:
+    """Ids of the chunks of a stored document mapped to their index, in order."""
+    # Documents imported before chunks were shared keep the index on the chunk
+    result = neo4j.get_graph().query(
+        """MATCH (d:Document {id: $document_name})-[r:HAS_CHUNK]->(c:Chunk)
+    WITH c, coalesce(r.index, c.index) AS index
+    RETURN c.id AS id, index ORDER BY index
+    """,
+        params={"document_name": doc_name},
+    )
+    return {record["id"]: record["index"] for record in result}
+
+
+@dataclass
+class RemovalStats:
+    """Nodes deleted from the graph."""
+
+    chunks: int = 0
+    atomic_facts: int = 0
+    key_elements: List[str] = field(default_factory=list)
+
+    def add(self, other: "RemovalStats"):
+        self.chunks += other.chunks
+        self.atomic_facts += other.atomic_facts
+        self.key_elements += other.key_elements
+
+    def report(self) -> str:
+        return (
+            f"{self.chunks} chunks, {self.atomic_facts} atomic facts and "
+            f"{len(self.key_elements)} key elements"
+        )
+
+
+# Removes a deleted chunk from the document frequencies of its key elements
+_FORGET_CHUNK_TERMS = """CALL {
+        WITH c
+        UNWIND coalesce(c.terms, []) AS term
+        MATCH (k:KeyElement {id: term})
+        SET k.df = k.df - 1
+    }"""
+
+
+def remove_chunks(doc_name: str, chunk_ids: List[str]) -> RemovalStats:
     """
+    Detach chunks from a document and delete what is left without references.
 
+    Chunks still used by another document are kept, without the NEXT
+    relationships of this document. Atomic facts and key elements are only
+    checked if they hung off a deleted chunk, so the cost is proportional to
+    the removed chunks rather than to the graph.
+    """
+    removal = RemovalStats()
+    if not chunk_ids:
+        return removal
     graph = neo4j.get_graph()
-    graph.query(
-        import_query,
-        params={
-            "data": chunks,
-            "document_name": doc.name,
-            "document_address": doc.address,
-        },
+    result = graph.query(
+        f"""MATCH (d:Document {{id: $document_name}})-[r:HAS_CHUNK]->(c:Chunk)
+    WHERE c.id IN $chunk_ids
+    DELETE r
+    WITH c
+    OPTIONAL MATCH (c)-[n:NEXT {{doc: $document_name}}]-()
+    DELETE n
+    WITH DISTINCT c
+    WHERE NOT (c)<-[:HAS_CHUNK]-(:Document)
+    {_FORGET_CHUNK_TERMS}
+    OPTIONAL MATCH (c)-[:HAS_ATOMIC_FACT]->(a:AtomicFact)
+    WITH c, collect(a.id) AS atomic_fact_ids
+    DETACH DELETE c
+    RETURN atomic_fact_ids
+    """,
+        params={"document_name": doc_name, "chunk_ids": chunk_ids},
     )
-    # Create next relationships between chunks
-    graph.query(
-        """MATCH (c:Chunk)<-[:HAS_CHUNK]-(d:Document)
-    WHERE d.id = $document_name
-    WITH c ORDER BY c.index WITH collect(c) AS nodes
-    UNWIND range(0, size(nodes) -2) AS index
-    WITH nodes[index] AS start, nodes[index + 1] AS end
-    MERGE (start)-[:NEXT]->(end)
+    removal.chunks = len(result)
+    atomic_fact_ids = list({i for record in result for i in record["atomic_fact_ids"]})
+    if not atomic_fact_ids:
+        return removal
+
+    result = graph.query(
+        """MATCH (a:AtomicFact)
+    WHERE a.id IN $atomic_fact_ids AND NOT (a)<-[:HAS_ATOMIC_FACT]-(:Chunk)
+    OPTIONAL MATCH (a)-[:HAS_KEY_ELEMENT]->(k:KeyElement)
+    WITH a, collect(k.id) AS key_element_ids
+    DETACH DELETE a
+    RETURN key_element_ids
     """,
-        params={"document_name": doc.name},
+        params={"atomic_fact_ids": atomic_fact_ids},
+    )
+    removal.atomic_facts = len(result)
+    key_element_ids = list({i for record in result for i in record["key_element_ids"]})
+    if not key_element_ids:
+        return removal
+
+    result = graph.query(
+        """MATCH (k:KeyElement)
+    WHERE k.id IN $key_element_ids AND NOT (k)<-[:HAS_KEY_ELEMENT]-(:AtomicFact)
+    WITH k, k.id AS id
+    DETACH DELETE k
+    RETURN id
+    """,
+        params={"key_element_ids": key_element_ids},
+    )
+    removal.key_elements = [record["id"] for record in result]
+    return removal
+
+
+def forget_key_elements(key_elements: List[str]):
+    """Drop deleted key elements from the key element caches and indexes."""
+    if not key_elements:
+        return
+    neo4j.mark_removal()
+    neo4j.get_all_key_elements.cache_clear()
+    neo4j.get_keyword_index().remove(key_elements)
+    # Only a normalizer already loaded; one loaded later reads the index files.
+    # The class is wrapped in lru_cache, which mypy does not see.
+    if getattr(KeyElementNormalizer, "cache_info")().currsize:
+        KeyElementNormalizer().forget(key_elements)
+
+
+def remove_document(doc_name: str, batch_size: int = CHUNK_BATCH_SIZE) -> RemovalStats:
+    """
+    Delete a document with its chunks and whatever no other document uses.
+
+    Chunks are removed batch_size at a time, each batch in transactions of
+    its own, see remove_chunks.
+    """
+    chunk_ids = list(get_document_chunk_indexes(doc_name))
+    removal = RemovalStats()
+    for i in range(0, len(chunk_ids), batch_size):
+        removal.add(remove_chunks(doc_name, chunk_ids[i : i + batch_size]))
+    neo4j.get_graph().query(
+        "MATCH (d:Document {id: $document_name}) DETACH DELETE d",
+        params={"document_name": doc_name},
+    )
+    forget_key_elements(removal.key_elements)
+    return removal
+
+
+def _delete_in_batches(query: str, batch_size: int) -> List[dict]:
+    """Run a query deleting up to $limit nodes until it deletes fewer."""
+    graph = neo4j.get_graph()
+    records = []
+    while True:
+        result = graph.query(query, params={"limit": batch_size})
+        records += result
+        if len(result) < batch_size:
+            return records
+
+
+def compact_graph(batch_size: int = CHUNK_BATCH_SIZE) -> RemovalStats:
+    """
+    Delete chunks, atomic facts and key elements that nothing references.
+
+    remove_chunks and remove_document leave none behind, but an interrupted
+    import or removal can, as can documents deleted by hand. Nodes are
+    deleted batch_size at a time, each batch in a transaction of its own.
+    """
+    # In this order, as deleting chunks orphans atomic facts and so on
+    chunks = _delete_in_batches(
+        f"""MATCH (c:Chunk) WHERE NOT (c)<-[:HAS_CHUNK]-(:Document)
+    WITH c, c.id AS id LIMIT $limit
+    {_FORGET_CHUNK_TERMS}
+    DETACH DELETE c
+    RETURN id
+    """,
+        batch_size,
     )
+    atomic_facts = _delete_in_batches(
+        """MATCH (a:AtomicFact) WHERE NOT (a)<-[:HAS_ATOMIC_FACT]-(:Chunk)
+    WITH a, a.id AS id LIMIT $limit
+    DETACH DELETE a
+    RETURN id
+    """,
+        batch_size,
+    )
+    key_elements = _delete_in_batches(
+        """MATCH (k:KeyElement) WHERE NOT (k)<-[:HAS_KEY_ELEMENT]-(:AtomicFact)
+    WITH k, k.id AS id LIMIT $limit
+    DETACH DELETE k
+    RETURN id
+    """,
+        batch_size,
+    )
+    removal = RemovalStats(
+        chunks=len(chunks),
+        atomic_facts=len(atomic_facts),
+        key_elements=[record["id"] for record in key_elements],
+    )
+    forget_key_elements(removal.key_elements)
+    return removal
+
+
+def chunk_links(chunk_ids: List[str]) -> Set[Tuple[str, str]]:
+    """NEXT relationships between chunks in the order of chunk_ids."""
+    return {(a, b) for a, b in zip(chunk_ids, chunk_ids[1:]) if a != b}
+
+
+def write_chunk_links(doc_name: str, links: Iterable[Tuple[str, str]]):
+    """
+    Create NEXT relationships of a document between pairs of stored chunks.
+
+    Chunks are shared between documents, so a NEXT relationship carries the
+    document it belongs to as doc, and documents with the same chunks in a
+    different order do not overwrite each other's links.
+    """
+    neo4j.write_batches(
+        """UNWIND $rows AS row
+    MATCH (start:Chunk {id: row.start}), (end:Chunk {id: row.end})
+    MERGE (start)-[:NEXT {doc: $document_name}]->(end)
+    """,
+        [{"start": start, "end": end} for start, end in links],
+        params={"document_name": doc_name},
+    )
+
+
+def relink_chunks(
+    doc_name: str,
+    old_chunk_ids: List[str],
+    new_chunk_ids: List[str],
+    linked: Optional[Set[Tuple[str, str]]] = None,
+):
+    """
+    Update NEXT relationships for a new chunk order, touching only changed links.
+
+    Links of the old order missing from the new one are deleted and links of
+    the new order are created unless they are in the old order or in linked,
+    the links already written with the chunks, see import_chunks. What is
+    left are the gaps around inserted, removed and failed chunks, so the cost
+    is proportional to the changes rather than to the document. Links
+    written before they carried their document are only deleted if no other
+    document has the two chunks next to each other.
+    """
+    old_links = chunk_links(old_chunk_ids)
+    new_links = chunk_links(new_chunk_ids)
+    if stale_links := old_links - new_links:
+        neo4j.write_batches(
+            """UNWIND $rows AS row
+    MATCH (start:Chunk {id: row.start})-[r:NEXT]->(end:Chunk {id: row.end})
+    WHERE r.doc = $document_name
+        OR r.doc IS NULL AND NOT EXISTS {
+            MATCH (start)<-[a:HAS_CHUNK]-(d:Document)-[b:HAS_CHUNK]->(end)
+            WHERE d.id <> $document_name
+                AND coalesce(b.index, end.index) = coalesce(a.index, start.index) + 1
+        }
+    DELETE r
+    """,
+            [{"start": start, "end": end} for start, end in stale_links],
+            params={"document_name": doc_name},
+        )
+    write_chunk_links(doc_name, new_links - old_links - (linked or set()))
+
+
+def import_chunks(
+    doc: Document,
+    chunks: List[dict],
+    existing: Optional[Dict[str, int]] = None,
+    links: Iterable[Tuple[str, str]] = (),
+) -> List[dict]:
+    """
+    Write chunks of a document, returning the chunks written.
+
+    Extracted chunks are written with their atomic facts. Chunks the graph
+    already had, from this or another document, are only linked to the
+    document, and only if they are new to it or moved. existing maps the ids
+    of the chunks the document had to their index, as returned by
+    get_document_chunk_indexes. links are NEXT relationships to create once
+    the chunks are written, between these chunks or chunks imported before.
+    """
+    existing = existing or {}
+    extracted = [chunk for chunk in chunks if chunk["extracted"]]
+    attached = [
+        chunk
+        for chunk in chunks
+        if not chunk["extracted"] and existing.get(chunk["id"]) != chunk["index"]
+    ]
+    if extracted:
+        write_chunks(doc, extracted)
+    if attached:
+        attach_chunks(doc, attached)
+    write_chunk_links(doc.name, links)
+    return extracted + attached
+
+
+def finish_document(
+    doc_name: str,
+    chunk_ids: List[str],
+    existing: Optional[Dict[str, int]] = None,
+    linked: Optional[Set[Tuple[str, str]]] = None,
+) -> List[str]:
+    """
+    Remove the chunks a document no longer has and repair its NEXT links.
+
+    chunk_ids are the ids of all chunks of the document in order, after they
+    were imported, existing is as for import_chunks and linked are the links
+    written with the chunks; see relink_chunks. Returns the ids of the
+    removed chunks.
+    """
+    existing = existing or {}
+    removed = list(existing.keys() - set(chunk_ids))
+    forget_key_elements(remove_chunks(doc_name, removed).key_elements)
+    relink_chunks(doc_name, list(existing), chunk_ids, linked)
+    return removed
+
+
+def sync_chunks(
+    doc: Document, chunks: List[dict], existing: Optional[Dict[str, int]] = None
+) -> List[dict]:
+    """
+    Bring a stored document in line with its new chunks.
+
+    Chunks are written by import_chunks, then chunks that vanished from the
+    document are removed and the rest linked by finish_document. Returns the
+    chunks written.
+    """
+    chunk_ids = [chunk["id"] for chunk in chunks]
+    links = chunk_links(chunk_ids) - chunk_links(list(existing or {}))
+    written = import_chunks(doc, chunks, existing, links)
+    removed = finish_document(doc.name, chunk_ids, existing, links)
+    extracted = sum(chunk["extracted"] for chunk in chunks)
+    print(
+        f"{doc.name}: {extracted} extracted, {len(chunks) - extracted} "
+        f"reused and {len(removed)} removed chunks"
+    )
+    return written
+
+
+async def process_document(
+    doc: Document,
+    pages: Optional[Iterable[Page]] = None,
+    incremental: bool = False,
+    scheduler: Optional[ExtractionScheduler] = None,
+) -> List[Tuple[dict, BaseException]]:
+    """
+    Build the knowledge graph for a document.
+
+    If pages is given it is consumed lazily instead of doc.pages. Parsing,
+    chunking, extraction and the Neo4j import overlap, see
+    pipeline.DocumentPipeline: extraction of each chunk starts as soon as the
+    chunk is complete and chunks are written as their extraction finishes.
+
+    Chunks that are already in the graph, from this or any other document,
+    are not extracted again but linked to the document with their stored
+    atomic facts. Other chunks are looked up in the extraction cache first,
+    so an interrupted run resumes without repeating finished calls. In
+    incremental mode chunks the document no longer has are removed as well,
+    see finish_document.
+
+    Extraction calls go through scheduler, by default one configured from
+    the environment. Chunks whose extraction fails after all retries are left
+    out of the import and returned with their errors. Key elements are
+    normalized with KeyElementNormalizer if NORMALIZE_KEY_ELEMENTS is set,
+    and the new ones are embedded before returning.
+    """
+    # Imported here because the pipeline is built from this module
+    from src.reader_agent.pipeline import DocumentPipeline
+
+    normalizer = KeyElementNormalizer() if os.getenv("NORMALIZE_KEY_ELEMENTS") else None
+    existing = get_document_chunk_indexes(doc.name) if incremental else {}
+
+    print("Constructing knowledge graph")
+    pipeline = DocumentPipeline(
+        doc, pages, scheduler=scheduler, existing=existing, normalizer=normalizer
+    )
+    failed = await pipeline.run()
+    pipeline.report()
+
+    print("Embedding new key elements")
+    await asyncio.to_thread(EmbeddingBackfill().run_once)
+    if failed:
+        print(
+            f"{len(failed)} of {pipeline.chunks} chunks failed extraction and were "
+            f"not imported, last error: {failed[-1][1]!r}"
+        )
+    return failed
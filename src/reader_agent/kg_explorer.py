@@ -1,11 +1,14 @@
-from typing import Dict, List
-
-from rank_bm25 import BM25Okapi
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 
 from src.adapters import neo4j
 from src.reader_agent import chains
 from src.reader_agent.states import InputState, OutputState, OverallState
-from src.utils import parse_function
+from src.utils import parse_function, reciprocal_rank_fusion
 
 
 def rational_plan_creation(state: InputState) -> OverallState:
@@ -19,25 +22,65 @@ def rational_plan_creation(state: InputState) -> OverallState:
     }
 
 
-def get_potential_nodes(question: str, count=10) -> List[str]:
+@lru_cache
+def get_retrieval_executor() -> ThreadPoolExecutor:
+    # Shared, so a retriever that timed out does not hold up the question
+    return ThreadPoolExecutor(
+        max_workers=int(os.getenv("RETRIEVAL_THREADS", 8)),
+        thread_name_prefix="retrieval",
+    )
+
 
-    similarity_based_data = neo4j.retrieve_key_elements_by_similarity(question, count)
-    all_keys = neo4j.get_all_key_elements()
-    bm25 = BM25Okapi(all_keys)
-    bm25_scores = bm25.get_scores(question.split())
-    bm25_based_data = sorted(
-        zip(all_keys, bm25_scores), key=lambda item: item[1], reverse=True
-    )[:count]
-    similarity_based_keys = [key for key, _ in similarity_based_data]
-    bm25_based_keys = [key for key, _ in bm25_based_data]
-    print(f"Similarity based keys: {similarity_based_keys}")
-    print(f"BM25 based keys: {bm25_based_keys}")
-    return list(set(similarity_based_keys + bm25_based_keys))
+def get_potential_nodes(
+    question: str, count=10, timeout: Optional[float] = None
+) -> List[Tuple[str, float]]:
+    """
+    Top count key elements for the question and their scores, best first.
+
+    The key elements found by vector similarity and BM25, which run
+    concurrently, are fused by reciprocal rank. A retriever that has not
+    answered within timeout seconds, RETRIEVAL_TIMEOUT by default, or that
+    failed is left out; if none answered, its error or a TimeoutError is
+    raised.
+    """
+    timeout = timeout or float(os.getenv("RETRIEVAL_TIMEOUT", 5.0))
+    executor = get_retrieval_executor()
+    retrievers = {
+        "Similarity": executor.submit(
+            neo4j.retrieve_key_elements_by_similarity, question, count
+        ),
+        "BM25": executor.submit(
+            neo4j.retrieve_key_elements_by_keywords, question, count
+        ),
+    }
+    deadline = time.monotonic() + timeout
+    rankings, errors = [], []
+    for name, future in retrievers.items():
+        try:
+            data = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            print(f"{name} retrieval timed out after {timeout} s")
+            continue
+        except Exception as e:
+            print(f"{name} retrieval failed: {e!r}")
+            errors.append(e)
+            continue
+        keys = [key for key, _ in data]
+        print(f"{name} based keys: {keys}")
+        rankings.append(keys)
+    if not rankings:
+        if errors:
+            raise errors[0]
+        raise TimeoutError(f"No retrieval answered within {timeout} s")
+
+    fused = reciprocal_rank_fusion(rankings)[:count]
+    print(f"Fused keys: {[(key, round(score, 4)) for key, score in fused]}")
+    return fused
 
 
 def initial_node_selection(state: OverallState) -> OverallState:
 
-    potential_nodes = get_potential_nodes(state.get("question"))
+    potential_nodes = [key for key, _ in get_potential_nodes(state.get("question"))]
     initial_nodes = chains.initial_nodes_chain().invoke(
         {
             "question": state.get("question"),
@@ -126,11 +169,12 @@ def atomic_fact_check(state: OverallState) -> OverallState:
 
 
 def get_subsequent_chunk_id(chunk_id: str):
+    # A chunk shared by documents has a NEXT relationship in each of them
     data = neo4j.get_graph().query(
         """
     MATCH (c:Chunk)-[:NEXT]->(next)
     WHERE c.id = $id
-    RETURN next.id AS next
+    RETURN DISTINCT next.id AS next
     """,
         params={"id": chunk_id},
     )
@@ -142,7 +186,7 @@ def get_previous_chunk_id(chunk_id: str):
         """
     MATCH (c:Chunk)<-[:NEXT]-(previous)
     WHERE c.id = $id
-    RETURN previous.id AS previous
+    RETURN DISTINCT previous.id AS previous
     """,
         params={"id": chunk_id},
     )
@@ -216,7 +260,7 @@ def chunk_check(state: OverallState) -> OverallState:
             # Get neighbors/use vector similarity
             print(f"Neighbor rational: {read_chunk_results.rational_next_move}")
             neighbors = get_potential_nodes(read_chunk_results.rational_next_move)
-            response["neighbor_check_queue"] = neighbors
+            response["neighbor_check_queue"] = [key for key, _ in neighbors]
 
     response["check_chunks_queue"] = check_chunks_queue
 
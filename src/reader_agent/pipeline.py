@@ -0,0 +1,402 @@
+"""
+Staged ingestion of a single document.
+
+Pages are parsed, chunked, extracted and written to Neo4j by separate stages
+connected by bounded queues, so all stages work at the same time and a large
+document takes about as long as its slowest stage instead of the sum of all
+of them. Parsing and chunking run in threads of their own, extraction goes
+through an ExtractionScheduler and chunks are written as soon as their
+extraction finishes. Every stage records how many items it handled and how
+long it was busy.
+"""
+
+import asyncio
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from src.models import Document, Extraction, Page
+from src.reader_agent import kg_constructor
+from src.reader_agent.scheduler import ExtractionScheduler
+from src.utils import encode_md5
+
+# Marks the end of the items in a queue
+_DONE = object()
+# What became of a chunk: its extraction, None if it is already stored, or
+# the error its extraction failed with
+Outcome = Union[Optional[Extraction], BaseException]
+
+
+@dataclass
+class StageStats:
+    """Items handled by a stage and the time it had at least one in progress."""
+
+    name: str
+    items: int = 0
+    busy: float = 0.0
+    _active: int = 0
+    _since: float = 0.0
+
+    def begin(self):
+        if self._active == 0:
+            self._since = time.perf_counter()
+        self._active += 1
+
+    def end(self, items: int = 1):
+        self._active -= 1
+        self.items += items
+        if self._active == 0:
+            self.busy += time.perf_counter() - self._since
+
+    def add(self, other: "StageStats"):
+        self.items += other.items
+        self.busy += other.busy
+
+    def report(self) -> str:
+        rate = self.items / self.busy if self.busy else 0.0
+        return (
+            f"{self.name:>8}: {self.items:>7} items, busy {self.busy:7.1f} s "
+            f"({rate:.1f}/s)"
+        )
+
+
+class DocumentPipeline:
+    """
+    Build the knowledge graph for one document as a staged pipeline.
+
+    pages is consumed lazily, so it can be a stream of pages still being
+    parsed. Chunks that are already in the graph are linked with their
+    stored atomic facts and chunks in the extraction cache are not
+    extracted again, see kg_constructor.process_document.
+
+    extraction_tasks maps chunk ids to extractions in flight and can be
+    shared by the pipelines of several documents, so a chunk they have in
+    common is extracted once. import_semaphore, if given, bounds the Neo4j
+    writes of all pipelines sharing it. normalizer, if given, normalizes the
+    key elements of extracted chunks before they are written. At most
+    max_unwritten chunks are between chunking and the Neo4j write at any
+    time, which bounds memory whichever stage is the slowest.
+
+    NEXT relationships are written with the chunks, between each chunk and
+    its neighbours imported so far, so the document is never read back to
+    link it; finish_document only fills the gaps left by failed chunks and
+    the edits of an incremental import.
+    """
+
+    def __init__(
+        self,
+        doc: Document,
+        pages: Optional[Iterable[Page]] = None,
+        scheduler: Optional[ExtractionScheduler] = None,
+        existing: Optional[Dict[str, int]] = None,
+        chunk_size: int = 2000,
+        overlap: int = 0,
+        extraction_tasks: Optional[Dict[str, asyncio.Task]] = None,
+        import_semaphore: Optional[asyncio.Semaphore] = None,
+        normalizer: Optional[kg_constructor.KeyElementNormalizer] = None,
+        page_queue_size: int = 8,
+        max_unwritten: int = 256,
+        write_batch_size: int = 256,
+    ):
+        self.doc = doc
+        self.pages = doc.pages if pages is None else pages
+        self.scheduler = scheduler or ExtractionScheduler.from_env(
+            kg_constructor.extract_atomic_facts
+        )
+        self.existing = existing or {}
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.extraction_tasks = {} if extraction_tasks is None else extraction_tasks
+        self.import_semaphore = import_semaphore
+        self.normalizer = normalizer
+        self.page_queue_size = page_queue_size
+        self.max_unwritten = max_unwritten
+        self.write_batch_size = write_batch_size
+
+        self.stages = {
+            name: StageStats(name) for name in ("parse", "chunk", "extract", "write")
+        }
+        self.chunks = 0
+        self.extracting = 0
+        self.cached = 0
+        self.written: List[dict] = []
+        self.failed: List[Tuple[dict, BaseException]] = []
+        self.removed: List[str] = []
+
+    def _put(self, items: queue.Queue, item):
+        while not self._stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _put_chunk(self, item):
+        future = asyncio.run_coroutine_threadsafe(self._chunks.put(item), self._loop)
+        while True:
+            try:
+                return future.result(timeout=0.1)
+            except TimeoutError:
+                if self._stop.is_set():
+                    future.cancel()
+                    return
+
+    def _parse(self):
+        stats = self.stages["parse"]
+        try:
+            pages = iter(self.pages)
+            while not self._stop.is_set():
+                stats.begin()
+                page = next(pages, _DONE)
+                stats.end(int(page is not _DONE))
+                if page is _DONE:
+                    break
+                self._put(self._pages, page)
+            self._put(self._pages, _DONE)
+        except BaseException as e:
+            self._put(self._pages, e)
+
+    def _parsed_pages(self):
+        stats = self.stages["chunk"]
+        while not self._stop.is_set():
+            # Waiting for pages does not count as chunking
+            stats.end(0)
+            try:
+                page = self._pages.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            finally:
+                stats.begin()
+            if page is _DONE:
+                return
+            if isinstance(page, BaseException):
+                raise page
+            yield page
+
+    def _chunk(self):
+        stats = self.stages["chunk"]
+        stats.begin()
+        try:
+            chunk_iterator = kg_constructor.iter_chunks(
+                self._parsed_pages(), self.chunk_size, self.overlap
+            )
+            for index, chunk in enumerate(chunk_iterator):
+                chunk["id"] = encode_md5(chunk["text"])
+                chunk["index"] = index
+                stats.end()
+                self._put_chunk(chunk)
+                stats.begin()
+            self._put_chunk(_DONE)
+        except BaseException as e:
+            self._put_chunk(e)
+        finally:
+            stats.end(0)
+
+    async def _next_chunks(self) -> List[Any]:
+        """
+        Wait for a chunk and take up to DEDUP_BATCH_SIZE that are ready.
+
+        The last item may be _DONE or the error chunking failed with.
+        """
+        batch = [await self._chunks.get()]
+        while len(batch) < kg_constructor.DEDUP_BATCH_SIZE:
+            try:
+                batch.append(self._chunks.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def _finish(self, chunk: dict, task: asyncio.Task):
+        try:
+            # Shielded, as other documents may wait for the same extraction
+            outcome = await asyncio.shield(task)
+        except asyncio.CancelledError as e:
+            # Cancelled by the failed document that started it, see run
+            if not task.cancelled():
+                raise
+            outcome = e
+        except Exception as e:
+            outcome = e
+        self.stages["extract"].end()
+        await self._results.put((chunk, outcome))
+
+    async def _dispatch(self):
+        finishers = []
+        try:
+            done = False
+            while not done:
+                batch = await self._next_chunks()
+                if isinstance(batch[-1], BaseException):
+                    raise batch[-1]
+                if batch[-1] is _DONE:
+                    batch.pop()
+                    done = True
+                chunk_ids = [chunk["id"] for chunk in batch]
+                stored = await asyncio.to_thread(
+                    kg_constructor.find_stored_chunks, chunk_ids
+                )
+                cached = await asyncio.to_thread(
+                    kg_constructor.get_cached_extractions,
+                    [i for i in chunk_ids if i not in stored],
+                )
+                for chunk in batch:
+                    # Released once the chunk is written
+                    await self._unwritten.acquire()
+                    self.chunks += 1
+                    chunk_id = chunk["id"]
+                    if chunk_id in stored:
+                        await self._results.put((chunk, None))
+                        continue
+                    if chunk_id in cached:
+                        self.cached += 1
+                        await self._results.put((chunk, cached[chunk_id]))
+                        continue
+                    if chunk_id not in self.extraction_tasks:
+                        # Waits while the scheduler has too many chunks pending
+                        self.extraction_tasks[chunk_id] = await self.scheduler.submit(
+                            chunk
+                        )
+                        self._submitted.append(self.extraction_tasks[chunk_id])
+                    self._extraction_ids.add(chunk_id)
+                    self.extracting += 1
+                    self.stages["extract"].begin()
+                    finishers.append(
+                        asyncio.create_task(
+                            self._finish(chunk, self.extraction_tasks[chunk_id])
+                        )
+                    )
+            await asyncio.gather(*finishers)
+            await self._results.put(_DONE)
+        finally:
+            for finisher in finishers:
+                finisher.cancel()
+
+    async def _write_batch(self, batch: List[Tuple[dict, Outcome]]):
+        stats = self.stages["write"]
+        stats.begin()
+        chunks = []
+        for chunk, outcome in batch:
+            if isinstance(outcome, BaseException):
+                self.failed.append((chunk, outcome))
+            else:
+                kg_constructor.set_atomic_facts(chunk, outcome)
+                chunks.append(chunk)
+        if self.normalizer is not None:
+            await asyncio.to_thread(
+                self.normalizer.sanitize_key_elements,
+                [chunk for chunk in chunks if chunk["extracted"]],
+            )
+        # NEXT links to the neighbours imported so far, the rest are written
+        # by later batches or repaired by finish_document
+        for chunk in chunks:
+            self._imported[chunk["index"]] = chunk["id"]
+        links = set()
+        for chunk in chunks:
+            index = chunk["index"]
+            for start, end in ((index - 1, index), (index, index + 1)):
+                if start in self._imported and end in self._imported:
+                    links |= kg_constructor.chunk_links(
+                        [self._imported[start], self._imported[end]]
+                    )
+        links -= self._stored_links
+        async with self.import_semaphore or asyncio.Semaphore():
+            self.written += await asyncio.to_thread(
+                kg_constructor.import_chunks, self.doc, chunks, self.existing, links
+            )
+        self._linked |= links
+        for chunk, _ in batch:
+            # Imported chunks are found in the graph from here on, and failed
+            # extractions are retried by the next document
+            self.extraction_tasks.pop(chunk["id"], None)
+            self._unwritten.release()
+        stats.end(len(chunks))
+
+    async def _write(self):
+        while True:
+            # Take whatever finished while the previous batch was written
+            batch: List[Any] = [await self._results.get()]
+            while len(batch) < self.write_batch_size:
+                try:
+                    batch.append(self._results.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            done = batch[-1] is _DONE
+            if done:
+                batch.pop()
+            if batch:
+                await self._write_batch(batch)
+            if done:
+                return
+
+    async def run(self) -> List[Tuple[dict, BaseException]]:
+        """
+        Run the document through all stages and link its chunks.
+
+        Returns the (chunk, error) pairs of the chunks whose extraction
+        failed after all retries, which are left out of the import.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stop = threading.Event()
+        # Pages, chunks and (chunk, Outcome) pairs, each followed by _DONE
+        self._pages: queue.Queue[object] = queue.Queue(maxsize=self.page_queue_size)
+        self._chunks: asyncio.Queue[object] = asyncio.Queue(
+            maxsize=kg_constructor.DEDUP_BATCH_SIZE
+        )
+        self._results: asyncio.Queue[object] = asyncio.Queue()
+        self._unwritten = asyncio.Semaphore(self.max_unwritten)
+        self._extraction_ids: Set[str] = set()
+        self._submitted: List[asyncio.Task] = []
+        self._imported: Dict[int, str] = {}
+        self._stored_links = kg_constructor.chunk_links(list(self.existing))
+        self._linked: Set[Tuple[str, str]] = set()
+
+        # Dedicated threads, as these block for the whole document and would
+        # starve the default executor that the other stages use
+        threads = [
+            threading.Thread(target=target, daemon=True)
+            for target in (self._parse, self._chunk)
+        ]
+        for thread in threads:
+            thread.start()
+        stages = [
+            asyncio.create_task(self._dispatch()),
+            asyncio.create_task(self._write()),
+        ]
+        try:
+            await asyncio.gather(*stages)
+        except BaseException:
+            # Nothing will write the extractions this document started
+            for task in self._submitted:
+                task.cancel()
+            raise
+        finally:
+            for stage in stages:
+                stage.cancel()
+            self._stop.set()
+            for chunk_id in self._extraction_ids:
+                self.extraction_tasks.pop(chunk_id, None)
+            for thread in threads:
+                await asyncio.to_thread(thread.join)
+
+        chunk_ids = [self._imported[index] for index in sorted(self._imported)]
+        async with self.import_semaphore or asyncio.Semaphore():
+            self.removed = await asyncio.to_thread(
+                kg_constructor.finish_document,
+                self.doc.name,
+                chunk_ids,
+                self.existing,
+                self._linked,
+            )
+        return self.failed
+
+    def report(self):
+        extracted = sum(chunk["extracted"] for chunk in self.written)
+        reused = self.chunks - extracted - len(self.failed)
+        print(
+            f"{self.doc.name}: {extracted} extracted, {reused} reused and "
+            f"{len(self.removed)} removed chunks"
+        )
+        for stats in self.stages.values():
+            print(stats.report())
@@ -0,0 +1,184 @@
+"""
+Scheduling of LLM extraction calls.
+
+ExtractionScheduler runs one extraction per chunk under a concurrency limit
+and request-per-minute and token-per-minute budgets, retries failed calls
+with jittered exponential backoff and keeps the number of unfinished chunks
+bounded, so a fast producer waits instead of piling up requests.
+"""
+
+import asyncio
+import os
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from src.models import Extraction
+
+# Status codes for which a retry cannot help
+PERMANENT_STATUS_CODES = {400, 401, 403, 404, 422}
+
+
+class RateLimiter:
+    """
+    Token bucket refilled continuously with limit units per minute.
+
+    The bucket holds at most burst units, one second of budget by default,
+    so a minute's budget is spread over the minute instead of being spent at
+    once. Requests are charged in full: one larger than the bucket waits
+    until the budget accrued since the previous request covers it. Waiters
+    are served in arrival order, so a large request is not starved by a
+    stream of small ones.
+    """
+
+    def __init__(self, limit: Optional[float], burst: Optional[float] = None):
+        self.limit = limit
+        self.burst = burst or (limit or 0.0) / 60
+        self._available = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Hold back all requests, e.g. after the server answered 429."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, amount: float = 1.0):
+        async with self._lock:
+            while (delay := self._paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+            if not self.limit:
+                return
+            # The bucket grows to fit a request larger than it
+            capacity = max(self.burst, amount)
+            while True:
+                now = time.monotonic()
+                self._available = min(
+                    capacity,
+                    self._available + (now - self._updated) * self.limit / 60,
+                )
+                self._updated = now
+                if self._available >= amount:
+                    self._available -= amount
+                    return
+                await asyncio.sleep((amount - self._available) * 60 / self.limit)
+
+
+def error_status_code(error: Exception) -> Optional[int]:
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class ExtractionStats:
+    requests: int = 0
+    retries: int = 0
+    rate_limited: int = 0
+    tokens: int = 0
+    failures: List[Tuple[dict, Exception]] = field(default_factory=list)
+
+
+class ExtractionScheduler:
+    """
+    Run extraction calls for chunks within concurrency and rate limits.
+
+    extract is the coroutine function doing one call, for instance
+    kg_constructor.extract_atomic_facts. Token use is estimated from the
+    "tokens" of a chunk plus request_overhead_tokens for the prompt and the
+    answer. At most max_pending chunks are unfinished at any time; submit
+    waits for a slot, which throttles whatever produces the chunks.
+    """
+
+    def __init__(
+        self,
+        extract: Callable[[dict], Awaitable[Extraction]],
+        max_concurrency: int = 8,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        max_pending: Optional[int] = None,
+        request_overhead_tokens: int = 1000,
+    ):
+        self.extract = extract
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.request_overhead_tokens = request_overhead_tokens
+        self.stats = ExtractionStats()
+
+        self._concurrency = asyncio.Semaphore(max_concurrency)
+        self._pending = asyncio.Semaphore(max_pending or 4 * max_concurrency)
+        self._requests = RateLimiter(requests_per_minute)
+        self._tokens = RateLimiter(tokens_per_minute)
+
+    @classmethod
+    def from_env(cls, extract: Callable[[dict], Awaitable[Extraction]], **kwargs):
+        """Create a scheduler configured by EXTRACTION_* environment variables."""
+        settings = {
+            "max_concurrency": int(os.getenv("EXTRACTION_CONCURRENCY", 8)),
+            "requests_per_minute": float(os.getenv("EXTRACTION_RPM", 0)) or None,
+            "tokens_per_minute": float(os.getenv("EXTRACTION_TPM", 0)) or None,
+            "max_retries": int(os.getenv("EXTRACTION_MAX_RETRIES", 5)),
+        }
+        return cls(extract, **{**settings, **kwargs})
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        # Full jitter keeps retries of many chunks from arriving in lockstep
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        return max(delay, _retry_after(error) or 0.0)
+
+    async def _run(self, chunk: dict) -> Extraction:
+        tokens = chunk.get("tokens", 0) + self.request_overhead_tokens
+        attempt = 0
+        while True:
+            async with self._concurrency:
+                # Take budget only once a slot is free, so requests go out
+                # at the pace the budget is granted
+                await self._requests.acquire()
+                await self._tokens.acquire(tokens)
+                self.stats.requests += 1
+                self.stats.tokens += tokens
+                try:
+                    return await self.extract(chunk)
+                except Exception as e:
+                    error = e
+            status_code = error_status_code(error)
+            if attempt >= self.max_retries or status_code in PERMANENT_STATUS_CODES:
+                self.stats.failures.append((chunk, error))
+                raise error
+
+            delay = self._backoff(attempt, error)
+            if status_code == 429:
+                # The budget is exhausted for everyone, not just this chunk
+                self.stats.rate_limited += 1
+                self._requests.pause(delay)
+            self.stats.retries += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _run_and_release(self, chunk: dict) -> Extraction:
+        try:
+            return await self._run(chunk)
+        finally:
+            self._pending.release()
+
+    async def submit(self, chunk: dict) -> asyncio.Task:
+        """Schedule the extraction of a chunk, waiting while too many are pending."""
+        await self._pending.acquire()
+        return asyncio.create_task(self._run_and_release(chunk))
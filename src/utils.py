@@ -3,35 +3,50 @@ import base64
 import os
 import re
 from difflib import SequenceMatcher
+from functools import lru_cache
 from hashlib import md5
-from typing import List
+from html.parser import HTMLParser
+from typing import Dict, Iterable, List, Tuple
 
-import pandas as pd
 import pymupdf as fitz
-from bs4 import BeautifulSoup
+import tiktoken
 from klarna_wiki_api.sessions import KlarnaWikiSession
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
-from sklearn.feature_extraction.text import TfidfVectorizer
 
 
 def encode_md5(text):
     return md5(text.encode("utf-8")).hexdigest()
 
 
-def calculate_tfidf_matrix(corpus, words):
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Tokenizer of an OpenAI model, loaded once per process."""
+    return tiktoken.encoding_for_model(model)
 
-    vectorizer = TfidfVectorizer(vocabulary=set(words), lowercase=False)
-    tfidf_matrix = vectorizer.fit_transform(corpus)
 
-    # Convert the result to a DataFrame for better readability
-    df = pd.DataFrame(
-        tfidf_matrix.toarray(), columns=vectorizer.get_feature_names_out()
-    )
-    return df.to_dict(orient="records")
+def count_tokens(text: str, model: str) -> int:
+    return len(get_encoding(model).encode_ordinary(text))
+
+
+def reciprocal_rank_fusion(
+    rankings: Iterable[List[str]], k: int = 60
+) -> List[Tuple[str, float]]:
+    """
+    Fuse rankings into one, best first, by reciprocal rank fusion.
+
+    An item scores the sum of 1 / (k + rank) over the rankings it is in, so
+    items ranked high by several rankings come first. Ties keep the order
+    the items were first seen in.
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(dict.fromkeys(ranking), 1):
+            scores[item] = scores.get(item, 0.0) + 1 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
 
 
 def highlight_text_in_pdf(pdf_path, output_path, page_number, rect):
@@ -317,6 +332,312 @@ def json_to_md(data, level=0):
     return md
 
 
+# Order in which Markdown conversions are applied. An element only sees the
+# Markdown of descendants converted in an earlier step; later ones are flattened
+# to plain text, e.g. bold inside a link or nested list items.
+_HEADING_STEPS = {f"h{level}": 7 - level for level in range(1, 7)}  # h6 first
+(
+    _LINK_STEP,
+    _IMAGE_STEP,
+    _UL_ITEM_STEP,
+    _OL_ITEM_STEP,
+    _STRONG_STEP,
+    _EM_STEP,
+    _PRE_STEP,
+    _CODE_STEP,
+    _QUOTE_STEP,
+    _TABLE_STEP,
+    _FINAL_STEP,
+) = range(7, 18)
+_TAG_STEPS = {
+    **_HEADING_STEPS,
+    "a": _LINK_STEP,
+    "strong": _STRONG_STEP,
+    "b": _STRONG_STEP,
+    "em": _EM_STEP,
+    "i": _EM_STEP,
+    "pre": _PRE_STEP,
+    "blockquote": _QUOTE_STEP,
+    "table": _TABLE_STEP,
+}
+# Tags BeautifulSoup's html.parser builder treats as empty elements
+_VOID_TAGS = {
+    "area",
+    "base",
+    "basefont",
+    "bgsound",
+    "br",
+    "col",
+    "command",
+    "embed",
+    "frame",
+    "hr",
+    "image",
+    "img",
+    "input",
+    "isindex",
+    "keygen",
+    "link",
+    "menuitem",
+    "meta",
+    "nextid",
+    "param",
+    "source",
+    "spacer",
+    "track",
+    "wbr",
+}
+
+
+class _Element:
+    __slots__ = (
+        "tag",
+        "attrs",
+        "step",
+        "texts",
+        "index",
+        "first_code",
+        "headers",
+        "rows",
+        "cells",
+    )
+
+    def __init__(self, tag, attrs, step, steps):
+        self.tag = tag
+        self.attrs = attrs
+        self.step = step
+        # Text of the element as seen by each step that still needs it
+        self.texts = {s: [] for s in steps}
+        self.index = 0
+        self.first_code = None
+        self.headers = None
+        self.rows = None
+        self.cells = None
+
+    def text(self, step: int) -> str:
+        return "".join(self.texts[step])
+
+
+class _MarkdownConverter(HTMLParser):
+    """Event-driven HTML to Markdown converter, see html_to_md."""
+
+    def reset(self):
+        super().reset()
+        self.stack = [_Element(None, {}, None, (_FINAL_STEP,))]
+        self.pending_data = []
+        self.preserve_whitespace = 0
+
+    def convert(self, html_content: str) -> str:
+        self.reset()
+        self.feed(html_content)
+        self.close()
+        self._flush_data()
+        while len(self.stack) > 1:
+            self._close_element()
+
+        text = self.stack[0].text(_FINAL_STEP)
+        text = re.sub(r"\n\s*\n", "\n\n", text)
+        text = re.sub(r" +", " ", text)
+        return text.strip()
+
+    def _open_elements(self, *tags):
+        return [
+            (depth, element)
+            for depth, element in enumerate(self.stack)
+            if element.tag in tags
+        ]
+
+    def _reaches(self, depth: int, step: int):
+        """
+        Check whether the element at depth still contains the current position
+        when its conversion step runs, i.e. nothing in between was converted
+        earlier. Returns the <pre> elements in between, which only detach the
+        position if they turn out to contain code, or None if it is detached.
+        """
+        pres = []
+        for element in self.stack[depth + 1 :]:
+            if element.tag == "pre":
+                pres.append(element)
+            elif element.step is not None and element.step < step:
+                return None
+        return pres
+
+    def _step(self, tag):
+        if tag == "li":
+            if self._open_elements("ul"):
+                return _UL_ITEM_STEP
+            if self._open_elements("ol"):
+                return _OL_ITEM_STEP
+            return None
+        if tag == "code":
+            return _CODE_STEP if self.stack[-1].tag != "pre" else None
+        return _TAG_STEPS.get(tag)
+
+    def handle_starttag(self, tag, attrs):
+        self._flush_data()
+        attrs = dict(attrs)
+        if tag == "img":
+            self._append(_Element(tag, attrs, _IMAGE_STEP, ()))
+            return
+        if tag in _VOID_TAGS:
+            return
+
+        parent = self.stack[-1]
+        step = self._step(tag)
+        if tag in ("script", "style"):
+            steps = ()
+        elif step is not None:
+            steps = (*parent.texts, step)
+        else:
+            steps = parent.texts
+        element = _Element(tag, attrs, step, steps)
+
+        if step == _OL_ITEM_STEP:
+            depth, outermost_list = self._open_elements("ol")[0]
+            if self._reaches(depth, _OL_ITEM_STEP) is not None:
+                outermost_list.index += 1
+                element.index = outermost_list.index
+        elif tag == "code":
+            for depth, pre in self._open_elements("pre"):
+                if (
+                    pre.first_code is None
+                    and self._reaches(depth, _PRE_STEP) is not None
+                ):
+                    pre.first_code = element
+        elif tag == "table":
+            element.headers = []
+            element.rows = []
+        elif tag == "tr":
+            element.cells = []
+            for depth, table in self._open_elements("table"):
+                pres = self._reaches(depth, _TABLE_STEP)
+                if pres is not None:
+                    table.rows.append((element.cells, pres))
+        elif tag in ("th", "td"):
+            # Cells are read back when the table is rendered
+            container_tag = "table" if tag == "th" else "tr"
+            for depth, container in self._open_elements(container_tag):
+                pres = self._reaches(depth, _TABLE_STEP)
+                if pres is None:
+                    continue
+                if tag == "th":
+                    container.headers.append((element, pres))
+                else:
+                    container.cells.append((element, pres))
+        elif tag in ("pre", "textarea"):
+            self.preserve_whitespace += 1
+
+        self.stack.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in _VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        self._flush_data()
+        if tag in _VOID_TAGS:
+            return
+        for depth in range(len(self.stack) - 1, 0, -1):
+            if self.stack[depth].tag == tag:
+                while len(self.stack) > depth:
+                    self._close_element()
+                return
+
+    def handle_data(self, data):
+        self.pending_data.append(data)
+
+    def handle_comment(self, data):
+        self._flush_data()
+
+    def handle_decl(self, decl):
+        self._flush_data()
+
+    def handle_pi(self, data):
+        self._flush_data()
+
+    def unknown_decl(self, data):
+        self._flush_data()
+        if data.startswith("CDATA["):
+            self.pending_data.append(data[6:])
+            self._flush_data()
+
+    def _flush_data(self):
+        if not self.pending_data:
+            return
+        data = "".join(self.pending_data)
+        self.pending_data = []
+        # Like BeautifulSoup, collapse whitespace-only strings outside <pre>
+        if not self.preserve_whitespace and not data.strip(" \n\t\f\r"):
+            data = "\n" if "\n" in data else " "
+        for texts in self.stack[-1].texts.values():
+            texts.append(data)
+
+    def _close_element(self):
+        element = self.stack.pop()
+        if element.tag in ("pre", "textarea"):
+            self.preserve_whitespace -= 1
+        self._append(element)
+
+    def _append(self, element):
+        markdown = self._render(element)
+        for step, texts in self.stack[-1].texts.items():
+            if markdown is not None and element.step < step:
+                texts.append(markdown)
+            elif step in element.texts:
+                texts.append(element.text(step))
+
+    @staticmethod
+    def _attached(items):
+        return [item for item, pres in items if not any(p.first_code for p in pres)]
+
+    def _render(self, element):
+        step = element.step
+        if step is None:
+            return None
+        if step <= len(_HEADING_STEPS):
+            return f"{'#' * (7 - step)} {element.text(step)}\n"
+        if step == _LINK_STEP:
+            return f"[{element.text(step)}]({element.attrs.get('href') or ''})"
+        if step == _IMAGE_STEP:
+            alt = element.attrs.get("alt") or ""
+            return f"![{alt}]({element.attrs.get('src') or ''})"
+        if step == _UL_ITEM_STEP:
+            return f"- {element.text(step)}\n"
+        if step == _OL_ITEM_STEP:
+            return f"{element.index}. {element.text(step)}\n"
+        if step == _STRONG_STEP:
+            return f"**{element.text(step)}**"
+        if step == _EM_STEP:
+            return f"*{element.text(step)}*"
+        if step == _PRE_STEP:
+            code = element.first_code
+            if code is None:
+                return None
+            classes = (code.attrs.get("class") or "").split()
+            lang = classes[0].replace("language-", "") if classes else ""
+            return f"```{lang}\n{code.text(_PRE_STEP)}\n```\n"
+        if step == _CODE_STEP:
+            return f"`{element.text(step)}`"
+        if step == _QUOTE_STEP:
+            lines = element.text(step).strip().split("\n")
+            return "> " + "\n> ".join(lines) + "\n"
+        if step == _TABLE_STEP:
+            md_table = []
+            headers = [
+                cell.text(_TABLE_STEP).strip()
+                for cell in self._attached(element.headers)
+            ]
+            if headers:
+                md_table.append("| " + " | ".join(headers) + " |")
+                md_table.append("| " + " | ".join(["---"] * len(headers)) + " |")
+            for row in self._attached(element.rows):
+                cells = [cell.text(_TABLE_STEP).strip() for cell in self._attached(row)]
+                if cells:
+                    md_table.append("| " + " | ".join(cells) + " |")
+            return "\n".join(md_table) + "\n"
+
+
 def html_to_md(html_content: str) -> str:
     """
     Convert HTML content to Markdown format.
@@ -327,95 +648,21 @@ def html_to_md(html_content: str) -> str:
     Returns:
         str: Markdown formatted string
     """
-    soup = BeautifulSoup(html_content, "html.parser")
-
-    # Remove script and style elements
-    for script in soup(["script", "style"]):
-        script.decompose()
-
-    # Handle headings
-    for i in range(6, 0, -1):
-        for heading in soup.find_all(f"h{i}"):
-            heading.replace_with(f"{'#' * i} {heading.get_text()}\n")
-
-    # Handle links
-    for link in soup.find_all("a"):
-        href = link.get("href", "")
-        text = link.get_text()
-        link.replace_with(f"[{text}]({href})")
-
-    # Handle images
-    for img in soup.find_all("img"):
-        alt = img.get("alt", "")
-        src = img.get("src", "")
-        img.replace_with(f"![{alt}]({src})")
-
-    # Handle lists
-    for ul in soup.find_all("ul"):
-        for li in ul.find_all("li"):
-            li.replace_with(f"- {li.get_text()}\n")
-
-    for ol in soup.find_all("ol"):
-        for i, li in enumerate(ol.find_all("li"), 1):
-            li.replace_with(f"{i}. {li.get_text()}\n")
-
-    # Handle emphasis
-    for strong in soup.find_all(["strong", "b"]):
-        strong.replace_with(f"**{strong.get_text()}**")
-
-    for em in soup.find_all(["em", "i"]):
-        em.replace_with(f"*{em.get_text()}*")
-
-    # Handle code blocks
-    for pre in soup.find_all("pre"):
-        code = pre.find("code")
-        if code:
-            lang = (
-                code.get("class", [""])[0].replace("language-", "")
-                if code.get("class")
-                else ""
-            )
-            pre.replace_with(f"```{lang}\n{code.get_text()}\n```\n")
-
-    # Handle inline code
-    for code in soup.find_all("code"):
-        if code.parent.name != "pre":
-            code.replace_with(f"`{code.get_text()}`")
-
-    # Handle blockquotes
-    for quote in soup.find_all("blockquote"):
-        lines = quote.get_text().strip().split("\n")
-        quote.replace_with("> " + "\n> ".join(lines) + "\n")
-
-    # Handle tables
-    for table in soup.find_all("table"):
-        md_table = []
-        # Headers
-        headers = []
-        for th in table.find_all("th"):
-            headers.append(th.get_text().strip())
-        if headers:
-            md_table.append("| " + " | ".join(headers) + " |")
-            md_table.append("| " + " | ".join(["---"] * len(headers)) + " |")
-
-        # Rows
-        for tr in table.find_all("tr"):
-            cells = []
-            for td in tr.find_all("td"):
-                cells.append(td.get_text().strip())
-            if cells:
-                md_table.append("| " + " | ".join(cells) + " |")
-
-        table.replace_with("\n".join(md_table) + "\n")
-
-    # Get the text and clean it up
-    text = soup.get_text()
-
-    # Clean up extra whitespace
-    text = re.sub(r"\n\s*\n", "\n\n", text)
-    text = re.sub(r" +", " ", text)
-
-    return text.strip()
+    return _MarkdownConverter().convert(html_content)
+
+
+def html_blocks_to_md(html_blocks: List[str]) -> List[str]:
+    """
+    Convert the HTML of several blocks, e.g. all blocks of a page, to Markdown.
+
+    Args:
+        html_blocks: HTML strings to convert
+
+    Returns:
+        List[str]: Markdown formatted strings, one per block
+    """
+    converter = _MarkdownConverter()
+    return [converter.convert(html_content) for html_content in html_blocks]
 
 
 def compare_header_levels(header1: str, header2: str) -> int: